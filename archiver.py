@@ -1,12 +1,112 @@
+import os
+import json
+import time
 import asyncio
-import aiohttp
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 
-ARCHIVER_URL = 'http://10.0.38.42/retrieval/data/getData.json'
+from instrumentation import PROFILER, count_frame
+
+# archiver appliance address, e.g. http://localhost:17665 for a local stand-in service
+ARCHIVER_HOST = os.environ.get('ARCHIVER_HOST', 'http://10.0.38.42')
+ARCHIVER_URL = f'{ARCHIVER_HOST}/retrieval/data/getData.json'
+PV_STATUS_URL = f'{ARCHIVER_HOST}/mgmt/bpl/getPVStatus'
+
+PV_STATUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'pv_status.json')
+# status entries older than this are requested again
+PV_STATUS_MAX_AGE_IN_SECONDS = 24 * 3600
+# statuses of pvs with archived data
+ARCHIVED_STATUSES = ['Being archived', 'Paused']
+# samples may still be reaching the archiver this long after their time
+ARCHIVER_DELAY_IN_SECONDS = 15 * 60
+
+
+class PVStatusCache:
+    """ local copy of the archiver status of each pv: whether it is archived, its sampling period and its first
+        and last samples, kept in a json file. The missing and expired entries of a request are refreshed
+        together, in a single getPVStatus call, and the requests are filtered against them beforehand """
+
+    def __init__(self, path: str = PV_STATUS_PATH, max_age_in_seconds: float = PV_STATUS_MAX_AGE_IN_SECONDS) -> None:
+        self.path = path
+        self.max_age_in_seconds = max_age_in_seconds
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def parse_status(status: dict) -> dict:
+        """ entry of one getPVStatus record (an empty one for pvs the archiver does not know) """
+        sampling_period = status.get('samplingPeriod')
+        return {'exists': status.get('status') in ARCHIVED_STATUSES,
+                'status': status.get('status', 'Not being archived'),
+                'sampling_period': float(sampling_period) if sampling_period not in (None, '') else None,
+                'first_sample': status.get('connectionFirstEstablished'),
+                'last_sample': status.get('lastEvent')}
+
+    def get_stale_pvs(self, pvs: list) -> list:
+        now = time.time()
+        return [pv for pv in dict.fromkeys(pvs) if pv not in self.entries or now - self.entries[pv]['checked'] > self.max_age_in_seconds]
+
+    async def refresh(self, pvs: list) -> None:
+        """ requests the status of the missing and expired pvs at once """
+        import aiohttp
+
+        stale = self.get_stale_pvs(pvs)
+        if not stale:
+            return
+        async with aiohttp.ClientSession() as session:
+            async with session.post(PV_STATUS_URL, json=stale) as response:
+                response.raise_for_status()
+                statuses = {status.get('pvName'): status for status in await response.json()}
+        now = time.time()
+        for pv in stale:
+            self.entries[pv] = {**PVStatusCache.parse_status(statuses.get(pv, {})), 'checked': now}
+        self.save()
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    async def filter_pvs(self, pvs: list) -> list:
+        """ pvs with archived data, in the given order; all of them if the status cannot be requested """
+        import aiohttp
+
+        try:
+            await self.refresh(pvs)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            print(f'pv status unavailable ({error}), requesting every pv')
+            return list(pvs)
+        return [pv for pv in pvs if self.entries[pv]['exists']]
+
+    def get_metadata(self, pvs: list = None) -> pd.DataFrame:
+        """ cached entries as a table, one row per pv """
+        pvs = list(self.entries) if pvs is None else pvs
+        return pd.DataFrame([self.entries.get(pv, {}) for pv in pvs], index=pvs)
+
 
 class Archiver:
+    # pvs are checked against the status cache before being requested
+    check_pv_status = True
+    status_cache: PVStatusCache = None
+
+    @staticmethod
+    def set_host(host: str) -> None:
+        """ points the data and status requests to another archiver (or a local stand-in service) """
+        global ARCHIVER_HOST, ARCHIVER_URL, PV_STATUS_URL
+        ARCHIVER_HOST = host
+        ARCHIVER_URL = f'{host}/retrieval/data/getData.json'
+        PV_STATUS_URL = f'{host}/mgmt/bpl/getPVStatus'
+
+    @staticmethod
+    def get_status_cache() -> PVStatusCache:
+        if Archiver.status_cache is None:
+            Archiver.status_cache = PVStatusCache()
+        return Archiver.status_cache
+
     @staticmethod
     async def fetch_pv(session, pv, time_from, time_to, is_optimized, mean_minutes):
         pv_query = f'mean_{int(60*mean_minutes)}({pv})' if is_optimized else pv
@@ -18,46 +118,87 @@ class Archiver:
 
     @staticmethod
     async def fetch_multiple_pvs(pvs: list, time_from: str, time_to: str, isOptimized: bool=False, mean_minutes: int=0):
+        import aiohttp
+
         async with aiohttp.ClientSession() as session:
             data = await asyncio.gather(*[Archiver.fetch_pv(session, pv, time_from, time_to, isOptimized, mean_minutes) for pv in pvs])
             return data
 
     @staticmethod
-    async def request_data(pvs: list, timespam: dict, aquisition_period_in_minutes: int) -> pd.DataFrame:
-        datetime_init = datetime(timespam['init']['year'], timespam['init']["month"], timespam['init']["day"], timespam['init']["hour"], timespam['init']["minute"], timespam['init']["second"]) + timedelta(hours=3)
-        datetime_end = datetime(timespam['end']['year'], timespam['end']["month"], timespam['end']["day"], timespam['end']["hour"], timespam['end']["minute"], timespam['end']["second"]) + timedelta(hours=3)
+    def timespam_to_datetimes(timespam: dict) -> tuple:
+        datetime_init = datetime(timespam['init']['year'], timespam['init']["month"], timespam['init']["day"], timespam['init']["hour"], timespam['init']["minute"], timespam['init']["second"])
+        datetime_end = datetime(timespam['end']['year'], timespam['end']["month"], timespam['end']["day"], timespam['end']["hour"], timespam['end']["minute"], timespam['end']["second"])
+        return datetime_init, datetime_end
+
+    @staticmethod
+    def datetimes_to_timespam(datetime_init: datetime, datetime_end: datetime) -> dict:
+        to_dict = lambda dt: {'day': dt.day, 'month': dt.month, 'year': dt.year, 'hour': dt.hour, 'minute': dt.minute, 'second': dt.second}
+        return {'init': to_dict(datetime_init), 'end': to_dict(datetime_end)}
+
+    @staticmethod
+    def is_settled(timespam: dict, margin_in_minutes: float = 0) -> bool:
+        """ whether the samples of the timespam (extended by margin_in_minutes) are all archived already, so that
+            requesting them again gives the same data """
+        datetime_end = Archiver.timespam_to_datetimes(timespam)[1] + timedelta(minutes=margin_in_minutes)
+        return datetime_end <= datetime.now() - timedelta(seconds=ARCHIVER_DELAY_IN_SECONDS)
+
+    @staticmethod
+    @PROFILER.instrument('archiver.fetch_json', lambda result, args, kwargs: {'pvs': len(args[0])})
+    async def fetch_json(pvs: list, timespam: dict, aquisition_period_in_minutes: int) -> list:
+        """ raw archiver responses of the pvs over the timespam (local time), to be decoded by decode_json """
+        datetime_init, datetime_end = Archiver.timespam_to_datetimes(timespam)
+        # converting local time to UTC
+        datetime_init += timedelta(hours=3)
+        datetime_end += timedelta(hours=3)
 
         dt_init_formatted = datetime_init.isoformat(timespec='milliseconds') + 'Z'
         dt_end_formatted = datetime_end.isoformat(timespec='milliseconds') + 'Z'
 
-        timespam = (dt_init_formatted, dt_end_formatted)
+        requested = await Archiver.get_status_cache().filter_pvs(pvs) if Archiver.check_pv_status else list(pvs)
+        responses = dict(zip(requested, await Archiver.fetch_multiple_pvs(requested, dt_init_formatted, dt_end_formatted, True,
+                                                                          aquisition_period_in_minutes)))
+        # pvs without archived data get an empty response, decoded as a missing column
+        return [responses.get(pv, [{'data': []}]) for pv in pvs]
 
+    @staticmethod
+    @PROFILER.instrument('archiver.request_data', lambda result, args, kwargs: {'pvs': len(args[0]), **count_frame(result)})
+    async def request_data(pvs: list, timespam: dict, aquisition_period_in_minutes: int) -> pd.DataFrame:
         print("fetching data...")
 
         try:
             # retrieving raw data from Archiver
-            json_data = await Archiver.fetch_multiple_pvs(pvs, timespam[0], timespam[1], True, aquisition_period_in_minutes)
-
-            # mapping pv's values
-            data = [np.array(list(map(lambda i: i['val'], serie))) for serie in map(lambda j: j[0]['data'], json_data)]
-            # mapping timestamps
-            # time_fmt = list(map(lambda data: datetime.fromtimestamp(data['secs']).strftime("%d.%m.%y %H:%M"), json_data[0][0]['data']))
-            time_fmt = list(map(lambda data: datetime.fromtimestamp(data['secs'])+timedelta(seconds=30), json_data[0][0]['data']))
-
-            # creating pandas dataframe object
-            d = {'datetime': time_fmt}
-            for l_data, name in zip(data, pvs):
-                d[name] = l_data if len(l_data) > 0 else np.repeat(0, len(d['datetime']))
-
-            data = pd.DataFrame(data=d)
-            # droping the last term to correct timestamp overflow problem
-            data.drop([data.index[-1]], inplace=True)
-            # indexing by datetime
-            data.reset_index(drop=True, inplace=True)
-            data = data.set_index('datetime')
+            json_data = await Archiver.fetch_json(pvs, timespam, aquisition_period_in_minutes)
+            data = Archiver.decode_json(json_data, pvs)
             print('data fetched!')
             return data
 
         except IndexError:
             print('Fetching data failed.')
             return
+
+    @staticmethod
+    def decode_json(json_data: list, pvs: list) -> pd.DataFrame:
+        """ converts the archiver responses of each pv to a DataFrame indexed by datetime; pvs without data
+            are left empty (NaN), and the frame has no rows when none has data """
+        series = [response[0]['data'] if response else [] for response in json_data]
+        if not any(series):
+            # e.g. every pv skipped by the status check, or an empty window
+            return pd.DataFrame(columns=pvs, index=pd.DatetimeIndex([], name='datetime'), dtype=float)
+        # mapping pv's values
+        data = [np.array(list(map(lambda i: i['val'], serie)), dtype=float) for serie in series]
+        # mapping timestamps of the first pv with data
+        # time_fmt = list(map(lambda data: datetime.fromtimestamp(data['secs']).strftime("%d.%m.%y %H:%M"), json_data[0][0]['data']))
+        time_fmt = list(map(lambda data: datetime.fromtimestamp(data['secs'])+timedelta(seconds=30), [serie for serie in series if serie][0]))
+
+        # creating pandas dataframe object
+        d = {'datetime': time_fmt}
+        for l_data, name in zip(data, pvs):
+            d[name] = l_data if len(l_data) > 0 else np.full(len(d['datetime']), np.nan)
+
+        data = pd.DataFrame(data=d)
+        # droping the last term to correct timestamp overflow problem
+        data.drop([data.index[-1]], inplace=True)
+        # indexing by datetime
+        data.reset_index(drop=True, inplace=True)
+        data = data.set_index('datetime')
+        return data
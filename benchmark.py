@@ -0,0 +1,284 @@
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from archiver import Archiver
+from temp import TemperatureDeformation, PVS
+from perimeter import Perimeter
+from utils import MathUtils
+from instrumentation import PROFILER
+from main import POINT_NAMES_TEMP, POINT_NAMES_TIDES, generate_node_temp_directions, generate_node_tides_directions
+
+# window lengths in days
+SIZES = {'day': 1, 'week': 7, 'month': 30, 'year': 365}
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+
+# modules of the computation path, which must import without the heavy dependencies below
+CORE_MODULES = ['main', 'archiver', 'temp', 'tides', 'perimeter', 'rf', 'utils', 'chunked']
+HEAVY_MODULES = ['matplotlib', 'scipy', 'aiohttp', 'geodesics']
+# import time allowed for each core module on top of numpy and pandas, in seconds
+IMPORT_TIME_BUDGET_S = 0.25
+
+
+class SyntheticDataset:
+    """ reproducible ring-scale data with 1 minute sampling: all concrete PVs mapped to the 40 nodes,
+        16 tide stations and RF, with daily cycles, slow drifts and noise """
+
+    def __init__(self, days: float, seed: int = 0) -> None:
+        self.days = days
+        self.seed = seed
+        self.index = pd.date_range(start=datetime(2021, 11, 1), periods=int(days*24*60), freq='min')
+        self.pvs = list(dict.fromkeys(pv for pvs in PVS['concrete']['all_sensors'].values() for pv in pvs))
+
+    def rng(self) -> np.random.Generator:
+        # a fresh generator per series, so every call returns the same data
+        return np.random.default_rng(self.seed)
+
+    def hours(self) -> np.ndarray:
+        return np.arange(len(self.index)) / 60
+
+    def raw_temperature(self) -> pd.DataFrame:
+        rng = self.rng()
+        t = self.hours()[:, None]
+        n_pvs = len(self.pvs)
+        phase = rng.uniform(0, 2*np.pi, n_pvs)
+        amplitude = rng.uniform(0.05, 0.3, n_pvs)
+        drift = rng.normal(0, 1e-3, n_pvs)
+        values = 22 + amplitude*np.sin(2*np.pi*t/24 + phase) + drift*t + rng.normal(0, 0.01, (len(t), n_pvs))
+        return pd.DataFrame(values, index=self.index, columns=self.pvs)
+
+    def tides(self) -> dict:
+        t = self.hours()
+        data = {}
+        for i, name in enumerate(POINT_NAMES_TIDES):
+            # semidiurnal and diurnal components, in meters
+            components = [amp*np.sin(2*np.pi*t/period + i/16*2*np.pi) for amp, period in [(0.02, 12.42), (0.05, 12.42), (0.15, 24.0)]]
+            data[name] = pd.DataFrame(np.stack(components, axis=1), index=self.index, columns=['North', 'East', 'Up'])
+        return data
+
+    def rf(self) -> np.ndarray:
+        t = self.hours()
+        return 200*np.sin(2*np.pi*t/24) + np.cumsum(self.rng().normal(0, 0.5, len(t)))
+
+    def archiver_json(self, n_pvs: int = 10) -> tuple:
+        """ responses in the format returned by the archiver for n_pvs pvs """
+        secs = (self.index.astype('int64') // 10**9).tolist()
+        pvs = self.pvs[:n_pvs]
+        values = self.raw_temperature().iloc[:, :n_pvs]
+        json_data = [[{'meta': {'name': pv}, 'data': [{'secs': s, 'val': v, 'nanos': 0, 'severity': 0, 'status': 0}
+                                                      for s, v in zip(secs, values[pv].tolist())]}] for pv in pvs]
+        return json_data, pvs
+
+    def temperature_deformation(self) -> TemperatureDeformation:
+        temperature = TemperatureDeformation('local', 'concrete', concrete_pvs_combination='all_sensors')
+        temperature.temp_data = self.raw_temperature()
+        temperature.temp_data = temperature.temp_data - temperature.temp_data.iloc[0,:]
+        return temperature
+
+
+# each benchmark receives the dataset and returns the callable to be measured; the setup is not timed
+
+def bench_treat_data(dataset: SyntheticDataset):
+    temperature = dataset.temperature_deformation()
+    return temperature.treat_data
+
+def bench_perimeter_temperature(dataset: SyntheticDataset):
+    temperature = dataset.temperature_deformation()
+    temperature.treat_data()
+    deformation = temperature.calculate_deformation()
+    perimeter = Perimeter(POINT_NAMES_TEMP, generate_node_temp_directions())
+    return lambda: perimeter.calculate_delta_perimeter('temperature', deformation)
+
+def bench_perimeter_tides(dataset: SyntheticDataset):
+    tides_data = dataset.tides()
+    perimeter = Perimeter(POINT_NAMES_TIDES, generate_node_tides_directions())
+    return lambda: perimeter.calculate_delta_perimeter('tides', tides_data)
+
+def bench_perimeter_combined(dataset: SyntheticDataset):
+    temperature = dataset.temperature_deformation()
+    temperature.treat_data()
+    deformation = temperature.calculate_deformation()
+    tides_data = dataset.tides()
+    perimeter = Perimeter(POINT_NAMES_TEMP, generate_node_temp_directions())
+    tides_directions = dict(zip(POINT_NAMES_TIDES, generate_node_tides_directions()))
+    return lambda: perimeter.calculate_combined_delta_perimeter(deformation, tides_data, tides_directions, tides_sign=-1)
+
+def bench_generate_tides(dataset: SyntheticDataset):
+    from tides import Tides
+    timespam = Archiver.datetimes_to_timespam(dataset.index[0].to_pydatetime(), dataset.index[-1].to_pydatetime())
+    tides = Tides(POINT_NAMES_TIDES, mapping_needed=True)
+    return lambda: tides.generate_tides(timespam)
+
+def bench_archiver_decoding(dataset: SyntheticDataset):
+    json_data, pvs = dataset.archiver_json()
+    return lambda: Archiver.decode_json(json_data, pvs)
+
+def bench_lowpass_filter(dataset: SyntheticDataset):
+    rf = dataset.rf()
+    return lambda: MathUtils.filter_timeserie(rf, 2)
+
+def bench_causal_filter(dataset: SyntheticDataset):
+    rf = dataset.rf()
+    return lambda: MathUtils.filter_timeserie_causal(rf, 2)
+
+def bench_fft(dataset: SyntheticDataset):
+    rf = dataset.rf()
+    return lambda: MathUtils.calculate_fft(rf, 60)
+
+def bench_rolling_regression(dataset: SyntheticDataset):
+    # 20 model variants against the RF, over windows of one day
+    rf = dataset.rf()
+    models = rf[:, None] * np.linspace(0.5, 1.5, 20) + np.random.default_rng(dataset.seed).normal(0, 10, (len(rf), 20))
+    return lambda: MathUtils.rolling_regression(models, rf, 1440)
+
+def bench_change_points(dataset: SyntheticDataset):
+    from changepoint import ChangePointDetector
+    rf = dataset.rf()
+    return lambda: ChangePointDetector().update(dataset.index, rf)
+
+
+BENCHMARKS = {
+    'temp.treat_data': bench_treat_data,
+    'perimeter.temperature': bench_perimeter_temperature,
+    'perimeter.tides': bench_perimeter_tides,
+    'perimeter.combined': bench_perimeter_combined,
+    'tides.generate_tides': bench_generate_tides,
+    'archiver.decode_json': bench_archiver_decoding,
+    'utils.filter_timeserie': bench_lowpass_filter,
+    'utils.filter_timeserie_causal': bench_causal_filter,
+    'utils.calculate_fft': bench_fft,
+    'utils.rolling_regression': bench_rolling_regression,
+    'changepoint.update': bench_change_points,
+}
+
+
+def measure_import_time(module: str, repeats: int = 5) -> dict:
+    """ best import time of a module in a fresh interpreter, discounting numpy and pandas,
+        and the heavy dependencies it pulled in """
+    script = ('import time, sys, numpy, pandas; t = time.perf_counter(); import {}; '
+              'print(time.perf_counter() - t); print(",".join(m for m in {} if m in sys.modules))').format(module, HEAVY_MODULES)
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split('\n')
+        times.append(float(output[0]))
+    heavy_loaded = [m for m in output[1].split(',') if m]
+    return {'import_time_s': min(times), 'heavy_modules': heavy_loaded,
+            'within_budget': min(times) <= IMPORT_TIME_BUDGET_S and not heavy_loaded}
+
+
+def check_import_budget(modules: list = CORE_MODULES) -> dict:
+    results = {}
+    for module in modules:
+        results[module] = measure_import_time(module)
+        status = 'ok' if results[module]['within_budget'] else 'OVER BUDGET'
+        heavy = ', '.join(results[module]['heavy_modules']) or '-'
+        print(f"import {module}: {results[module]['import_time_s']:.3f} s (heavy: {heavy}) {status}")
+    return results
+
+
+def get_environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': sys.version.split()[0], 'numpy': np.__version__, 'pandas': pd.__version__,
+            'platform': platform.platform(), 'date': datetime.now().isoformat(timespec='seconds')}
+
+
+def measure(setup, dataset: SyntheticDataset, repeats: int) -> dict:
+    # timing without tracemalloc, as it slows allocations down
+    wall_times, cpu_times = [], []
+    for _ in range(repeats):
+        func = setup(dataset)
+        gc.collect()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        func()
+        wall_times.append(time.perf_counter() - wall_start)
+        cpu_times.append(time.process_time() - cpu_start)
+
+    # peak memory in a separate run
+    func = setup(dataset)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'wall_time_s': min(wall_times), 'wall_time_median_s': float(np.median(wall_times)),
+            'cpu_time_s': min(cpu_times), 'peak_memory_mb': peak/1e6, 'records': len(dataset.index)}
+
+
+def run_benchmarks(sizes: list, repeats: int = 3, selected: list = None, seed: int = 0) -> dict:
+    # the benchmark takes its own measurements
+    PROFILER.enabled = False
+    results = {'environment': get_environment(), 'results': {}}
+    for size in sizes:
+        dataset = SyntheticDataset(SIZES[size], seed=seed)
+        for name, setup in BENCHMARKS.items():
+            if selected and name not in selected:
+                continue
+            try:
+                result = measure(setup, dataset, repeats)
+            except ImportError as e:
+                # e.g. the geodesics extension is not available
+                print(f'{name} [{size}]: skipped ({e})')
+                continue
+            except Exception as e:
+                # a broken benchmark is reported without stopping the others
+                print(f'{name} [{size}]: failed ({type(e).__name__}: {e})')
+                results.setdefault('failed', {})[f'{name}[{size}]'] = f'{type(e).__name__}: {e}'
+                continue
+            results['results'][f'{name}[{size}]'] = result
+            print(f"{name} [{size}]: {result['wall_time_s']:.4f} s, {result['peak_memory_mb']:.1f} MB")
+    PROFILER.enabled = True
+    return results
+
+
+def save_results(results: dict, label: str, output_dir: str = RESULTS_DIR) -> str:
+    os.makedirs(output_dir, exist_ok=True)
+    filepath = os.path.join(output_dir, f'{label}.json')
+    with open(filepath, 'w') as f:
+        json.dump(results, f, indent=2)
+    return filepath
+
+
+def compare_results(baseline_file: str, results: dict) -> None:
+    with open(baseline_file) as f:
+        baseline = json.load(f)['results']
+    print(f"{'benchmark':<45}{'baseline [s]':>14}{'current [s]':>14}{'ratio':>8}{'memory ratio':>14}")
+    for name, current in results['results'].items():
+        if name not in baseline:
+            continue
+        ratio = current['wall_time_s'] / baseline[name]['wall_time_s']
+        memory_ratio = current['peak_memory_mb'] / baseline[name]['peak_memory_mb'] if baseline[name]['peak_memory_mb'] else float('nan')
+        print(f"{name:<45}{baseline[name]['wall_time_s']:>14.4f}{current['wall_time_s']:>14.4f}{ratio:>8.2f}{memory_ratio:>14.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='offline benchmarks with synthetic ring-scale data')
+    parser.add_argument('--sizes', nargs='+', default=['day', 'week'], choices=list(SIZES))
+    parser.add_argument('--benchmarks', nargs='+', default=None, choices=list(BENCHMARKS))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--label', default=datetime.now().strftime('%Y%m%d_%H%M%S'))
+    parser.add_argument('--compare', default=None, help='results file of a previous run')
+    parser.add_argument('--skip-imports', action='store_true', help='do not check the import time budget')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeats, args.benchmarks)
+    if not args.skip_imports:
+        results['imports'] = check_import_budget()
+    print(f'results saved to {save_results(results, args.label)}')
+    if args.compare:
+        compare_results(args.compare, results)
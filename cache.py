@@ -0,0 +1,77 @@
+import os
+import json
+import pickle
+import hashlib
+from datetime import datetime
+from types import ModuleType
+from typing import Any, Callable, Dict
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+
+
+class StageCache:
+    """ on-disk memoization of pipeline stages; each stage result is stored under a
+        hash of its inputs (timespam, pvs, parameters, upstream keys and code version).
+        Stages whose data may still change (e.g. archiver windows reaching the present) and the stages
+        depending on them are neither loaded nor stored, their keys including the time they ran at """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, enabled: bool = True) -> None:
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        # keys of the last executed stages, so downstream stages can depend on them
+        self.keys = {}
+        # keys of the stages that were not cached because their data may still change
+        self.unsettled = set()
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def code_version(*modules: ModuleType) -> str:
+        """ hash of the source files of the modules that implement a stage """
+        digest = hashlib.sha256()
+        for module in modules:
+            with open(module.__file__, 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    @staticmethod
+    def make_key(stage: str, inputs: Dict) -> str:
+        serialized = json.dumps({'stage': stage, 'inputs': inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def get_path(self, stage: str, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{stage}_{key[:16]}.pkl')
+
+    def run(self, stage: str, inputs: Dict, func: Callable, *args, settled: bool = True, **kwargs) -> Any:
+        """ returns the cached output of 'stage' for the given inputs, calling func only on a miss;
+            with settled False, or an unsettled upstream key, func is always called and its output not stored """
+        settled = settled and not self.unsettled.intersection(inputs.get('upstream') or [])
+        if not settled:
+            inputs = {**inputs, 'run_at': datetime.now().isoformat()}
+        key = StageCache.make_key(stage, inputs)
+        self.keys[stage] = key
+
+        if not self.enabled or not settled:
+            if not settled:
+                self.unsettled.add(key)
+            return func(*args, **kwargs)
+
+        path = self.get_path(stage, key)
+        if os.path.exists(path):
+            print(f'{stage}: loaded from cache')
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+
+        result = func(*args, **kwargs)
+
+        # writing to a temporary file first, so a killed run never leaves a truncated entry
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return result
+
+    def clear(self) -> None:
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.pkl'):
+                os.remove(os.path.join(self.cache_dir, filename))
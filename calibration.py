@@ -0,0 +1,157 @@
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+from instrumentation import PROFILER
+from perimeter import Perimeter
+from temp import THERMAL_COEFFICIENT
+from timeseries import TimeSeriesArray
+
+
+class ModelCalibration:
+    """ least squares fit of the perimeter model to the RF frequency:
+
+            rf[t] = offset - (sum_s alpha_s/alpha * P_s[t + lag] + tides_scale * P_tides[t + lag]) / microns_per_hz
+
+        where P_s is the perimeter evolution, in microns, caused by the thermal deformation of sector s computed
+        with the nominal coefficient alpha and P_tides the one caused by the tides. The columns P are computed once
+        (design matrix), so scanning lags only needs a small linear system per lag """
+
+    def __init__(self, point_names: List, directions: List, temp_deformation: pd.DataFrame or TimeSeriesArray, tides_deformation: Dict or TimeSeriesArray = None,
+                 tides_directions: Dict = None, tides_sign: float = 1, sectors: Dict = None, alpha: float = THERMAL_COEFFICIENT) -> None:
+        """ temp_deformation must have been calculated with the coefficient alpha; sectors maps a sector name to
+            its nodes, a single 'global' sector is used if not given. Sectors without any node with data (e.g.
+            left out by the pv combination or by the quality checks) are not fitted """
+        if isinstance(temp_deformation, TimeSeriesArray):
+            temp_deformation = temp_deformation.to_wide()
+        self.alpha = alpha
+        self.index = temp_deformation.index
+        sectors = sectors if sectors is not None else {'global': list(point_names)}
+        with_data = set(temp_deformation.columns[temp_deformation.notna().any(axis=0)])
+        self.sectors = {sector: nodes for sector, nodes in sectors.items() if with_data.intersection(nodes)}
+        if not self.sectors:
+            raise ValueError('no sector has temperature data')
+        self.columns, self.design_matrix = ModelCalibration.build_design_matrix(point_names, directions, temp_deformation, self.sectors,
+                                                                                tides_deformation, tides_directions, tides_sign)
+
+    @staticmethod
+    def generate_quadrant_sectors(point_names: List) -> Dict:
+        """ groups QxPy nodes by quadrant """
+        sectors = {}
+        for point in point_names:
+            sectors.setdefault(point[:2], []).append(point)
+        return sectors
+
+    @staticmethod
+    @PROFILER.instrument('calibration.build_design_matrix', lambda result, args, kwargs: {'rows': result[1].shape[0], 'columns': result[1].shape[1]})
+    def build_design_matrix(point_names: List, directions: List, temp_deformation: pd.DataFrame, sectors: Dict,
+                            tides_deformation: Dict or TimeSeriesArray = None, tides_directions: Dict = None, tides_sign: float = 1) -> tuple:
+        """ one column per sector plus one for the tides, each being the perimeter evolution in microns
+            caused by that part of the deformation alone """
+        perimeter = Perimeter(point_names, directions)
+        columns, matrix = [], []
+        for sector, nodes in sectors.items():
+            sector_nodes = [node for node in nodes if node in temp_deformation.columns]
+            columns.append(sector)
+            matrix.append(perimeter.calculate_combined_delta_perimeter(temp_deformation[sector_nodes]).values * 1e6)
+        if tides_deformation is not None:
+            # no thermal deformation, but the tides aligned to the temperature records
+            columns.append('tides')
+            matrix.append(perimeter.calculate_combined_delta_perimeter(temp_deformation[[]], tides_deformation, tides_directions, tides_sign).values * 1e6)
+
+        matrix = np.column_stack(matrix)
+        # interpolating gaps so that every record can be used in the fit
+        matrix = pd.DataFrame(matrix).interpolate(limit_direction='both').values
+        return columns, matrix
+
+    @staticmethod
+    def scan_lags(design_matrix: np.ndarray, target: np.ndarray, lags: List) -> tuple:
+        """ ordinary least squares of target[t] against [1, design_matrix[t + lag]] for every lag, over the same
+            records target[0:n], n = len(target) - max(lags). The normal equations of all lags come from cumulative
+            sums of the outer products of the rows, so each lag costs one small solve.
+            Returns coefficients (lag x (1 + columns)), offset first, and the residual rms of each lag """
+        lags = np.asarray(lags)
+        n = len(target) - lags.max()
+        if n <= design_matrix.shape[1]:
+            raise ValueError('not enough records for the requested lags')
+
+        regressors = np.column_stack((np.ones(len(design_matrix)), design_matrix))
+        target = target[:n]
+
+        # gram matrices of every window regressors[lag:lag + n]
+        outer = np.einsum('ti,tj->tij', regressors, regressors)
+        cumulative = np.concatenate((np.zeros((1,) + outer.shape[1:]), np.cumsum(outer, axis=0)))
+        gram = cumulative[lags + n] - cumulative[lags]
+        moments = np.stack([regressors[lag:lag + n].T @ target for lag in lags])
+
+        # pseudo-inverse, so that a column without effect (e.g. a sector deforming like another) does not
+        # make the system singular
+        coefficients = (np.linalg.pinv(gram) @ moments[:, :, None])[:, :, 0]
+        # residual sum of squares from the normal equations: y.y - 2 b.m + b.G.b = y.y - b.m
+        residual = target @ target - np.einsum('li,li->l', coefficients, moments)
+        rms = np.sqrt(np.maximum(residual, 0) / n)
+        return coefficients, rms
+
+    @PROFILER.instrument('calibration.fit', lambda result, args, kwargs: {'rows': len(args[0].index), 'columns': len(args[0].columns)})
+    def fit(self, rf_data: pd.Series, lags: List = range(0, 361, 5), microns_per_hz: float = None) -> Dict:
+        """ fits the model to rf_data over the lags given in records. With microns_per_hz given, the thermal
+            coefficients and the tides scale are fitted; otherwise the conversion factor is fitted as well, with
+            the thermal coefficients normalized so that their mean is the nominal one """
+        target = rf_data.reindex(self.index, method='nearest').interpolate(limit_direction='both').values
+        coefficients, rms = ModelCalibration.scan_lags(self.design_matrix, target, lags)
+        best = int(np.argmin(rms))
+
+        offset, gains = coefficients[best, 0], coefficients[best, 1:]
+        thermal_gains = gains[:len(self.sectors)]
+        if microns_per_hz is None:
+            microns_per_hz = -1 / np.mean(thermal_gains)
+        # rf = offset - (scale * P) / microns_per_hz  ->  scale = -gain * microns_per_hz
+        scales = -gains * microns_per_hz
+
+        results = {'lag': int(np.asarray(lags)[best]), 'microns_per_hz': float(microns_per_hz), 'offset': float(offset), 'rms': float(rms[best]),
+                   'alpha': {sector: float(scales[i] * self.alpha) for i, sector in enumerate(self.sectors)},
+                   'tides_scale': float(scales[-1]) if 'tides' in self.columns else None,
+                   'lag_scan': pd.Series(rms, index=np.asarray(lags), name='rms')}
+        return results
+
+    def predict(self, results: Dict) -> np.ndarray:
+        """ model frequency for the fitted parameters, aligned as rf[t] <- model[t + lag] (NaN at the end) """
+        scales = [results['alpha'][sector] / self.alpha for sector in self.sectors]
+        if 'tides' in self.columns:
+            scales.append(results['tides_scale'])
+        model = results['offset'] - self.design_matrix @ np.array(scales) / results['microns_per_hz']
+        shifted = np.full(len(model), np.nan)
+        shifted[:len(model) - results['lag']] = model[results['lag']:]
+        return shifted
+
+
+if __name__ == "__main__":
+    from main import (POINT_NAMES_TEMP, POINT_NAMES_TIDES, TIDES_SIGN, create_temperature_deformation_data, create_tides_data,
+                      load_rf_data, generate_node_temp_directions, generate_node_tides_directions)
+    from temp import TemperatureDeformation
+
+    # user definitions
+    per_sector = True
+    use_tides = True
+
+    temp_options = {
+        'data_source': 'archiver',
+        'which_temp': 'concrete',
+        'combination_params': ['A', 'N']
+    }
+
+    timespam = {
+        'init': {'day': 1,'month': 9, 'year': 2021,'hour': 0,'minute': 0,'second': 0},
+        'end': {'day': 1,'month': 12, 'year': 2021,'hour': 0,'minute': 0,'second': 0}
+    }
+
+    temp_data = create_temperature_deformation_data(TemperatureDeformation(timespam=timespam, **temp_options))
+    tides_data = create_tides_data(POINT_NAMES_TIDES, timespam) if use_tides else None
+    sectors = ModelCalibration.generate_quadrant_sectors(POINT_NAMES_TEMP) if per_sector else None
+
+    calibration = ModelCalibration(POINT_NAMES_TEMP, generate_node_temp_directions(), temp_data, tides_data,
+                                   dict(zip(POINT_NAMES_TIDES, generate_node_tides_directions())), TIDES_SIGN, sectors)
+    results = calibration.fit(load_rf_data(timespam).iloc[:,0])
+    print(f"lag: {results['lag']} records, conversion: {results['microns_per_hz']:.3f} um/Hz, tides scale: {results['tides_scale']}, rms: {results['rms']:.3f} Hz")
+    for sector, alpha in results['alpha'].items():
+        print(f'alpha {sector}: {alpha:.3e} 1/K')
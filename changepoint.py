@@ -0,0 +1,248 @@
+import numpy as np
+import pandas as pd
+
+from instrumentation import PROFILER
+
+# scipy is imported by the methods that use it, keeping this module light to import
+
+# the mean absolute deviation of gaussian noise times this factor is its standard deviation
+MAD_TO_STD = np.sqrt(np.pi/2)
+EVENT_COLUMNS = ['datetime', 'kind', 'onset', 'magnitude', 'score']
+# upward and downward shifts, each with its own cumulative sum
+DIRECTIONS = (1, -1)
+
+
+class ChangePointDetector:
+    """ two-sided CUSUM on a residual (e.g. the well contribution, in Hz) against a slowly moving baseline. The
+        level is an exponential moving average over about baseline_records and the deviations from it are
+        prewhitened with their lag-1 correlation, so that a slowly wandering (autocorrelated) residual gives
+        independent scores. The correlation and the noise scale are moving averages over about noise_records, long
+        enough for a change of level to barely move them; the scale comes from the absolute first differences,
+        which a change only touches at one sample and a spike at two, corrected for its start at zero.
+        A 'change' event is emitted when the cumulated score beyond drift exceeds threshold, with the shift of
+        the mean since the excursion started (onset) as magnitude. The level is then estimated again from the
+        samples after the change, which only set the baseline for the next warmup_records, as the first ones do.
+        Samples beyond spike_threshold are 'spike' events and are clipped in the sums, so a single spike does not
+        make a change. The state is a few numbers: update_sample consumes the residual sample by sample and update
+        processes whole blocks (e.g. archived months) vectorized, giving the same events """
+
+    def __init__(self, threshold: float = 10, drift: float = 0.5, spike_threshold: float = 6, baseline_records: int = 1440,
+                 warmup_records: int = 180, noise_records: int = 10080, max_correlation: float = 0.995, min_std: float = 1e-3) -> None:
+        """ threshold, drift and spike_threshold in standard deviations of the prewhitened residual, min_std in its
+            unit; the first warmup_records samples, and those after each change, only set the baseline. The
+            correlation is bounded by max_correlation, as a residual closer to a random walk has no level to return to """
+        self.threshold = threshold
+        self.drift = drift
+        self.spike_threshold = spike_threshold
+        self.alpha = 2/(baseline_records + 1)
+        self.noise_alpha = 2/(noise_records + 1)
+        self.warmup_records = warmup_records
+        self.max_correlation = max_correlation
+        self.min_std = min_std
+        self.reset()
+
+    def reset(self) -> None:
+        # last sample, moving averages of the lag-1 products and squares of the deviations and of the absolute
+        # differences, and their number of updates
+        self.value = None
+        self.product, self.square, self.deviation = 0.0, 0.0, 0.0
+        self.updates = 0
+        self.restart_level()
+
+    def restart_level(self) -> None:
+        # moving sum of the samples since the (re)start of the level, their number and the last deviation from it
+        self.level_sum, self.records, self.error = 0.0, 0, 0.0
+        self.clear_runs()
+
+    def clear_runs(self) -> None:
+        # one entry per direction: cumulative sum, length and sum of the samples of the excursion, its start
+        # and the level before it
+        self.cusum = np.zeros(len(DIRECTIONS))
+        self.run_length = np.zeros(len(DIRECTIONS), dtype=int)
+        self.run_sum = np.zeros(len(DIRECTIONS))
+        self.onset = [None]*len(DIRECTIONS)
+        self.onset_level = np.zeros(len(DIRECTIONS))
+
+    def make_change(self, timestamp, i: int) -> dict:
+        """ change event of direction i, restarting the level with the next samples """
+        event = {'datetime': timestamp, 'kind': 'change', 'onset': self.onset[i],
+                 'magnitude': self.run_sum[i]/self.run_length[i] - self.onset_level[i], 'score': DIRECTIONS[i]*self.cusum[i]}
+        self.restart_level()
+        return event
+
+    def get_level(self, level_sum, records):
+        """ moving average from its sum after a number of samples, corrected for its start at zero """
+        return level_sum/(1 - (1 - self.alpha)**np.maximum(records, 1))
+
+    def get_correlation(self, product, square):
+        """ lag-1 correlation of the deviations from the moving sums, within [0, max_correlation] """
+        return np.clip(product/np.maximum(square, np.finfo(float).tiny), 0, self.max_correlation)
+
+    def get_scale(self, deviation, updates, correlation):
+        """ standard deviation of the prewhitened residual from the moving absolute difference after a number of
+            updates: for a first order autoregression, the variance of the differences is 2/(1 + correlation) times
+            the prewhitened one """
+        difference_std = MAD_TO_STD*deviation/(1 - (1 - self.noise_alpha)**np.maximum(updates, 1))
+        return np.maximum(difference_std*np.sqrt((1 + correlation)/2), self.min_std)
+
+    def update_sample(self, timestamp, value: float) -> list:
+        """ events (spike and/or change) raised by one sample; missing (NaN) samples are skipped """
+        events = []
+        if np.isnan(value):
+            return events
+
+        difference = value - (value if self.value is None else self.value)
+        correlation = self.get_correlation(self.product, self.square)
+        scale = self.get_scale(self.deviation, self.updates, correlation)
+        # the first sample of the level (at the start or after a change) defines it
+        previous_level = value if self.records == 0 else self.get_level(self.level_sum, self.records)
+        error = value - previous_level
+        score = (error - correlation*self.error)/scale
+
+        self.product += self.noise_alpha*(error*self.error - self.product)
+        self.square += self.noise_alpha*(self.error**2 - self.square)
+        self.deviation += self.noise_alpha*(abs(difference) - self.deviation)
+        self.level_sum += self.alpha*(value - self.level_sum)
+        self.value, self.error = value, error
+        self.records += 1
+        self.updates += 1
+        if self.records <= self.warmup_records:
+            return events
+
+        if abs(score) > self.spike_threshold:
+            events.append({'datetime': timestamp, 'kind': 'spike', 'onset': timestamp, 'magnitude': error, 'score': score})
+        score = min(max(score, -self.spike_threshold), self.spike_threshold)
+
+        for i, direction in enumerate(DIRECTIONS):
+            self.cusum[i] = max(0.0, self.cusum[i] + direction*score - self.drift)
+            if self.cusum[i] == 0:
+                self.run_length[i], self.run_sum[i] = 0, 0.0
+                continue
+            if self.run_length[i] == 0:
+                self.onset[i], self.onset_level[i] = timestamp, previous_level
+            self.run_length[i] += 1
+            self.run_sum[i] += value
+
+        for i in range(len(DIRECTIONS)):
+            if self.cusum[i] > self.threshold:
+                events.append(self.make_change(timestamp, i))
+                break
+        return events
+
+    def track_baseline(self, values: np.ndarray) -> tuple:
+        """ level before each sample of a block, deviations from it and their scores, from the current state,
+            and the state after each sample (see keep_state) """
+        from scipy.signal import lfilter
+
+        moving_sum = lambda x, start, alpha=self.alpha: lfilter([alpha], [1, alpha - 1], x, zi=[(1 - alpha)*start])[0]
+        previous = lambda x, start: np.concatenate(([start], x[:-1]))
+        updates = np.arange(len(values))
+
+        level_sums = moving_sum(values, self.level_sum)
+        previous_levels = self.get_level(previous(level_sums, self.level_sum), self.records + updates)
+        if self.records == 0:
+            previous_levels[0] = values[0]
+        errors = values - previous_levels
+        previous_errors = previous(errors, self.error)
+
+        products = moving_sum(errors*previous_errors, self.product, self.noise_alpha)
+        squares = moving_sum(previous_errors**2, self.square, self.noise_alpha)
+        differences = values - previous(values, values[0] if self.value is None else self.value)
+        deviations = moving_sum(np.abs(differences), self.deviation, self.noise_alpha)
+        correlations = self.get_correlation(previous(products, self.product), previous(squares, self.square))
+        scales = self.get_scale(previous(deviations, self.deviation), self.updates + updates, correlations)
+        scores = (errors - correlations*previous_errors)/scales
+        return previous_levels, errors, scores, (values, products, squares, deviations, level_sums, errors)
+
+    def keep_state(self, states: tuple, position: int) -> None:
+        """ state after the sample at position of a block given to track_baseline """
+        self.value, self.product, self.square, self.deviation, self.level_sum, self.error = (state[position] for state in states)
+        self.records += position + 1
+        self.updates += position + 1
+
+    def process_block(self, index: np.ndarray, values: np.ndarray, events: list) -> int:
+        """ events of a block of valid samples (after the warmup), up to its first change: returns the number of
+            samples consumed, the state being that after the last of them """
+        previous_levels, errors, scores, states = self.track_baseline(values)
+        clipped = np.clip(scores, -self.spike_threshold, self.spike_threshold)
+        positions = np.arange(len(values))
+        sums = np.cumsum(values)
+
+        # cumulative sums with the reset at zero in closed form (Lindley): S_t = C_t - min(min C_s, -S_0)
+        cusums, last_zeros = [], []
+        for i, direction in enumerate(DIRECTIONS):
+            steps = np.cumsum(direction*clipped - self.drift)
+            cusum = steps - np.minimum(np.minimum.accumulate(steps), -self.cusum[i])
+            cusums.append(cusum)
+            # last sample at which the sum was back at zero (-1 if none in this block)
+            last_zeros.append(np.maximum.accumulate(np.where(cusum <= 0, positions, -1)))
+
+        crossings = [np.flatnonzero(cusum > self.threshold) for cusum in cusums]
+        firsts = [crossing[0] if len(crossing) else len(values) for crossing in crossings]
+        last = min(min(firsts), len(values) - 1)
+
+        for position in np.flatnonzero(np.abs(scores[:last+1]) > self.spike_threshold):
+            events.append({'datetime': pd.Timestamp(index[position]), 'kind': 'spike', 'onset': pd.Timestamp(index[position]),
+                           'magnitude': errors[position], 'score': scores[position]})
+
+        # excursion state of each direction at the last sample consumed
+        for i in range(len(DIRECTIONS)):
+            self.cusum[i] = max(cusums[i][last], 0.0)
+            last_zero = last_zeros[i][last]
+            if last_zero == last:
+                self.run_length[i], self.run_sum[i] = 0, 0.0
+            elif last_zero >= 0:
+                self.run_length[i], self.run_sum[i] = last - last_zero, sums[last] - sums[last_zero]
+                self.onset[i], self.onset_level[i] = pd.Timestamp(index[last_zero + 1]), previous_levels[last_zero + 1]
+            else:
+                if self.run_length[i] == 0:
+                    self.onset[i], self.onset_level[i] = pd.Timestamp(index[0]), previous_levels[0]
+                self.run_length[i] += last + 1
+                self.run_sum[i] += sums[last]
+
+        self.keep_state(states, last)
+        if firsts.count(last):
+            events.append(self.make_change(pd.Timestamp(index[last]), firsts.index(last)))
+        return last + 1
+
+    @PROFILER.instrument('changepoint.update', lambda result, args, kwargs: {'records': len(args[1]), 'events': len(result)})
+    def update(self, index, values, block_records: int = 1440) -> pd.DataFrame:
+        """ events of consecutive samples, as update_sample would give them one by one, evaluated in blocks of
+            up to block_records: the samples of a block after a change are evaluated again, so the blocks shrink
+            to about twice the distance between changes while these are frequent """
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        # plain datetime64 array, much cheaper to slice than the index
+        index, values = pd.DatetimeIndex(index).values[valid], values[valid]
+        events = []
+
+        start, length = 0, block_records
+        while start < len(values):
+            # samples only setting the baseline, at the start or after a change
+            warmup = min(max(self.warmup_records - self.records, 0), len(values) - start)
+            if warmup:
+                self.keep_state(self.track_baseline(values[start:start+warmup])[3], warmup - 1)
+                start += warmup
+            if start < len(values):
+                consumed = self.process_block(index[start:start+length], values[start:start+length], events)
+                start += consumed
+                length = min(max(2*consumed, 16), block_records)
+
+        return pd.DataFrame(events, columns=EVENT_COLUMNS).set_index('datetime')
+
+
+if __name__ == "__main__":
+    from store import ResultsStore
+
+    # user definitions
+    store_dir = 'results_store'
+    start, end = pd.Timestamp(2021, 9, 1), pd.Timestamp(2021, 12, 1)
+
+    # archived well contribution, month by month, through the same detector
+    store = ResultsStore(store_dir)
+    detector = ChangePointDetector()
+    months = pd.date_range(start, end, freq='MS')
+    for month_start, month_end in zip(months[:-1], months[1:]):
+        results = store.read('raw', month_start, month_end - pd.Timedelta(seconds=1))
+        if len(results):
+            print(detector.update(results.index, results['well_contrib']))
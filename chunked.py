@@ -0,0 +1,110 @@
+import os
+from datetime import timedelta
+
+import pandas as pd
+
+from archiver import Archiver
+from tides import Tides
+from rf import RF
+from utils import MathUtils
+from store import ResultsStore
+from changepoint import ChangePointDetector
+from main import POINT_NAMES_TIDES, WellContributionStream, create_temperature, create_temperature_deformation_data, calculate_delta_perimeter, get_node_temp_directions
+
+
+def generate_chunks(timespam: dict, chunk_days: float) -> list:
+    """ splits the timespam in consecutive [init, end) blocks of chunk_days, rounded to whole minutes
+        so that block boundaries coincide with the 1 minute acquisition bins """
+    datetime_init, datetime_end = Archiver.timespam_to_datetimes(timespam)
+    chunk_length = timedelta(minutes=max(1, round(chunk_days*24*60)))
+    chunks = []
+    chunk_init = datetime_init
+    while chunk_init < datetime_end:
+        chunk_end = min(chunk_init + chunk_length, datetime_end)
+        chunks.append((chunk_init, chunk_end))
+        chunk_init = chunk_end
+    return chunks
+
+
+def main_chunked(temp_options: dict, use_tides: bool, timespam: dict, chunk_days: float = 7,
+                 output_file: str = 'chunked_output.csv', filter_min_period: float = None, store_dir: str = None,
+                 events_file: str = None) -> str:
+    """ same processing as main(), but streaming the timespam in blocks of chunk_days through loading,
+        deformation, perimeter and residual; only the current block is kept in memory and its results
+        are appended to output_file. The first-sample references, the pending shifted samples and the
+        optional RF low-pass filter state are carried between blocks, so the output matches a single pass.
+        The events of the well contribution (see ChangePointDetector) are appended to events_file, if given """
+    for filename in [output_file, events_file]:
+        if filename and os.path.exists(filename):
+            os.remove(filename)
+
+    # instances reused for every block: they keep the references taken from the first one
+    temperature = create_temperature(temp_options, timespam, get_node_temp_directions())
+    tides = Tides(POINT_NAMES_TIDES, mapping_needed=True)
+    residual = WellContributionStream()
+    detector = ChangePointDetector()
+    store = ResultsStore(store_dir) if store_dir else None
+    rf_reference = None
+    filter_state = None
+
+    chunks = generate_chunks(timespam, chunk_days)
+    for i, (chunk_init, chunk_end) in enumerate(chunks):
+        print(f'processing block {i+1}/{len(chunks)}: {chunk_init} - {chunk_end}')
+        chunk_timespam = Archiver.datetimes_to_timespam(chunk_init, chunk_end)
+
+        # temperature deformation
+        temperature.timespam = chunk_timespam
+        temp_data = create_temperature_deformation_data(temperature)
+
+        # tides, generated up to the end of the block: the temperature records lie between two tide samples
+        # (at 30 s), so both neighbours are needed for the nearest one to match a single pass
+        tides_data = None
+        if use_tides:
+            tides.generate_tides(Archiver.datetimes_to_timespam(chunk_init, chunk_end))
+            tides_data = tides.get_array().select(POINT_NAMES_TIDES)
+
+        # combined perimeter evolution, in microns, aligned to the temperature records
+        delta_perimeter = calculate_delta_perimeter(temp_data, tides_data)
+
+        # RF data, referenced to the first sample of the whole timespam
+        rf = RF('archiver', chunk_timespam, reference=rf_reference)
+        rf_reference = rf.reference
+        rf_data = rf.get_data().iloc[:,0].reindex(temp_data.index, method='nearest').values
+        if filter_min_period:
+            rf_data, filter_state = MathUtils.filter_timeserie_causal(rf_data, filter_min_period, filter_state)
+
+        results = residual.update(temp_data.index, rf_data, delta_perimeter)
+        results.to_csv(output_file, mode='a', header=(i == 0))
+        if store is not None:
+            store.append(results)
+        if events_file:
+            write_events(detector.update(results.index, results['well_contrib']), events_file)
+
+    return output_file
+
+
+def write_events(events: pd.DataFrame, events_file: str) -> None:
+    if len(events):
+        events.to_csv(events_file, mode='a', header=not os.path.exists(events_file))
+
+
+def load_chunked_results(output_file: str = 'chunked_output.csv') -> pd.DataFrame:
+    return pd.read_csv(output_file, index_col='datetime', parse_dates=True)
+
+
+if __name__ == "__main__":
+    # user definitions
+    use_tides = True
+
+    temp_options = {
+        'data_source': 'archiver',
+        'which_temp': 'concrete',
+        'combination_params': ['A', 'N']
+    }
+
+    timespam = {
+        'init': {'day': 1,'month': 9, 'year': 2021,'hour': 0,'minute': 0,'second': 0},
+        'end': {'day': 1,'month': 12, 'year': 2021,'hour': 0,'minute': 0,'second': 0}
+    }
+
+    main_chunked(temp_options, use_tides, timespam, chunk_days=7)
@@ -0,0 +1,158 @@
+import os
+from typing import Dict, List
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+
+from instrumentation import PROFILER
+from perimeter import Perimeter
+from temp import THERMAL_COEFFICIENT
+
+
+class TemperatureEnsemble:
+    """ Monte Carlo propagation of the temperature sensor uncertainty through the thermal deformation and the
+        perimeter: every member gets its own sensor noise (per sample, the first sample included, as it is the
+        reference the variations are taken from) and node positions (constant in time). A constant sensor offset
+        cancels in the variation, so it is not simulated. The records are split in time blocks processed by a
+        pool of workers, each one simulating (ensemble x block x node) arrays sized to max_memory_mb and
+        returning only the statistics of each record over the ensemble """
+
+    # constants of the whole ensemble, set once in each worker process
+    worker_constants: Dict = {}
+
+    def __init__(self, point_names: List, directions: List, temp_data: pd.DataFrame, n_members: int = 1000,
+                 noise_std: float = 0.05, position_std: float = 0.05, alpha: float = THERMAL_COEFFICIENT, seed: int = 0) -> None:
+        """ temp_data holds the temperature variation of each node, as given by TemperatureDeformation.temp_data;
+            noise_std is in degrees Celsius and position_std is in meters (East and North) """
+        self.point_names = point_names
+        self.perimeter = Perimeter(point_names, directions)
+        self.index = temp_data.index
+        self.n_members = n_members
+        self.noise_std = noise_std
+        self.alpha = alpha
+        self.seed = seed
+
+        # temperature variation of each node, nodes without data are not deformed
+        self.temperature = np.zeros((len(temp_data), len(point_names)))
+        self.has_data = np.array([point in temp_data.columns for point in point_names])
+        self.temperature[:, self.has_data] = temp_data[[point for point in point_names if point in temp_data.columns]].values
+
+        # errors constant in time, drawn once for the whole timespam: the noise of the reference sample, subtracted
+        # from every record by the referencing, and the node positions
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(0,)))
+        self.reference_noise = rng.normal(0, noise_std, (n_members, len(point_names))) * self.has_data
+        initial_coordinates = np.array([self.perimeter.initial_coordinates[point] for point in point_names])
+        self.initial_coordinates = np.repeat(initial_coordinates[None, :, :], n_members, axis=0)
+        self.initial_coordinates[:, :, :2] += rng.normal(0, position_std, (n_members, len(point_names), 2))
+
+    @staticmethod
+    def attach_worker(constants: Dict) -> None:
+        """ pool initializer: keeps the arrays shared by every block, so they are sent once per worker """
+        TemperatureEnsemble.worker_constants = constants
+
+    @staticmethod
+    def block_statistics(members: np.ndarray, quantiles: List) -> np.ndarray:
+        """ mean, standard deviation and quantiles over the ensemble of each record (block x statistic) """
+        return np.column_stack((members.mean(axis=0), members.std(axis=0), np.quantile(members, quantiles, axis=0).T))
+
+    @staticmethod
+    def simulate_block(task: dict) -> np.ndarray:
+        """ statistics over the ensemble of the delta perimeter, in microns, of each record of one block """
+        constants = TemperatureEnsemble.worker_constants
+        rng = np.random.default_rng(task['seed'])
+        temperature, initial_coordinates = task['temperature'], constants['initial_coordinates']
+        theta = np.radians(constants['directions'])
+        r = Perimeter.REAL_PERIMETER/(2 * np.pi)
+
+        noise = rng.normal(0, constants['noise_std'], (len(initial_coordinates),) + temperature.shape) * constants['has_data']
+        # radial thermal deformation of each member, as in TemperatureDeformation.calculate_deformation, the
+        # measured variation being (T + noise) - (T_reference + reference_noise)
+        radial = (temperature[None, :, :] + noise - constants['reference_noise'][:, None, :]) * constants['alpha'] * r
+        del noise
+        positions = np.repeat(initial_coordinates[:, None, :, :], temperature.shape[0], axis=1)
+        positions[..., 0] += radial * np.cos(theta)
+        positions[..., 1] += radial * np.sin(theta)
+        del radial
+
+        initial_perimeter = Perimeter.calc_perimeter_series(initial_coordinates)
+        members = (Perimeter.calc_perimeter_series(positions) - initial_perimeter[:, None]) * 1e6
+        del positions
+        return TemperatureEnsemble.block_statistics(members, task['quantiles'])
+
+    def get_constants(self) -> Dict:
+        return {'initial_coordinates': self.initial_coordinates, 'reference_noise': self.reference_noise, 'has_data': self.has_data,
+                'directions': [self.perimeter.directions[point] for point in self.point_names],
+                'noise_std': self.noise_std, 'alpha': self.alpha}
+
+    def generate_tasks(self, block_size: int, quantiles: List) -> list:
+        tasks = []
+        for i, start in enumerate(range(0, len(self.index), block_size)):
+            tasks.append({'temperature': self.temperature[start:start + block_size], 'quantiles': list(quantiles),
+                          # independent and reproducible noise stream of each block
+                          'seed': np.random.SeedSequence(self.seed, spawn_key=(1, i))})
+        return tasks
+
+    def get_block_size(self, max_memory_mb: float) -> int:
+        # largest (ensemble x block x node x 3) positions array within the budget, with room for the temporaries
+        bytes_per_record = self.n_members * len(self.point_names) * 3 * 8 * 3
+        return max(1, int(max_memory_mb * 1e6 // bytes_per_record))
+
+    @PROFILER.instrument('ensemble.run', lambda result, args, kwargs: {'rows': len(result), 'members': args[0].n_members})
+    def run(self, quantiles: List = (0.025, 0.5, 0.975), processes: int = None, max_memory_mb: float = 256) -> pd.DataFrame:
+        """ mean, standard deviation and quantiles over the ensemble of the delta perimeter, in microns, of each
+            record; max_memory_mb bounds the arrays of each worker process """
+        processes = processes or os.cpu_count()
+        tasks = self.generate_tasks(self.get_block_size(max_memory_mb), quantiles)
+
+        if processes > 1 and len(tasks) > 1:
+            with Pool(min(processes, len(tasks)), initializer=TemperatureEnsemble.attach_worker, initargs=(self.get_constants(),)) as pool:
+                blocks = pool.map(TemperatureEnsemble.simulate_block, tasks)
+        else:
+            TemperatureEnsemble.attach_worker(self.get_constants())
+            blocks = [TemperatureEnsemble.simulate_block(task) for task in tasks]
+            TemperatureEnsemble.worker_constants = {}
+
+        columns = ['mean', 'std'] + [f'q{q*100:g}' for q in quantiles]
+        return pd.DataFrame(np.concatenate(blocks), index=self.index, columns=columns)
+
+    @staticmethod
+    def to_frequency(bands: pd.DataFrame, microns_per_hz: float) -> pd.DataFrame:
+        """ perimeter bands converted to RF frequency bands (a longer perimeter means a lower frequency) """
+        frequency = -bands / microns_per_hz
+        frequency['std'] = bands['std'] / microns_per_hz
+        # quantile q of the frequency is the quantile 1-q of the perimeter
+        quantile_columns = [column for column in bands.columns if column.startswith('q')]
+        frequency[quantile_columns] = frequency[quantile_columns[::-1]].values
+        return frequency
+
+
+if __name__ == "__main__":
+    from main import POINT_NAMES_TEMP, MICRONS_PER_HZ, THERMAL_SHIFT_RECORDS, generate_node_temp_directions
+    from temp import TemperatureDeformation
+
+    # user definitions
+    n_members = 1000
+    noise_std = 0.05
+    position_std = 0.05
+
+    temp_options = {
+        'data_source': 'archiver',
+        'which_temp': 'concrete',
+        'combination_params': ['A', 'N']
+    }
+
+    timespam = {
+        'init': {'day': 13,'month': 11, 'year': 2021,'hour': 0,'minute': 0,'second': 0},
+        'end': {'day': 14,'month': 11, 'year': 2021,'hour': 10,'minute': 0,'second': 0}
+    }
+
+    temperature = TemperatureDeformation(timespam=timespam, **temp_options)
+    temperature.load_temp_data()
+    ensemble = TemperatureEnsemble(POINT_NAMES_TEMP, generate_node_temp_directions(), temperature.temp_data,
+                                   n_members, noise_std, position_std)
+    bands = TemperatureEnsemble.to_frequency(ensemble.run(), MICRONS_PER_HZ)
+
+    # the model of each record predicts the frequency THERMAL_SHIFT_RECORDS records before it
+    from plot import plot_lines
+    shift = THERMAL_SHIFT_RECORDS
+    plot_lines({column: [bands.index[:-shift], bands[column].values[shift:]] for column in bands.columns if column != 'std'})
@@ -0,0 +1,80 @@
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+from instrumentation import PROFILER, count_frame
+from temp import TemperatureDeformation
+from tides import MAPPING_CARDINAL_SECTOR as CARDINAL_NODES
+
+
+class TemperatureFusion(TemperatureDeformation):
+    """ several temperature sources (concrete, hls, fancoil) in one instance: the pvs of all of them are fetched
+        with a single concurrent request, each source is treated as by its own TemperatureDeformation (quality,
+        reference, sector mean) and mapped onto the ring nodes, and the sources are fused node by node in one
+        pass, as the weighted mean of the sources available at each record. Nodes without any source are
+        interpolated along the ring, if node_directions is given """
+
+    def __init__(self, sources: Dict, timespam: dict = None, node_directions: dict = None, quality=True) -> None:
+        """ sources maps each which_temp to its options: 'weight' (1 by default) and any TemperatureDeformation
+            option, e.g. {'concrete': {'weight': 1, 'combination_params': ['A', 'N']}, 'fancoil': {'weight': 0.2}} """
+        super().__init__('archiver', 'fused', timespam, node_directions=node_directions, quality=quality)
+        self.weights = {source: options.get('weight', 1) for source, options in sources.items()}
+        # the node filling is only done after the fusion
+        self.sources = {source: TemperatureDeformation('archiver', source, timespam, quality=quality,
+                                                       **{key: value for key, value in options.items() if key != 'weight'})
+                        for source, options in sources.items()}
+        for instance in self.sources.values():
+            if instance.combination_params is not None:
+                instance.generate_custom_pvs_combination()
+        # temperature variation of each source on the nodes it covers (time x node)
+        self.source_data = {}
+
+    def resolve_pvs(self) -> List:
+        return list(dict.fromkeys(pv for instance in self.sources.values() for pv in instance.resolve_pvs()))
+
+    def advance(self, data: pd.DataFrame, lookahead: pd.DataFrame = None) -> None:
+        """ each source keeps its own state """
+        for instance in self.sources.values():
+            pvs = instance.resolve_pvs()
+            instance.advance(data[pvs], None if lookahead is None else lookahead.reindex(columns=pvs))
+
+    @staticmethod
+    def map_to_nodes(data: pd.DataFrame) -> pd.DataFrame:
+        """ columns named after cardinals moved to their nodes; columns on the same node are averaged """
+        nodes = [CARDINAL_NODES.get(column, column) for column in data.columns]
+        if len(set(nodes)) == len(nodes):
+            return data.set_axis(nodes, axis='columns')
+        return data.T.groupby(nodes, sort=False).mean().T
+
+    @staticmethod
+    def fuse(values: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """ weighted mean over the sources (source x time x node) of the available (not NaN) values """
+        valid_weights = ~np.isnan(values) * weights[:, None, None]
+        total = valid_weights.sum(axis=0)
+        weighted_sum = (np.nan_to_num(values) * valid_weights).sum(axis=0)
+        return np.divide(weighted_sum, total, out=np.full(total.shape, np.nan), where=total > 0)
+
+    @PROFILER.instrument('temp.load_fused_temp_data', lambda result, args, kwargs: count_frame(args[0].temp_data))
+    def load_temp_data(self, data: pd.DataFrame = None, lookahead: pd.DataFrame = None) -> None:
+        """ loads the pvs of every source at once, or takes them from data (time x pv) if given, with lookahead
+            holding the records following them, if available """
+        raw_data, lookahead = self.get_data_from_archiver() if data is None else (data, lookahead)
+        for source, instance in self.sources.items():
+            instance.timespam = self.timespam
+            pvs = instance.resolve_pvs()
+            instance.load_temp_data(raw_data[pvs], None if lookahead is None else lookahead.reindex(columns=pvs))
+            self.source_data[source] = TemperatureFusion.map_to_nodes(instance.temp_data)
+
+        if self.node_directions is not None:
+            nodes = list(self.node_directions)
+        else:
+            nodes = list(dict.fromkeys(node for frame in self.source_data.values() for node in frame.columns))
+        values = np.stack([frame.reindex(index=raw_data.index, columns=nodes).values for frame in self.source_data.values()])
+        fused = TemperatureFusion.fuse(values, np.array([self.weights[source] for source in self.source_data], dtype=float))
+
+        if self.node_operator is not None:
+            # filling every node, and every gap of a node, along the ring
+            fused = self.node_operator.apply(fused)
+            self.temp_data = pd.DataFrame(fused, index=raw_data.index, columns=nodes)
+        else:
+            self.temp_data = pd.DataFrame(fused, index=raw_data.index, columns=nodes).dropna(axis='columns', how='all')
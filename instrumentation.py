@@ -0,0 +1,153 @@
+import json
+import time
+import asyncio
+import functools
+import threading
+import tracemalloc
+from collections import deque
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows: max_rss_mb is left out of the records
+    resource = None
+
+# records kept for dump_json; the totals of summary cover every call
+MAX_RECORDS = 10000
+
+
+class StageProfiler:
+    """ records wall time, CPU time, peak memory and data counts (rows, pvs, ...) of each pipeline stage;
+        peak memory is measured with tracemalloc, so it is only available while tracing is enabled
+        (see start_memory_tracking), and nested stages are accounted in their parents' peak too. As tracemalloc
+        traces the whole process, stages running concurrently (threads, asyncio tasks) are accounted in each other's
+        peak as well. Only the last max_records records are kept, so long running processes (e.g. the live monitor)
+        stay bounded """
+
+    def __init__(self, max_records: int = MAX_RECORDS) -> None:
+        self.records = deque(maxlen=max_records)
+        self.totals = {}
+        self.enabled = True
+        # running peak of the stages currently being measured, in any thread or task
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def start_memory_tracking(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop_memory_tracking(self) -> None:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def clear(self) -> None:
+        self.records.clear()
+        self.totals = {}
+
+    def update_active_peaks(self) -> int:
+        """ keeps the peak reached so far in every stage being measured, before it is reset for a new one;
+            returns the current traced memory """
+        current, peak = tracemalloc.get_traced_memory()
+        for frame in self.active.values():
+            frame['peak'] = max(frame['peak'], peak)
+        return current
+
+    @contextmanager
+    def measure(self, stage: str, **counts):
+        """ context manager yielding the stage record, so counts known only at the end can be added to it """
+        record = {'stage': stage, 'start': datetime.now().isoformat(timespec='seconds'), **counts}
+        if not self.enabled:
+            yield record
+            return
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            with self.lock:
+                current = self.update_active_peaks()
+                # reset_peak needs python 3.9, before that the peak is that of the whole tracing
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                frame = {'peak': 0, 'start_memory': current}
+                self.active[id(frame)] = frame
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_time_s'] = time.perf_counter() - wall_start
+            record['cpu_time_s'] = time.process_time() - cpu_start
+            record['peak_memory_mb'] = None
+            if tracing:
+                with self.lock:
+                    self.update_active_peaks()
+                    del self.active[id(frame)]
+                record['peak_memory_mb'] = (frame['peak'] - frame['start_memory']) / 1e6
+            # process-wide high-water mark (kB on Linux)
+            if resource is not None:
+                record['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+            self.records.append(record)
+            self.add_to_totals(record)
+
+    def add_to_totals(self, record: Dict) -> None:
+        stage = self.totals.setdefault(record['stage'], {'calls': 0, 'wall_time_s': 0, 'cpu_time_s': 0, 'peak_memory_mb': None})
+        stage['calls'] += 1
+        stage['wall_time_s'] += record['wall_time_s']
+        stage['cpu_time_s'] += record['cpu_time_s']
+        if record['peak_memory_mb'] is not None:
+            stage['peak_memory_mb'] = max(stage['peak_memory_mb'] or 0, record['peak_memory_mb'])
+
+    def instrument(self, stage: str, counter: Callable = None) -> Callable:
+        """ decorator measuring every call of a function or coroutine; 'counter' receives
+            (result, args, kwargs) and returns the counts to be added to the record """
+        def decorator(func):
+            def add_counts(record, result, args, kwargs):
+                if counter is not None:
+                    record.update(counter(result, args, kwargs))
+
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.measure(stage) as record:
+                        result = await func(*args, **kwargs)
+                        add_counts(record, result, args, kwargs)
+                    return result
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.measure(stage) as record:
+                    result = func(*args, **kwargs)
+                    add_counts(record, result, args, kwargs)
+                return result
+            return wrapper
+        return decorator
+
+    def summary(self) -> Dict:
+        """ totals per stage """
+        return {stage: dict(values) for stage, values in self.totals.items()}
+
+    def print_report(self) -> None:
+        print(f"{'stage':<40}{'calls':>6}{'wall [s]':>12}{'cpu [s]':>12}{'peak [MB]':>12}")
+        for stage, values in self.summary().items():
+            peak = f"{values['peak_memory_mb']:.1f}" if values['peak_memory_mb'] is not None else '-'
+            print(f"{stage:<40}{values['calls']:>6}{values['wall_time_s']:>12.3f}{values['cpu_time_s']:>12.3f}{peak:>12}")
+
+    def dump_json(self, filepath: str) -> None:
+        with open(filepath, 'w') as f:
+            json.dump({'records': list(self.records), 'summary': self.summary()}, f, indent=2, default=str)
+
+
+def count_frame(frame) -> Dict:
+    """ rows and columns of a DataFrame-like result """
+    if frame is None:
+        return {'rows': 0, 'columns': 0}
+    shape = getattr(frame, 'shape', (len(frame),))
+    return {'rows': shape[0], 'columns': shape[1] if len(shape) > 1 else 1}
+
+
+# profiler shared by all modules
+PROFILER = StageProfiler()
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+class RingInterpolator:
+    """ linear interpolation along the ring circumference from values known at source angular
+        positions onto target angular positions, precomputed as a (target x source) matrix """
+
+    def __init__(self, source_directions: list, target_directions: list) -> None:
+        self.source_directions = np.asarray(source_directions, dtype=float)
+        self.target_directions = np.asarray(target_directions, dtype=float)
+        self.matrix = RingInterpolator.build_matrix(self.source_directions, self.target_directions)
+
+    @staticmethod
+    def build_matrix(source_directions: np.ndarray, target_directions: np.ndarray) -> np.ndarray:
+        n_source, n_target = len(source_directions), len(target_directions)
+        source = np.mod(source_directions, 360)
+        order = np.argsort(source)
+        source = source[order]
+        target = np.mod(target_directions, 360)
+
+        # neighbouring sources of each target, wrapping around 0/360 degrees
+        right = np.searchsorted(source, target, side='right') % n_source
+        left = (right - 1) % n_source
+        span = np.mod(source[right] - source[left], 360)
+        offset = np.mod(target - source[left], 360)
+        weight_right = np.divide(offset, span, out=np.zeros(n_target), where=span > 0)
+
+        matrix = np.zeros((n_target, n_source))
+        rows = np.arange(n_target)
+        np.add.at(matrix, (rows, order[left]), 1 - weight_right)
+        np.add.at(matrix, (rows, order[right]), weight_right)
+        return matrix
+
+    def apply(self, values: np.ndarray) -> np.ndarray:
+        """ interpolates values with the sources on the last axis (..., source) -> (..., target) """
+        return values @ self.matrix.T
+
+
+class RingNodeOperator:
+    """ fills the ring nodes without data from the available ones, linearly along the circumference, or smooths
+        all of them with a gaussian kernel of smoothing_width degrees. The (node x node) operator depends only on
+        which nodes are available, so it is built once per availability pattern and cached """
+
+    def __init__(self, directions: list, smoothing_width: float = None) -> None:
+        self.directions = np.asarray(directions, dtype=float)
+        self.smoothing_width = smoothing_width
+        self.matrices = {}
+
+    def build_matrix(self, available: np.ndarray) -> np.ndarray:
+        """ (node x node) operator with zero columns for the unavailable nodes """
+        matrix = np.zeros((len(self.directions), len(self.directions)))
+        if not available.any():
+            return matrix
+        if self.smoothing_width is None:
+            matrix[:, available] = RingInterpolator.build_matrix(self.directions[available], self.directions)
+        else:
+            distance = np.abs(self.directions[:, None] - self.directions[None, available]) % 360
+            distance = np.minimum(distance, 360 - distance)
+            weights = np.exp(-0.5 * (distance / self.smoothing_width)**2)
+            matrix[:, available] = weights / weights.sum(axis=1, keepdims=True)
+        return matrix
+
+    def get_matrix(self, available: np.ndarray) -> np.ndarray:
+        key = available.tobytes()
+        if key not in self.matrices:
+            self.matrices[key] = self.build_matrix(available)
+        return self.matrices[key]
+
+    def apply(self, values: np.ndarray, block_size: int = 100000) -> np.ndarray:
+        """ values (time x node), NaN where a node has no data; one matrix multiply per availability pattern
+            of each block of records. Records without any data remain NaN """
+        result = np.full(values.shape, np.nan)
+        for start in range(0, len(values), block_size):
+            block = values[start:start + block_size]
+            available = ~np.isnan(block)
+            known = np.where(available, block, 0)
+            patterns, inverse = np.unique(available, axis=0, return_inverse=True)
+            for i, pattern in enumerate(patterns):
+                if not pattern.any():
+                    continue
+                rows = np.flatnonzero(inverse.ravel() == i)
+                result[start + rows] = known[rows] @ self.get_matrix(pattern).T
+        return result
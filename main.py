@@ -1,20 +1,191 @@
+import os
+import sys
+from collections import deque
 import numpy as np
 import pandas as pd
 from pandas.core.arrays import boolean
 from pandas.core.frame import DataFrame
 
-
-from utils import DataUtils
+import archiver
+import fusion
+import interpolation
+import perimeter as perimeter_module
+import quality
+import rf as rf_module
+import temp
+import thermal
+import tides as tides_module
+import timeseries
+from archiver import Archiver
+from cache import StageCache
+from changepoint import ChangePointDetector
+from fusion import TemperatureFusion
+from instrumentation import PROFILER
 from temp import TemperatureDeformation
+from thermal import ThermalInertia
+from timeseries import TimeSeriesArray
 from tides import Tides
 from perimeter import Perimeter
 from rf import RF
-from plot import plot_rf
+
+# shifting -3h (1 minute period -> 180 records); the thermal lag of the slab is compensated either by this shift or,
+# with a thermal time constant, by the ThermalInertia kernel alone (see get_thermal_shift_records)
+THERMAL_SHIFT_RECORDS = 180
+# perimeter to RF frequency conversion [um/Hz]
+MICRONS_PER_HZ = 1.04
+# the tidal displacements are subtracted from the thermal ones, as the perimeters used to be
+TIDES_SIGN = -1
+
+# node/point names
+POINT_NAMES_TEMP = ['Q1P1', 'Q1P2', 'Q1P3', 'Q1P4', 'Q1P5', 'Q1P6', 'Q1P7', 'Q1P8', 'Q1P9', 'Q1P10',
+                    'Q2P1', 'Q2P2', 'Q2P3', 'Q2P4', 'Q2P5', 'Q2P6', 'Q2P7', 'Q2P8', 'Q2P9', 'Q2P10',
+                    'Q3P1', 'Q3P2', 'Q3P3', 'Q3P4', 'Q3P5', 'Q3P6', 'Q3P7', 'Q3P8', 'Q3P9', 'Q3P10',
+                    'Q4P1', 'Q4P2', 'Q4P3', 'Q4P4', 'Q4P5', 'Q4P6', 'Q4P7', 'Q4P8', 'Q4P9', 'Q4P10']
+POINT_NAMES_TIDES = ["Q1P2","Q1P4","Q1P6","Q1P8","Q1P10","Q2P4","Q2P6","Q2P8","Q3P2","Q3P4","Q3P6","Q3P8","Q4P2","Q4P4","Q4P6","Q4P8"]
+
+
+def create_temperature(temp_options: dict, timespam: dict = None, node_directions: dict = None) -> TemperatureDeformation:
+    """ temperature instance of temp_options: with 'sources', several of them (e.g. concrete, hls and fancoil) are
+        fused onto the nodes """
+    if 'sources' in temp_options:
+        return TemperatureFusion(temp_options['sources'], timespam, node_directions)
+    return TemperatureDeformation(timespam=timespam, node_directions=node_directions, **temp_options)
+
+
+def get_thermal_shift_records(thermal_time_constant: float = None, shift_records: int = None) -> int:
+    """ records the model is shifted by: shift_records if given, otherwise none when the ThermalInertia kernel
+        already models the lag (thermal_time_constant) and THERMAL_SHIFT_RECORDS when it does not """
+    if shift_records is not None:
+        return shift_records
+    return 0 if thermal_time_constant else THERMAL_SHIFT_RECORDS
 
 
-def create_temperature_deformation_data(temperature: TemperatureDeformation) -> pd.DataFrame:
+def create_temperature_deformation_data(temperature: TemperatureDeformation, thermal_time_constant: float = None) -> pd.DataFrame:
     temperature.load_temp_data()
-    return temperature.calculate_deformation()
+    # first order thermal lag of the slab, in seconds, applied to every node
+    inertia = ThermalInertia.from_time_constants(thermal_time_constant) if thermal_time_constant else None
+    return temperature.calculate_deformation(inertia=inertia)
+
+
+def create_tides_data(point_names: list, timespam: dict, tides_mode: str = 'stations') -> TimeSeriesArray:
+    if tides_mode == 'linearized':
+        # extrapolated from the ring center straight to the temperature nodes
+        tides = Tides(point_names, mode='linearized', node_directions=generate_node_temp_directions())
+    else:
+        tides = Tides(point_names, mapping_needed=True)
+    tides.generate_tides(timespam)
+    return tides.get_array()
+
+
+def get_tides_points(tides_mode: str = 'stations') -> tuple:
+    """ names and angular positions of the points where the tides are given """
+    if tides_mode == 'linearized':
+        return POINT_NAMES_TEMP, generate_node_temp_directions()
+    return POINT_NAMES_TIDES, generate_node_tides_directions()
+
+
+def get_perimeter(survey_file: str = None) -> tuple:
+    """ the 40 nodes on the ideal circle, or the surveyed nodes of survey_file, and the directions of the temperature
+        nodes to interpolate from (None when the temperature nodes are the perimeter nodes) """
+    if survey_file:
+        return Perimeter.from_file(survey_file), get_node_temp_directions()
+    return Perimeter(POINT_NAMES_TEMP, generate_node_temp_directions()), None
+
+
+def calculate_delta_perimeter(temp_data: pd.DataFrame = None, tides_data: dict or TimeSeriesArray = None, tides_mode: str = 'stations',
+                              survey_file: str = None) -> np.ndarray:
+    """ perimeter evolution, in microns, caused by temperature and tides together in a single pass over the 40 nodes,
+        or over the surveyed nodes of survey_file, onto which the temperature nodes are interpolated """
+    # instantiate Perimeter class that will define the discretized circle scheme and calculate the perimeter evolution
+    perimeter, temp_directions = get_perimeter(survey_file)
+    tides_directions = dict(zip(*get_tides_points(tides_mode)))
+    delta_perimeter = perimeter.calculate_combined_delta_perimeter(temp_data, tides_data, tides_directions, tides_sign=TIDES_SIGN,
+                                                                   temp_directions=temp_directions)
+    # transforming to microns
+    return delta_perimeter.values * 1e6
+
+
+def calculate_segment_attribution(temp_data: pd.DataFrame = None, tides_data: dict or TimeSeriesArray = None, tides_mode: str = 'stations',
+                                  survey_file: str = None) -> dict:
+    """ length variation, in microns, of every segment of the ring and its sums per quadrant, per cardinal of
+        tides.MAPPING_CARDINAL_SECTOR and per concrete temperature sector, and their total, the perimeter evolution
+        given by calculate_delta_perimeter, all from a single pass. Each segment belongs to the cardinal closest to
+        its midpoint, and half of it to the sector of each of its nodes (that of the closest temperature node for
+        surveyed nodes), the sector of a temperature node being that of its concrete sensors """
+    perimeter, temp_directions = get_perimeter(survey_file)
+    tides_directions = dict(zip(*get_tides_points(tides_mode)))
+    segments = perimeter.calculate_segment_delta_lengths(temp_data, tides_data, tides_directions, tides_sign=TIDES_SIGN,
+                                                         temp_directions=temp_directions) * 1e6
+
+    node_directions = get_node_temp_directions()
+    cardinal_directions = {cardinal: node_directions[node] for cardinal, node in tides_module.MAPPING_CARDINAL_SECTOR.items()}
+    return {'total': segments.values.sum(axis=1),
+            'segment': segments,
+            'quadrant': Perimeter.aggregate_segments(segments, perimeter.group_segments_by_quadrant()),
+            'cardinal': Perimeter.aggregate_segments(segments, perimeter.group_segments_by_direction(cardinal_directions)),
+            'sector': Perimeter.aggregate_segments(segments, perimeter.group_segments_by_node(TemperatureDeformation.get_node_sectors(), node_directions))}
+
+
+def load_rf_data(timespam: dict) -> pd.DataFrame:
+    rf = RF('archiver', timespam)
+    return rf.get_data()
+
+
+def calculate_well_contribution(delta_perimeter: np.ndarray, rf_data: pd.Series, shift: int = THERMAL_SHIFT_RECORDS, microns_per_hz: float = MICRONS_PER_HZ) -> tuple:
+    """ converts the modeled perimeter (in microns) to RF frequency and extracts the residual, i.e. the well contribution """
+    # shifting the model to compensate the slab thermal lag
+    perim_temp = np.roll(delta_perimeter, -shift)
+    perim_temp -= perim_temp[0] # necessary to reference again
+
+    # converting to Hz
+    freq_temp = -perim_temp/microns_per_hz
+
+    # extracting the contribution of the well
+    well_contrib = rf_data - freq_temp
+    return freq_temp, well_contrib
+
+
+class WellContributionStream:
+    """ incremental version of calculate_well_contribution: each RF sample is paired with the model value
+        'shift' records ahead of it as soon as that value arrives, so consecutive blocks of data give the
+        same result as a single pass over the whole timespam """
+
+    def __init__(self, shift: int = THERMAL_SHIFT_RECORDS, microns_per_hz: float = MICRONS_PER_HZ) -> None:
+        self.shift = shift
+        self.microns_per_hz = microns_per_hz
+        # samples waiting for the model value ahead of them
+        self.pending = deque()
+        self.model_reference = None
+
+    def update(self, index: pd.Index, rf_data, delta_perimeter) -> pd.DataFrame:
+        self.pending.extend(zip(index, rf_data, delta_perimeter))
+
+        results = []
+        while len(self.pending) > self.shift:
+            perimeter_shifted = self.pending[self.shift][2]
+            timestamp, rf_value, perimeter_value = self.pending.popleft()
+            # necessary to reference again
+            if self.model_reference is None:
+                self.model_reference = perimeter_shifted
+            freq_model = -(perimeter_shifted - self.model_reference)/self.microns_per_hz
+            results.append({'datetime': timestamp, 'rf': rf_value, 'perimeter': perimeter_value,
+                            'model': freq_model, 'well_contrib': rf_value - freq_model})
+
+        return pd.DataFrame(results, columns=['datetime', 'rf', 'perimeter', 'model', 'well_contrib']).set_index('datetime')
+
+
+def get_temperature_cache_inputs(temperature: TemperatureDeformation, timespam: dict, temp_options: dict, thermal_time_constant: float = None) -> dict:
+    # the pv list depends on the custom combination, which is only resolved on demand
+    if temperature.combination_params is not None:
+        temperature.generate_custom_pvs_combination()
+    inputs = {'timespam': timespam, 'options': temp_options, 'node_directions': temperature.node_directions,
+              'thermal_time_constant': thermal_time_constant,
+              'code': StageCache.code_version(temp, fusion, quality, archiver, perimeter_module, interpolation, thermal)}
+    if temperature.data_source == 'archiver':
+        inputs['pvs'] = temperature.resolve_pvs()
+    else:
+        inputs['file_mtime'] = os.path.getmtime(temperature.filepath)
+    return inputs
 
 
 def generate_node_temp_directions() -> list:
@@ -31,85 +202,118 @@ def generate_node_temp_directions() -> list:
     pos_ang = [distance/Perimeter.REAL_PERIMETER * 360 for distance in distances]
     return pos_ang
 
+def get_node_temp_directions() -> dict:
+    return dict(zip(POINT_NAMES_TEMP, generate_node_temp_directions()))
+
 def generate_node_tides_directions() -> list:
     # mapped angles for each cardinal position, starting from East
     return [10.27, 28.26, 43.68, 64.23, 82.22, 118.26, 133.68, 154.23, 190.27, 208.26, 223.68, 244.23, 280.27, 298.26, 313.68, 334.23]
 
-def main(temp_options: list, use_tides: boolean, use_temp: boolean, timespam: dict):
+def main(temp_options: list, use_tides: boolean, use_temp: boolean, timespam: dict, use_cache: bool = True, profile_output: str = None,
+         tides_mode: str = 'stations', fill_nodes: bool = True, thermal_time_constant: float = None, shift_records: int = None,
+         store_dir: str = None, survey_file: str = None, events_file: str = None, attribution_file: str = None):
+    # timing and memory of each stage are saved as json if profile_output is given
+    if profile_output:
+        PROFILER.start_memory_tracking()
+
     # defining node/point names
-    point_names_temp = ['Q1P1', 'Q1P2', 'Q1P3', 'Q1P4', 'Q1P5', 'Q1P6', 'Q1P7', 'Q1P8', 'Q1P9', 'Q1P10',
-                        'Q2P1', 'Q2P2', 'Q2P3', 'Q2P4', 'Q2P5', 'Q2P6', 'Q2P7', 'Q2P8', 'Q2P9', 'Q2P10',
-                        'Q3P1', 'Q3P2', 'Q3P3', 'Q3P4', 'Q3P5', 'Q3P6', 'Q3P7', 'Q3P8', 'Q3P9', 'Q3P10',
-                        'Q4P1', 'Q4P2', 'Q4P3', 'Q4P4', 'Q4P5', 'Q4P6', 'Q4P7', 'Q4P8', 'Q4P9', 'Q4P10']
-    point_names_tides = ["Q1P2","Q1P4","Q1P6","Q1P8","Q1P10","Q2P4","Q2P6","Q2P8","Q3P2","Q3P4","Q3P6","Q3P8","Q4P2","Q4P4","Q4P6","Q4P8"]
+    point_names_temp = POINT_NAMES_TEMP
+    # 'linearized' evaluates the tides once at the ring center and extrapolates them to the 40 nodes
+    point_names_tides, tides_directions = get_tides_points(tides_mode)
+
+    # every stage output is cached on disk by a hash of its inputs, so that
+    # only the stages affected by a change are recomputed
+    cache = StageCache(enabled=use_cache)
+    temp_data, tides_data = None, None
 
     if use_tides:
         # creating tide signals
-        tides = Tides(point_names_tides, mapping_needed=True)
-        tides.generate_tides(timespam)
-        tides_data = tides.get_timeseries()
+        # the linearized mode extrapolates to the node directions, over the ring radius (Perimeter.REAL_PERIMETER)
+        tides_data = cache.run('tides', {'timespam': timespam, 'points': point_names_tides, 'mode': tides_mode,
+                                         'directions': tides_directions,
+                                         'code': StageCache.code_version(tides_module, timeseries, perimeter_module)},
+                               create_tides_data, point_names_tides, timespam, tides_mode)
 
     if use_temp:
         # calculating local deformation based on simulated temperature fluctuations
-        real_temp = TemperatureDeformation(timespam=timespam, **temp_options)
-        temp_data = create_temperature_deformation_data(real_temp)
-
+        # nodes without sensors are interpolated along the ring, so that the perimeter always uses the 40 nodes
+        node_directions = get_node_temp_directions() if fill_nodes else None
+        real_temp = create_temperature(temp_options, timespam, node_directions)
+        # the quality checks also fetch the records following the timespam
+        lookahead_records = real_temp.quality.get_lookahead_records() if real_temp.quality is not None else 0
+        temp_settled = real_temp.data_source != 'archiver' or Archiver.is_settled(timespam, lookahead_records)
+        temp_data = cache.run('temperature', get_temperature_cache_inputs(real_temp, timespam, temp_options, thermal_time_constant),
+                              create_temperature_deformation_data, real_temp, thermal_time_constant, settled=temp_settled)
 
-    # creating Perimeter object and calculating relative changes
-    # based on temperatura and tides influence, individually
 
-    # set/calculate the angular direction of each node/point
-    directions = generate_node_temp_directions()
-
-    # instantiate Perimeter class that will define the discretized circle scheme and calculate the perimeter evolution
-    perimeter = Perimeter(point_names_temp, directions)
-    # calculating perimeter evolution based on deformations caused by the temperature
-    delta_perimeter_temp = perimeter.calculate_delta_perimeter('temperature', temp_data)
-
-    # same process to tidal effects
-    directions = generate_node_tides_directions()
-    perimeter = Perimeter(point_names_tides, directions)
-    delta_perimeter_tide = perimeter.calculate_delta_perimeter('tides', tides_data)
-
-    # after calculating the contribution of both temperature and tides, compose the signals
-    delta_perimeter = delta_perimeter_temp - delta_perimeter_tide
-    # transforming to microns
-    delta_perimeter *= 1e6
-    # fixing length incompability with datetime index (don't know why)
-    delta_perimeter = delta_perimeter[:-1]
+    # calculating the perimeter evolution based on temperature and tides influence together:
+    # the tidal field is interpolated onto the temperature nodes and aligned to its records;
+    # with attribution_file, the same pass keeps the variation of every segment, the perimeter being their sum
+    perimeter_inputs = {'upstream': [cache.keys.get('temperature'), cache.keys.get('tides')],
+                        'points': point_names_temp, 'directions': generate_node_temp_directions(),
+                        'tides_points': point_names_tides, 'tides_directions': tides_directions,
+                        'tides_sign': TIDES_SIGN, 'code': StageCache.code_version(perimeter_module, interpolation, timeseries),
+                        'survey': [survey_file, os.path.getmtime(survey_file)] if survey_file else None}
+    if attribution_file:
+        attribution = cache.run('perimeter', {**perimeter_inputs, 'attribution': True, 'sectors': TemperatureDeformation.get_node_sectors()},
+                                calculate_segment_attribution, temp_data, tides_data, tides_mode, survey_file)
+        delta_perimeter = attribution['total']
+        pd.concat({level: frame for level, frame in attribution.items() if level != 'total'}, axis=1).to_csv(attribution_file)
+    else:
+        delta_perimeter = cache.run('perimeter', perimeter_inputs, calculate_delta_perimeter, temp_data, tides_data, tides_mode, survey_file)
 
 
     # load RF data
-    rf = RF('archiver', timespam)
-    rf_df = rf.get_data()
+    rf_df = cache.run('rf', {'timespam': timespam, 'pvs': rf_module.PV,
+                             'code': StageCache.code_version(rf_module, archiver)},
+                      load_rf_data, timespam, settled=Archiver.is_settled(timespam))
     rf_time = rf_df.index
     rf_data = rf_df.iloc[:,0]
 
     # # excluding outliers
+    # from utils import DataUtils
     # rf_df = DataUtils.filter_and_save_dataframe(rf_df, plot_output=True)
     # rf_df, perim_filt = DataUtils.filter_dataframes_mutually(rf_df, pd.DataFrame(delta_perimeter, index=rf_time))
     # delta_perimeter = perim_filt.iloc[:,0]
 
-    # shifting -3h (1 minute period -> 180 records)
-    perim_temp = np.roll(delta_perimeter, -180)
-    perim_temp -= perim_temp[0] # necessary to reference again
+    # converting the model to Hz and extracting the contribution of the well; the thermal lag is compensated
+    # by shifting the model, unless the inertia kernel already models it
+    shift = get_thermal_shift_records(thermal_time_constant, shift_records)
+    freq_temp, well_contrib = cache.run('residual', {'upstream': [cache.keys['perimeter'], cache.keys['rf']],
+                                                     'shift': shift, 'microns_per_hz': MICRONS_PER_HZ,
+                                                     'code': StageCache.code_version(sys.modules[__name__])},
+                                        calculate_well_contribution, delta_perimeter, rf_data, shift)
 
-    # converting to Hz
-    freq_temp = -perim_temp/1.04
+    # plotting (the last 'shift' records are ignored, as the shifted model wraps around there)
+    from plot import plot_rf
+    valid = slice(None, len(temp_data.index) - shift)
 
-    # extracting the contribution of the well
-    well_contrib = rf_data - freq_temp
+    # change points (e.g. ground-water or machine events) and spikes of the well contribution
+    events = ChangePointDetector().update(temp_data.index[valid], np.asarray(well_contrib)[valid])
+    print(f'{len(events)} events in the well contribution')
+    if events_file:
+        events.to_csv(events_file)
+
+    # saving the results, with the same columns as WellContributionStream
+    if store_dir:
+        from store import ResultsStore
+        results = pd.DataFrame({'rf': np.asarray(rf_data), 'perimeter': delta_perimeter, 'model': np.asarray(freq_temp),
+                                'well_contrib': np.asarray(well_contrib)}, index=temp_data.index.rename('datetime'))
+        ResultsStore(store_dir).append(results.iloc[valid])
+    plot_rf({'rf': [rf_time[valid], rf_data[valid]],\
+             'temp': [temp_data.index[valid], freq_temp[valid]],\
+             'poço': [temp_data.index[valid], well_contrib[valid]]})
 
-    # plotting (the last 180 records are ignored because of the 3h shift)
-    plot_rf({'rf': [rf_time[:-180], rf_data[:-180]],\
-             'temp': [temp_data.index[:-180], freq_temp[:-180]],\
-             'poço': [temp_data.index[:-180], well_contrib[:-180]]})
+    if profile_output:
+        PROFILER.print_report()
+        PROFILER.dump_json(profile_output)
 
 
 if __name__ == "__main__":
     # user definitions
     use_tides = True
     use_temperature = True
+    tides_mode = 'stations'
 
     temp_options = {
         'data_source': 'archiver',
@@ -122,7 +326,7 @@ if __name__ == "__main__":
         'end': {'day': 14,'month': 11, 'year': 2021,'hour': 10,'minute': 0,'second': 0}
     }
 
-    main(temp_options, use_tides, use_temperature, timespam)
+    main(temp_options, use_tides, use_temperature, timespam, tides_mode=tides_mode)
 
 
 
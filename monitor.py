@@ -0,0 +1,145 @@
+import os
+import time
+import asyncio
+from collections import deque
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import rf as rf_module
+from archiver import Archiver
+from temp import TemperatureDeformation
+from tides import Tides
+from store import ResultsStore
+from main import POINT_NAMES_TIDES, THERMAL_SHIFT_RECORDS, WellContributionStream, calculate_delta_perimeter, get_node_temp_directions
+
+
+class LiveMonitor:
+    """ long-running estimation of the thermal + tide perimeter and of the well contribution to RF;
+        each poll fetches only the samples newer than the last processed one and updates the results
+        incrementally, keeping the latest ones in a bounded buffer and appending all of them to a file """
+
+    def __init__(self, temp_options: dict, start: datetime = None, use_tides: bool = True, buffer_size: int = 7*24*60,
+                 output_file: str = 'live_output.csv', poll_period_in_seconds: int = 60, store_dir: str = None) -> None:
+        self.use_tides = use_tides
+        self.poll_period = poll_period_in_seconds
+        self.output_file = output_file
+        # results are also appended to a ResultsStore, queryable by dashboards at any resolution
+        self.store = ResultsStore(store_dir) if store_dir else None
+
+        self.temperature = TemperatureDeformation(node_directions=get_node_temp_directions(), **temp_options)
+        if self.temperature.combination_params is not None:
+            self.temperature.generate_custom_pvs_combination()
+        self.temp_pvs = self.temperature.resolve_pvs()
+
+        # tides are generated one whole day at a time; the instance keeps the first day's reference
+        self.tides = Tides(POINT_NAMES_TIDES, mapping_needed=True)
+        self.tides_day = None
+        self.tides_day_data = None
+
+        # first RF sample, defined by the first poll (the temperature one is kept by self.temperature)
+        self.rf_reference = None
+        # pairs each sample with the shifted model and keeps the model reference between polls
+        self.residual = WellContributionStream()
+        # latest results
+        self.buffer = deque(maxlen=buffer_size)
+
+        self.last_timestamp = None
+        # results already in the store (of a previous run) are not produced again
+        self.resume_after = self.store.get_last_timestamp() if self.store is not None else None
+        # by default starting early enough to have the residual available right away, from now or where the store ends
+        resume_from = self.resume_after.to_pydatetime() if self.resume_after is not None else datetime.now()
+        self.next_init = start if start else resume_from - timedelta(minutes=2*THERMAL_SHIFT_RECORDS)
+
+    def fetch_newest_data(self) -> pd.DataFrame:
+        """ fetches temperature and RF in a single request, so both share the same index """
+        timespam = Archiver.datetimes_to_timespam(self.next_init, datetime.now())
+        data = asyncio.run(Archiver.request_data(self.temp_pvs + rf_module.PV, timespam, 1))
+        if data is None:
+            return None
+        # discarding samples already processed by the previous polls
+        if self.last_timestamp is not None:
+            data = data[data.index > self.last_timestamp]
+        return data
+
+    def get_tides_day(self, day: pd.Timestamp) -> dict:
+        if self.tides_day != day:
+            day_end = day + timedelta(hours=23, minutes=59)
+            self.tides.generate_tides(Archiver.datetimes_to_timespam(day, day_end))
+            self.tides_day_data = {name: self.tides.get_timeseries()[name].copy() for name in POINT_NAMES_TIDES}
+            self.tides_day = day
+        return self.tides_day_data
+
+    def get_tides(self, index: pd.DatetimeIndex) -> dict:
+        tides_data = {name: [] for name in POINT_NAMES_TIDES}
+        for day, day_index in index.groupby(index.normalize()).items():
+            day_data = self.get_tides_day(day)
+            for name in tides_data:
+                tides_data[name].append(day_data[name].reindex(day_index, method='nearest'))
+        return {name: pd.concat(frames) for name, frames in tides_data.items()}
+
+    def calculate_delta_perimeter(self, temp_raw: pd.DataFrame) -> pd.Series:
+        # referenced to the first sample ever received
+        self.temperature.load_temp_data(temp_raw)
+        deformation = self.temperature.calculate_deformation()
+        tides_data = self.get_tides(temp_raw.index) if self.use_tides else None
+        # combined thermal and tidal perimeter, in microns
+        return pd.Series(calculate_delta_perimeter(deformation, tides_data), index=temp_raw.index)
+
+    def poll(self) -> pd.DataFrame:
+        """ processes the newest samples and returns the results that became available """
+        data = self.fetch_newest_data()
+        if data is None or data.empty:
+            return pd.DataFrame()
+        self.last_timestamp = data.index[-1]
+        # request_data drops the last (incomplete) bin, so the next request starts at its beginning
+        self.next_init = (self.last_timestamp + timedelta(seconds=30)).to_pydatetime()
+
+        rf_raw = data[rf_module.PV[0]]
+        if self.rf_reference is None:
+            self.rf_reference = rf_raw.iloc[0]
+
+        delta_perimeter = self.calculate_delta_perimeter(data[self.temp_pvs])
+        # the model is shifted -3h, so each sample waits for the one THERMAL_SHIFT_RECORDS ahead of it
+        results = self.residual.update(data.index, rf_raw - self.rf_reference, delta_perimeter)
+        if self.resume_after is not None:
+            results = results[results.index > self.resume_after]
+
+        self.buffer.extend(results.reset_index().to_dict('records'))
+        self.write_results(results)
+        return results
+
+    def write_results(self, results: pd.DataFrame) -> None:
+        if results.empty:
+            return
+        write_header = not os.path.exists(self.output_file)
+        results.to_csv(self.output_file, mode='a', header=write_header)
+        if self.store is not None:
+            self.store.append(results)
+
+    def get_buffer(self) -> pd.DataFrame:
+        return pd.DataFrame(list(self.buffer)).set_index('datetime') if self.buffer else pd.DataFrame()
+
+    def run(self) -> None:
+        try:
+            while True:
+                poll_start = time.monotonic()
+                results = self.poll()
+                if not results.empty:
+                    last = results.iloc[-1]
+                    print(f"{results.index[-1]}: model = {last['model']:.2f} Hz, well = {last['well_contrib']:.2f} Hz")
+                time.sleep(max(0, self.poll_period - (time.monotonic() - poll_start)))
+        except KeyboardInterrupt:
+            print('monitoring stopped.')
+
+
+if __name__ == "__main__":
+    # user definitions
+    temp_options = {
+        'data_source': 'archiver',
+        'which_temp': 'concrete',
+        'combination_params': ['A', 'N']
+    }
+
+    monitor = LiveMonitor(temp_options, use_tides=True)
+    monitor.run()
@@ -4,19 +4,75 @@ from typing import Dict, List
 import numpy as np
 import pandas as pd
 
+from instrumentation import PROFILER
+from interpolation import RingInterpolator
+from timeseries import TimeSeriesArray
+
 
 class Perimeter:    
     REAL_PERIMETER = 518.4
     
-    def __init__(self, point_names, directions: list = None) -> None:
+    def __init__(self, point_names, directions: list = None, coordinates: np.ndarray = None) -> None:
+        """ nodes on the ideal circle at the given directions, or at surveyed coordinates (node x 3, in meters,
+            in ring order), in which case the radial directions are derived from the geometry """
         self.point_names = point_names
         self.initial_coordinates = {}
         self.point_pairs = []
         self.directions = {}
 
         self.form_point_pairs()
-        self.calculate_directions(directions)
-        self.compute_initial_coordinates()
+        if coordinates is None:
+            self.calculate_directions(directions)
+            self.compute_initial_coordinates()
+        else:
+            self.set_surveyed_coordinates(coordinates)
+        self.compute_geometry()
+
+    @staticmethod
+    def load_coordinates(filepath: str) -> tuple:
+        """ node names and coordinates from a csv or excel file with 'name', 'x', 'y' and 'z' columns (meters),
+            one row per node in ring order """
+        table = pd.read_csv(filepath) if filepath.endswith('.csv') else pd.read_excel(filepath)
+        return list(table['name']), table[['x', 'y', 'z']].values.astype(float)
+
+    @staticmethod
+    def from_file(filepath: str) -> 'Perimeter':
+        point_names, coordinates = Perimeter.load_coordinates(filepath)
+        return Perimeter(point_names, coordinates=coordinates)
+
+    def set_surveyed_coordinates(self, coordinates: np.ndarray) -> None:
+        coordinates = np.asarray(coordinates, dtype=float)
+        for point, coordinate in zip(self.point_names, coordinates):
+            self.initial_coordinates[point] = tuple(coordinate)
+        # radial direction of each node: bisector of the outward normals of its two segments
+        _, normals, _ = Perimeter.calc_segment_geometry(coordinates)
+        bisectors = normals + np.roll(normals, 1, axis=0)
+        for point, bisector in zip(self.point_names, bisectors):
+            self.directions[point] = np.degrees(np.arctan2(bisector[1], bisector[0]))
+
+    @staticmethod
+    def calc_segment_geometry(coordinates: np.ndarray) -> tuple:
+        """ vectors from each node to the next one, horizontal outward unit normals and lengths of the segments """
+        pair_vectors = np.roll(coordinates, -1, axis=0) - coordinates
+        segment_lengths = np.sqrt((pair_vectors**2).sum(axis=1))
+        normals = np.column_stack((pair_vectors[:, 1], -pair_vectors[:, 0], np.zeros(len(pair_vectors))))
+        normals /= np.sqrt((normals**2).sum(axis=1, keepdims=True))
+        # pointing away from the centroid, whatever the orientation of the ring
+        midpoints = coordinates + pair_vectors/2 - coordinates.mean(axis=0)
+        normals *= np.where((normals[:, :2] * midpoints[:, :2]).sum(axis=1) < 0, -1, 1)[:, None]
+        return pair_vectors, normals, segment_lengths
+
+    def compute_geometry(self) -> None:
+        """ geometry arrays used by the vectorized calculations, in point_names order """
+        self.coordinates = np.array([self.initial_coordinates[point] for point in self.point_names])
+        self.pair_vectors, self.unit_normals, self.segment_lengths = Perimeter.calc_segment_geometry(self.coordinates)
+        theta = np.radians([self.directions[point] for point in self.point_names])
+        self.radial_vectors = np.column_stack((np.cos(theta), np.sin(theta), np.zeros(len(theta))))
+        self.initial_perimeter = self.segment_lengths.sum()
+        # gradient of the perimeter with respect to each node position (node x 3): the unit vector of the
+        # segment arriving at the node minus the one of the segment leaving it
+        self.unit_pairs = self.pair_vectors / self.segment_lengths[:, None]
+        self.node_gradients = np.roll(self.unit_pairs, 1, axis=0) - self.unit_pairs
     
     def form_point_pairs(self) -> None:
         for i in range(len(self.point_names)-1):
@@ -70,7 +126,168 @@ class Perimeter:
 
         return perim
 
+    @staticmethod
+    def calc_perimeter_series(positions: np.ndarray) -> np.ndarray:
+        """ perimeters of the closed polygons given by positions (... x node x 3), nodes in ring order """
+        segments = np.roll(positions, -1, axis=-2) - positions
+        return np.sqrt((segments**2).sum(axis=-1)).sum(axis=-1)
+
+    @PROFILER.instrument('perimeter.calculate_combined_delta_perimeter', lambda result, args, kwargs: {'nodes': len(args[0].point_names), 'rows': len(result)})
+    def calculate_combined_delta_perimeter(self, temp_deformation: pd.DataFrame or TimeSeriesArray = None, tides_deformation: Dict or TimeSeriesArray = None,
+                                           tides_directions: Dict = None, tides_sign: float = 1, block_size: int = 100000,
+                                           temp_directions: Dict = None, linearized: bool = False) -> pd.Series:
+        """ single pass over the thermal (radial) and tidal (3D) deformations superimposed on the same nodes;
+            the tidal field, known at the stations of tides_directions, is interpolated along the ring onto
+            every node and aligned to the temperature records. Returns one value per record, relative to
+            the undeformed ring. With linearized, the first order variation is used: the geometry is folded into one
+            weight per source series, so the cost per record does not depend on the number of nodes """
+        index, radial, temp_matrix, station_data, tides_matrix = self.prepare_deformation(temp_deformation, tides_deformation,
+                                                                                          tides_directions, temp_directions)
+        if linearized:
+            # d(perimeter)/d(source): radial sources move their nodes along radial_vectors
+            delta_perimeter = radial @ (temp_matrix.T @ (self.node_gradients * self.radial_vectors).sum(axis=1))
+            if station_data is not None:
+                delta_perimeter = delta_perimeter + tides_sign * np.einsum('tsc,sc->t', station_data, tides_matrix.T @ self.node_gradients)
+            return pd.Series(delta_perimeter, index=index)
+
+        delta_perimeter = Perimeter.calc_delta_perimeter_series(self.pair_vectors, self.radial_vectors, radial @ temp_matrix.T,
+                                                                station_data, tides_matrix, tides_sign, block_size)
+        return pd.Series(delta_perimeter, index=index)
+
+    @PROFILER.instrument('perimeter.calculate_segment_delta_lengths', lambda result, args, kwargs: {'nodes': len(args[0].point_names), 'rows': len(result)})
+    def calculate_segment_delta_lengths(self, temp_deformation: pd.DataFrame or TimeSeriesArray = None, tides_deformation: Dict or TimeSeriesArray = None,
+                                        tides_directions: Dict = None, tides_sign: float = 1, block_size: int = 100000,
+                                        temp_directions: Dict = None, linearized: bool = False) -> pd.DataFrame:
+        """ same pass as calculate_combined_delta_perimeter keeping the length variation of every segment (time x segment,
+            named 'first-second' after its nodes); the rows add up to the perimeter variation and aggregate_segments
+            groups the columns by quadrant, cardinal or sector """
+        index, radial, temp_matrix, station_data, tides_matrix = self.prepare_deformation(temp_deformation, tides_deformation,
+                                                                                          tides_directions, temp_directions)
+        if linearized:
+            # d(segment)/d(source): the unit segment vector projected on the displacement of its end minus its start
+            start = (self.unit_pairs * self.radial_vectors).sum(axis=1)[:, None] * temp_matrix
+            end = (self.unit_pairs * np.roll(self.radial_vectors, -1, axis=0)).sum(axis=1)[:, None] * np.roll(temp_matrix, -1, axis=0)
+            segment_deltas = radial @ (end - start).T
+            if station_data is not None:
+                segment_deltas += tides_sign * np.einsum('tsc,ns,nc->tn', station_data, np.roll(tides_matrix, -1, axis=0) - tides_matrix,
+                                                         self.unit_pairs)
+        else:
+            _, segment_deltas = Perimeter.calc_delta_perimeter_series(self.pair_vectors, self.radial_vectors, radial @ temp_matrix.T,
+                                                                      station_data, tides_matrix, tides_sign, block_size, return_segments=True)
+        return pd.DataFrame(segment_deltas, index=index, columns=self.get_segment_names())
+
+    def prepare_deformation(self, temp_deformation: pd.DataFrame or TimeSeriesArray = None, tides_deformation: Dict or TimeSeriesArray = None,
+                            tides_directions: Dict = None, temp_directions: Dict = None) -> tuple:
+        """ index, radial deformation (time x source) and its node matrix (node x source), station displacements
+            (time x station x 3, or None) and their node matrix (node x station) """
+        if temp_deformation is not None:
+            temp_deformation = TimeSeriesArray.from_any(temp_deformation)
+        if tides_deformation is not None:
+            tides_deformation = TimeSeriesArray.from_any(tides_deformation, ['East', 'North', 'Up'])
+        index = temp_deformation.index if temp_deformation is not None else tides_deformation.index
+        directions = [self.directions[point] for point in self.point_names]
+
+        # radial thermal deformation (time x source) mapped onto the nodes by temp_matrix (node x source): interpolated
+        # along the ring from the nodes at temp_directions, if given, otherwise zero for the nodes without data
+        radial, temp_matrix = np.zeros((len(index), 0)), np.zeros((len(self.point_names), 0))
+        if temp_deformation is not None and temp_directions is not None:
+            radial = temp_deformation.values[:, :, 0]
+            temp_matrix = RingInterpolator([temp_directions[node] for node in temp_deformation.stations], directions).matrix
+        elif temp_deformation is not None:
+            nodes = [i for i, point in enumerate(self.point_names) if point in temp_deformation]
+            radial = temp_deformation.select([self.point_names[i] for i in nodes]).values[:, :, 0]
+            temp_matrix = np.zeros((len(self.point_names), len(nodes)))
+            temp_matrix[nodes, np.arange(len(nodes))] = 1
+
+        # tidal displacements at the stations, time x station x (East, North, Up)
+        station_data, tides_matrix = None, None
+        if tides_deformation is not None:
+            tides_deformation = tides_deformation.reindex_nearest(index).select(components=['East', 'North', 'Up'])
+            tides_matrix = RingInterpolator([tides_directions[station] for station in tides_deformation.stations], directions).matrix
+            station_data = tides_deformation.values
+        return index, radial, temp_matrix, station_data, tides_matrix
+
+    def get_segment_names(self) -> List:
+        return [f'{first}-{second}' for first, second in self.point_pairs]
+
+    def get_segment_directions(self) -> np.ndarray:
+        """ direction of the midpoint of each segment, in degrees from East, seen from the centroid of the ring """
+        midpoints = self.coordinates + self.pair_vectors/2 - self.coordinates.mean(axis=0)
+        return np.degrees(np.arctan2(midpoints[:, 1], midpoints[:, 0])) % 360
+
+    def group_segments_by_quadrant(self) -> Dict:
+        """ segment name to quadrant (Q1 from 0 to 90 degrees, counterclockwise from East) """
+        return {segment: f'Q{int(direction // 90) + 1}' for segment, direction in zip(self.get_segment_names(), self.get_segment_directions())}
+
+    def group_segments_by_direction(self, label_directions: Dict) -> Dict:
+        """ segment name to the label (e.g. cardinal or sector) whose direction, in degrees, is the closest one """
+        labels = list(label_directions)
+        angles = np.asarray([label_directions[label] for label in labels], dtype=float)
+        distances = np.abs((self.get_segment_directions()[:, None] - angles[None, :] + 180) % 360 - 180)
+        return {segment: labels[i] for segment, i in zip(self.get_segment_names(), distances.argmin(axis=1))}
+
+    def group_segments_by_node(self, node_labels: Dict, node_directions: Dict = None) -> Dict:
+        """ segment name to the labels (e.g. sectors) of its two nodes, half of the segment to each; a node missing
+            from node_labels (as a surveyed one) takes the label of the node of node_directions closest to it """
+        def get_label(point):
+            if point in node_labels:
+                return node_labels[point]
+            names = [name for name in node_directions if name in node_labels]
+            angles = np.asarray([node_directions[name] for name in names], dtype=float)
+            distances = np.abs((self.directions[point] - angles + 180) % 360 - 180)
+            return node_labels[names[distances.argmin()]]
+
+        groups = {}
+        for segment, pair in zip(self.get_segment_names(), self.point_pairs):
+            shares = {}
+            for point in pair:
+                label = get_label(point)
+                shares[label] = shares.get(label, 0) + 0.5
+            groups[segment] = shares
+        return groups
+
+    @staticmethod
+    def aggregate_segments(segment_deltas: pd.DataFrame, groups: Dict) -> pd.DataFrame:
+        """ sum of the segment columns of each group (time x group), groups in order of first appearance; a segment
+            is mapped to a single group or split among several ({group: share}) """
+        groups = {segment: group if isinstance(group, dict) else {group: 1} for segment, group in groups.items()}
+        labels = list(dict.fromkeys(label for segment in segment_deltas.columns for label in groups[segment]))
+        membership = np.zeros((len(segment_deltas.columns), len(labels)))
+        for i, segment in enumerate(segment_deltas.columns):
+            for label, share in groups[segment].items():
+                membership[i, labels.index(label)] = share
+        return pd.DataFrame(segment_deltas.values @ membership, index=segment_deltas.index, columns=labels)
+
+    @staticmethod
+    def calc_delta_perimeter_series(pair_vectors: np.ndarray, radial_vectors: np.ndarray, radial: np.ndarray, station_data: np.ndarray = None,
+                                    tides_matrix: np.ndarray = None, tides_sign: float = 1, block_size: int = 100000,
+                                    return_segments: bool = False) -> np.ndarray:
+        """ perimeter variation of the ring whose segments are pair_vectors (node x 3) when its nodes are displaced
+            radially (time x node, along radial_vectors) and, optionally, by the station displacements
+            (time x station x 3) mapped onto the nodes by tides_matrix (node x station). With return_segments,
+            the length variation of each segment (time x segment) is returned too """
+        initial_lengths = np.sqrt((pair_vectors**2).sum(axis=1))
+        initial_perimeter = initial_lengths.sum()
+        # processing blocks of records to bound the (time x node x 3) arrays
+        delta_perimeter = np.empty(len(radial))
+        segment_deltas = np.empty((len(radial), len(pair_vectors))) if return_segments else None
+        for start in range(0, len(radial), block_size):
+            block = slice(start, start + block_size)
+            displacements = radial[block][:, :, None] * radial_vectors
+            if station_data is not None:
+                displacements += tides_sign * np.einsum('ns,tsc->tnc', tides_matrix, station_data[block])
+            # segments deformed by the relative displacement of their nodes
+            segments = pair_vectors + np.roll(displacements, -1, axis=1) - displacements
+            lengths = np.sqrt((segments**2).sum(axis=2))
+            delta_perimeter[block] = lengths.sum(axis=1) - initial_perimeter
+            if return_segments:
+                segment_deltas[block] = lengths - initial_lengths
+        if return_segments:
+            return delta_perimeter, segment_deltas
+        return delta_perimeter
+
 
+    @PROFILER.instrument('perimeter.calculate_delta_perimeter', lambda result, args, kwargs: {'nodes': len(args[0].point_names), 'rows': len(result)})
     def calculate_delta_perimeter(self, deformation_type: str, deformation: pd.DataFrame or Dict[pd.DataFrame]) -> np.ndarray:
         # setting first perimeter value as the initial/unaltered one
         perimeter_value = [self.calc_perimeter(self.initial_coordinates)]
@@ -0,0 +1,198 @@
+import os
+import copy
+import queue
+import asyncio
+import threading
+from collections import deque
+from multiprocessing import Pool
+
+from archiver import Archiver
+from temp import TemperatureDeformation
+from instrumentation import PROFILER
+from tides import Tides
+from rf import PV as RF_PV
+from utils import MathUtils
+from store import ResultsStore
+from chunked import generate_chunks, write_events
+from changepoint import ChangePointDetector
+from main import POINT_NAMES_TIDES, WellContributionStream, create_temperature, calculate_delta_perimeter, get_node_temp_directions
+
+
+class ChunkPipeline:
+    """ same processing as chunked.main_chunked, with the archiver downloads overlapped with the computation:
+        a producer thread fetches the next blocks (asynchronously, temperature and RF together) into a bounded
+        queue, while a pool of workers computes the deformation, tides and perimeter of each block. The responses
+        are decoded by the producer, as the decoded frames are much cheaper to send to the workers than the json.
+        The steps carrying state between blocks (references, RF filter, shifted residual, outputs) run in the main
+        process, in block order, each block being written as soon as it and the ones before it are done.
+        At most prefetch decoded blocks wait in the queue and at most processes blocks are submitted to the
+        workers (their frames and results included), so the memory holds up to prefetch + processes blocks,
+        whatever the length of the timespam, and the total time approaches the longest of downloading and
+        computing """
+
+    def __init__(self, temp_options: dict, use_tides: bool, timespam: dict, chunk_days: float = 7,
+                 processes: int = None, prefetch: int = 2, filter_min_period: float = None) -> None:
+        self.temp_options = temp_options
+        self.use_tides = use_tides
+        self.timespam = timespam
+        self.chunks = generate_chunks(timespam, chunk_days)
+        self.processes = processes or os.cpu_count()
+        self.prefetch = prefetch
+        self.filter_min_period = filter_min_period
+
+        # copied to the worker of each block with the state (quality checks, references) of the blocks before it
+        self.temperature = create_temperature(temp_options, timespam, get_node_temp_directions())
+        if self.temperature.combination_params is not None:
+            self.temperature.generate_custom_pvs_combination()
+        self.temp_pvs = self.temperature.resolve_pvs()
+
+    @staticmethod
+    async def fetch_block(temp_pvs: list, timespam: dict, lookahead_records: int) -> tuple:
+        """ raw temperature and RF data of one block, and the temperature records following it (None if not needed) """
+        fetches = [Archiver.fetch_json(temp_pvs, timespam, 1), Archiver.fetch_json(RF_PV, timespam, 1)]
+        if lookahead_records:
+            fetches.append(Archiver.fetch_json(temp_pvs, TemperatureDeformation.get_lookahead_timespam(timespam, lookahead_records), 1))
+        responses = await asyncio.gather(*fetches)
+        with PROFILER.measure('pipeline.decode'):
+            lookahead = Archiver.decode_json(responses[2], temp_pvs) if lookahead_records else None
+            return Archiver.decode_json(responses[0], temp_pvs), lookahead, Archiver.decode_json(responses[1], RF_PV)
+
+    def produce(self, fetched: queue.Queue, stop: threading.Event) -> None:
+        """ producer thread: fetches the blocks in order, waiting while the queue is full """
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    fetched.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        lookahead_records = self.temperature.quality.get_lookahead_records() if self.temperature.quality is not None else 0
+
+        async def fetch_all():
+            for i, (chunk_init, chunk_end) in enumerate(self.chunks):
+                raw_data = await ChunkPipeline.fetch_block(self.temp_pvs, Archiver.datetimes_to_timespam(chunk_init, chunk_end), lookahead_records)
+                if not put((i, raw_data)):
+                    return
+            put(None)
+
+        try:
+            asyncio.run(fetch_all())
+        except Exception as error:
+            # raised again by the consumer
+            put(error)
+
+    @staticmethod
+    def compute_block(task: dict) -> tuple:
+        """ worker: perimeter evolution, in microns, and RF variation of one block, both aligned to the temperature
+            records, using the references of the whole timespam """
+        temp_raw, temp_lookahead, rf_raw = task['raw_data']
+        temperature = task['temperature']
+        temperature.timespam = task['timespam']
+        temperature.load_temp_data(temp_raw, temp_lookahead)
+        temp_data = temperature.calculate_deformation()
+
+        tides_data = None
+        if task['tides_reference'] is not None:
+            tides = Tides(POINT_NAMES_TIDES, mapping_needed=True)
+            tides.reference = task['tides_reference']
+            tides.generate_tides(task['timespam'])
+            tides_data = tides.get_array().select(POINT_NAMES_TIDES)
+
+        delta_perimeter = calculate_delta_perimeter(temp_data, tides_data)
+        rf_data = (rf_raw - task['rf_reference']).iloc[:, 0].reindex(temp_data.index, method='nearest').values
+        return temp_data.index, rf_data, delta_perimeter
+
+    def consume_result(self, result, i: int, residual: WellContributionStream, detector: ChangePointDetector,
+                       store: ResultsStore, output_file: str, events_file: str) -> int:
+        """ main process: the steps carrying state between blocks, for block i; returns the next block number """
+        print(f'processing block {i+1}/{len(self.chunks)}: {self.chunks[i][0]} - {self.chunks[i][1]}')
+        index, rf_data, delta_perimeter = result.get()
+        if self.filter_min_period:
+            rf_data, self.filter_state = MathUtils.filter_timeserie_causal(rf_data, self.filter_min_period, self.filter_state)
+        results = residual.update(index, rf_data, delta_perimeter)
+        results.to_csv(output_file, mode='a', header=(i == 0))
+        if store is not None:
+            store.append(results)
+        if events_file:
+            write_events(detector.update(results.index, results['well_contrib']), events_file)
+        return i + 1
+
+    @PROFILER.instrument('pipeline.run', lambda result, args, kwargs: {'blocks': len(args[0].chunks)})
+    def run(self, output_file: str = 'chunked_output.csv', store_dir: str = None, events_file: str = None) -> str:
+        for filename in [output_file, events_file]:
+            if filename and os.path.exists(filename):
+                os.remove(filename)
+        residual = WellContributionStream()
+        detector = ChangePointDetector()
+        store = ResultsStore(store_dir) if store_dir else None
+        self.filter_state = None
+
+        fetched, stop = queue.Queue(maxsize=self.prefetch), threading.Event()
+        producer = threading.Thread(target=self.produce, args=(fetched, stop), daemon=True)
+        rf_reference = None
+        pending, done = deque(), False
+        # the workers are forked before the producer thread starts, so they never inherit a lock held by it
+        with Pool(self.processes) as pool:
+            producer.start()
+            try:
+                # the tides reference only depends on the first day, it is taken while the first block downloads
+                tides_reference = None
+                if self.use_tides:
+                    tides = Tides(POINT_NAMES_TIDES, mapping_needed=True)
+                    tides.set_reference(self.timespam)
+                    tides_reference = tides.reference
+
+                i = 0
+                while True:
+                    # the oldest block is written as soon as it is ready; otherwise the workers are fed
+                    # while they have room and blocks are left
+                    if pending and (pending[0].ready() or done or len(pending) >= self.processes):
+                        i = self.consume_result(pending.popleft(), i, residual, detector, store, output_file, events_file)
+                        continue
+                    if not done:
+                        item = fetched.get()
+                        if isinstance(item, Exception):
+                            raise item
+                        if item is None:
+                            done = True
+                            continue
+                        index, raw_data = item
+                        # the worker gets the state of the blocks before this one, which is then carried over it here
+                        # (the quality checks run again in the main process, in block order, as main_chunked does)
+                        temperature = copy.deepcopy(self.temperature)
+                        self.temperature.advance(raw_data[0], raw_data[1])
+                        if rf_reference is None:
+                            # first record of the whole timespam, as taken by the instance reused in main_chunked
+                            rf_reference = raw_data[2].iloc[0, :]
+                        chunk_init, chunk_end = self.chunks[index]
+                        task = {'raw_data': raw_data, 'timespam': Archiver.datetimes_to_timespam(chunk_init, chunk_end),
+                                'temperature': temperature, 'rf_reference': rf_reference, 'tides_reference': tides_reference}
+                        pending.append(pool.apply_async(ChunkPipeline.compute_block, (task,)))
+                        continue
+                    break
+            finally:
+                stop.set()
+                producer.join()
+
+        return output_file
+
+
+if __name__ == "__main__":
+    # user definitions
+    use_tides = True
+
+    temp_options = {
+        'data_source': 'archiver',
+        'which_temp': 'concrete',
+        'combination_params': ['A', 'N']
+    }
+
+    timespam = {
+        'init': {'day': 1,'month': 9, 'year': 2021,'hour': 0,'minute': 0,'second': 0},
+        'end': {'day': 1,'month': 12, 'year': 2021,'hour': 0,'minute': 0,'second': 0}
+    }
+
+    ChunkPipeline(temp_options, use_tides, timespam, chunk_days=7).run()
+    PROFILER.print_report()
@@ -6,6 +6,82 @@ import matplotlib.dates as mdates
 import numpy as np
 from functools import partial
 
+from instrumentation import PROFILER
+
+
+def decimate_minmax(x: np.ndarray, y: np.ndarray, n_bins: int) -> np.ndarray:
+    """ shape-preserving downsampling: returns the (sorted) indexes of the minimum and maximum
+        of each of n_bins consecutive buckets, plus the first and last points """
+    n = len(y)
+    if n <= 2*n_bins:
+        return np.arange(n)
+    bin_size = int(np.ceil(n / n_bins))
+    n_full = (n // bin_size) * bin_size
+    # NaNs are never chosen unless the whole bucket is NaN, keeping the gap visible
+    nan = np.isnan(y)
+    y_min = np.where(nan, np.inf, y)
+    y_max = np.where(nan, -np.inf, y)
+
+    offsets = np.arange(0, n_full, bin_size)
+    idx_min = y_min[:n_full].reshape(-1, bin_size).argmin(axis=1) + offsets
+    idx_max = y_max[:n_full].reshape(-1, bin_size).argmax(axis=1) + offsets
+    indexes = [idx_min, idx_max, [0, n - 1]]
+    if n_full < n:
+        indexes.append([n_full + y_min[n_full:].argmin(), n_full + y_max[n_full:].argmax()])
+    return np.unique(np.concatenate(indexes))
+
+
+class DecimatedPlot:
+    """ keeps the full-resolution series of each line and draws them decimated to about the
+        axes width in pixels; zooming or panning re-decimates the visible range from the full data """
+
+    def __init__(self, ax, enabled: bool = True) -> None:
+        self.ax = ax
+        self.enabled = enabled
+        self.series = []
+        self.ax.callbacks.connect('xlim_changed', self.update)
+
+    def plot(self, x, y, **kwargs):
+        x = np.asarray(x)
+        if np.issubdtype(x.dtype, np.datetime64) or x.dtype == object:
+            # working with matplotlib's float dates, so the visible range can be searched directly
+            x = mdates.date2num(x)
+            self.ax.xaxis_date()
+        x = x.astype(float)
+        y = np.asarray(y, dtype=float)
+        # the first draw covers the whole series
+        idx = self.decimate(x, y, 0, len(x))
+        line, = self.ax.plot(x[idx], y[idx], **kwargs)
+        self.series.append((line, x, y))
+        return line
+
+    def get_n_bins(self) -> int:
+        return max(int(self.ax.get_window_extent().width), 100)
+
+    def decimate(self, x: np.ndarray, y: np.ndarray, start: int, end: int) -> np.ndarray:
+        if not self.enabled:
+            return np.arange(start, end)
+        return decimate_minmax(x[start:end], y[start:end], self.get_n_bins()) + start
+
+    def update(self, ax=None) -> None:
+        x_min, x_max = self.ax.get_xlim()
+        for line, x, y in self.series:
+            # one point beyond each side, so the line reaches the borders of the axes
+            start = max(np.searchsorted(x, x_min) - 1, 0)
+            end = min(np.searchsorted(x, x_max) + 1, len(x))
+            idx = self.decimate(x, y, start, end)
+            line.set_data(x[idx], y[idx])
+
+
+def show_or_save(fig, output_file: str = None) -> None:
+    """ renders to output_file (for batch jobs) or shows the interactive window """
+    if output_file:
+        fig.savefig(output_file, dpi=150)
+        plt.close(fig)
+    else:
+        plt.show()
+
+
 class LegendPickablePlot():
     fig = None
     ax = None
@@ -56,55 +132,93 @@ class LegendPickablePlot():
         fig.canvas.draw()
 
 
+class SortedXIndex:
+    """ spatial index over (x, y) points sorted by x: a bounding box query is a binary search
+        on x followed by a filter on y over that slice only """
+
+    def __init__(self, x: np.ndarray, y: np.ndarray) -> None:
+        self.order = np.argsort(x, kind='stable')
+        self.x = np.asarray(x, dtype=float)[self.order]
+        self.y = np.asarray(y, dtype=float)[self.order]
+
+    def query_positions(self, x_min: float, x_max: float, y_min: float, y_max: float) -> np.ndarray:
+        """ positions, in the sorted arrays, of the points inside the box """
+        start = np.searchsorted(self.x, x_min, side='left')
+        end = np.searchsorted(self.x, x_max, side='right')
+        y = self.y[start:end]
+        return np.nonzero((y >= y_min) & (y <= y_max))[0] + start
+
+    def query_bbox(self, x_min: float, x_max: float, y_min: float = -np.inf, y_max: float = np.inf) -> np.ndarray:
+        """ original indexes of the points inside the box, sorted by x """
+        return self.order[self.query_positions(x_min, x_max, y_min, y_max)]
+
+    def query_path(self, path: Path) -> np.ndarray:
+        """ original indexes of the points inside a closed path, testing only the candidates in its bounding box """
+        extents = path.get_extents()
+        positions = self.query_positions(extents.x0, extents.x1, extents.y0, extents.y1)
+        if len(positions) == 0:
+            return self.order[positions]
+        inside = path.contains_points(np.column_stack((self.x[positions], self.y[positions])))
+        return self.order[positions[inside]]
+
+
 class PickPointsPlot:
+    # number of points drawn for the whole visible range
+    MAX_DISPLAYED_POINTS = 4000
+
     @staticmethod
     def plot(x, y):
-        class SelectFromCollection:
-            def __init__(self, ax, collection, alpha_other=0.3):
+        class SelectFromIndex:
+            def __init__(self, ax, x, y):
+                self.ax = ax
                 self.canvas = ax.figure.canvas
-                self.collection = collection
-                self.alpha_other = alpha_other
-
-                self.xys = collection.get_offsets()
-                self.Npts = len(self.xys)
-
-                # Ensure that we have separate colors for each object
-                self.fc = collection.get_facecolors()
-                if len(self.fc) == 0:
-                    raise ValueError('Collection must have a facecolor')
-                elif len(self.fc) == 1:
-                    self.fc = np.tile(self.fc, (self.Npts, 1))
+                self.x = np.asarray(x, dtype=float)
+                self.y = np.asarray(y, dtype=float)
+                self.index = SortedXIndex(self.x, self.y)
+
+                # decimated view of the data and the selected points drawn over it
+                self.points = ax.scatter([], [], alpha=0.3)
+                self.selected = ax.scatter([], [], color='darkorange')
+                ax.set_xlim(np.nanmin(self.x), np.nanmax(self.x))
+                ax.set_ylim(np.nanmin(self.y), np.nanmax(self.y))
+                self.update_view()
+                ax.callbacks.connect('xlim_changed', self.update_view)
 
                 self.lasso = LassoSelector(ax, onselect=self.onselect)
-                self.ind = []
+                self.ind = np.array([], dtype=int)
+
+            def update_view(self, ax=None):
+                x_min, x_max = self.ax.get_xlim()
+                visible = self.index.query_bbox(x_min, x_max)
+                shown = visible[decimate_minmax(self.x[visible], self.y[visible], PickPointsPlot.MAX_DISPLAYED_POINTS // 2)]
+                self.points.set_offsets(np.column_stack((self.x[shown], self.y[shown])))
+                self.points.set_sizes([min(20, max(1, 4000/max(len(shown), 1)))])
 
             def onselect(self, verts):
-                path = Path(verts)
-                self.ind = np.nonzero(path.contains_points(self.xys))[0]
-                self.fc[:, -1] = self.alpha_other
-                self.fc[self.ind, -1] = 1
-                self.collection.set_facecolors(self.fc)
+                self.ind = self.index.query_path(Path(verts))
+                self.selected.set_offsets(np.column_stack((self.x[self.ind], self.y[self.ind])))
+                self.selected.set_sizes(self.points.get_sizes())
                 self.canvas.draw_idle()
 
+            def get_selected_points(self):
+                return np.column_stack((self.x[self.ind], self.y[self.ind]))
+
             def disconnect(self):
                 self.lasso.disconnect_events()
-                self.fc[:, -1] = 1
-                self.collection.set_facecolors(self.fc)
+                self.selected.set_offsets(np.empty((0, 2)))
                 self.canvas.draw_idle()
         
         fig, ax = plt.subplots(figsize=(15,7))
 
-        pts = ax.scatter(x, y, s=4000/len(y))
-
-        selector = SelectFromCollection(ax, pts)
+        selector = SelectFromIndex(ax, x, y)
 
         selected_pts = []
 
         def accept(event, selected_pts):
             if event.key == "enter":
                 print("Selected points:")
-                print(selector.xys[selector.ind])
-                for point in selector.xys[selector.ind].data:
+                print(selector.get_selected_points())
+                for point in selector.get_selected_points():
                     selected_pts.append(point)
                 fig.canvas.draw()
             
@@ -118,13 +232,17 @@ class PickPointsPlot:
         return selected_pts
         
 
-def plot_timeseries(xy_pais: dict):
-    _, ax_perim = plt.subplots(figsize=(15,7))
+@PROFILER.instrument('plot.plot_timeseries', lambda result, args, kwargs: {'series': len(args[0]), 'rows': len(args[0]['rf'][0])})
+def plot_timeseries(xy_pais: dict, output_file: str = None, decimate: bool = True):
+    fig, ax_perim = plt.subplots(figsize=(15,7))
     ax_rf = ax_perim.twinx()
+    # long series are drawn decimated to the figure width
+    perim_plot = DecimatedPlot(ax_perim, enabled=decimate)
+    rf_plot = DecimatedPlot(ax_rf, enabled=decimate)
     
-    plot1 = ax_perim.plot(xy_pais['perimeter'][0], xy_pais['perimeter'][1], color='darkorange', label='Perímetro')
-    plot2 = ax_rf.plot(xy_pais['rf'][0], xy_pais['rf'][1], color='darkblue', label='RF')
-    plot3 = ax_rf.plot(xy_pais['resíduo'][0], xy_pais['resíduo'][1], color='green', label='Resíduo')
+    plot1 = [perim_plot.plot(xy_pais['perimeter'][0], xy_pais['perimeter'][1], color='darkorange', label='Perímetro')]
+    plot2 = [rf_plot.plot(xy_pais['rf'][0], xy_pais['rf'][1], color='darkblue', label='RF')]
+    plot3 = [rf_plot.plot(xy_pais['resíduo'][0], xy_pais['resíduo'][1], color='green', label='Resíduo')]
 
     ax_perim.set_ylabel(u"\u03bcm")
     ax_rf.set_ylabel('Hz')
@@ -145,14 +263,17 @@ def plot_timeseries(xy_pais: dict):
     ax_perim.xaxis.set_major_formatter(formatter)
     ax_perim.tick_params(axis='both')
     ax_perim.grid()
-    plt.show()
+    show_or_save(fig, output_file)
 
-def plot_rf(xy_pais: dict):
+@PROFILER.instrument('plot.plot_rf', lambda result, args, kwargs: {'series': len(args[0]), 'rows': len(args[0]['rf'][0])})
+def plot_rf(xy_pais: dict, output_file: str = None, decimate: bool = True):
     fig, ax = plt.subplots(figsize=(15,7))
+    # long series are drawn decimated to the figure width
+    plot = DecimatedPlot(ax, enabled=decimate)
     
-    ax.plot(xy_pais['temp'][0], xy_pais['temp'][1], color='darkorange', label='Efeito da temperatura + maré')
-    ax.plot(xy_pais['poço'][0], xy_pais['poço'][1], color='green', label='Efeito do poço')
-    ax.plot(xy_pais['rf'][0], xy_pais['rf'][1], color='darkblue', label='RF')
+    plot.plot(xy_pais['temp'][0], xy_pais['temp'][1], color='darkorange', label='Efeito da temperatura + maré')
+    plot.plot(xy_pais['poço'][0], xy_pais['poço'][1], color='green', label='Efeito do poço')
+    plot.plot(xy_pais['rf'][0], xy_pais['rf'][1], color='darkblue', label='RF')
 
     ax.set_ylabel('Hz')
 
@@ -167,7 +288,29 @@ def plot_rf(xy_pais: dict):
     ax.tick_params(axis='both')
     ax.grid()
     fig.tight_layout()
-    plt.show()
+    show_or_save(fig, output_file)
+
+@PROFILER.instrument('plot.plot_lines', lambda result, args, kwargs: {'series': len(args[0])})
+def plot_lines(xy_pais: dict, ylabel: str = 'Hz', output_file: str = None, decimate: bool = True):
+    """ one line per key of xy_pais, labeled with the key """
+    fig, ax = plt.subplots(figsize=(15,7))
+    # long series are drawn decimated to the figure width
+    plot = DecimatedPlot(ax, enabled=decimate)
+    for label, (x, y) in xy_pais.items():
+        plot.plot(x, y, label=label)
+
+    ax.set_ylabel(ylabel)
+    ax.legend()
+
+    ax.yaxis.labelpad = 10
+    locator = mdates.AutoDateLocator(minticks=5, maxticks=10)
+    formatter = mdates.ConciseDateFormatter(locator)
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(formatter)
+    ax.tick_params(axis='both')
+    ax.grid()
+    fig.tight_layout()
+    show_or_save(fig, output_file)
 
 def plot_fft(fft_data: list, labels: list):
     fig, ax = plt.subplots()
@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+
+# status of a pv from the fraction of its records flagged
+STATUS_OK = 'ok'
+STATUS_DEGRADED = 'degraded'
+STATUS_EXCLUDED = 'excluded'
+# smallest temperature change stored for the sensors, in degrees Celsius
+SENSOR_RESOLUTION = 0.01
+
+
+class SensorQuality:
+    """ data quality checks run at once over the whole (time x pv) array of raw temperatures: gaps (missing
+        records), values out of valid_range (e.g. the zeros put in place of pvs without data), flatlines (records
+        ending a run of flatline_records consecutive records spanning no more than flatline_tolerance, the sensor
+        resolution by default, as a stuck sensor) and jumps (changes larger than max_jump from the previous valid
+        record, as spikes). Each pv gets a weight at each record: one minus its fraction of flagged records so far
+        (over at least min_records), or zero above max_bad_fraction.
+        Consecutive blocks of a timespam (chunked runs, live polls) are checked as a single one: the instance keeps
+        the last records of the previous calls, their flags and the counts, every check only looks back, and the
+        gaps at the end of a block are told and filled with the records following it (lookahead), if given """
+
+    def __init__(self, valid_range: tuple = (0.5, 60), flatline_records: int = 1440, flatline_tolerance: float = SENSOR_RESOLUTION,
+                 max_jump: float = 1, max_bad_fraction: float = 0.5, max_fill_records: int = 60, min_records: int = 1440) -> None:
+        """ temperatures in degrees Celsius, records of 1 minute """
+        self.valid_range = valid_range
+        self.flatline_records = flatline_records
+        self.flatline_tolerance = flatline_tolerance
+        self.max_jump = max_jump
+        self.max_bad_fraction = max_bad_fraction
+        self.max_fill_records = max_fill_records
+        self.min_records = min_records
+        self.reset()
+
+    def reset(self) -> None:
+        # state carried between consecutive calls: the last raw records and their flags, the last valid value of
+        # each pv and the number of records checked and flagged
+        self.tail_values, self.tail_mask = None, None
+        self.last_valid = None
+        self.records, self.flagged = 0, None
+
+    def get_context_records(self) -> int:
+        """ records kept from the previous calls: a whole flatline window and a whole fillable gap with its ends """
+        return max(self.flatline_records - 1, self.max_fill_records + 1)
+
+    def get_lookahead_records(self) -> int:
+        """ records after a block needed to tell and fill the gaps at its end """
+        return self.max_fill_records + 1
+
+    @staticmethod
+    def detect_flatlines(values: np.ndarray, records: int, tolerance: float) -> np.ndarray:
+        """ records (time x pv) ending a window of 'records' records whose range (max - min) does not exceed
+            tolerance, i.e. once the sensor stayed that long within it: with the sensor resolution, a sensor
+            alternating between two consecutive stored values is stuck as well """
+        if records < 2 or len(values) < records:
+            return np.zeros(values.shape, dtype=bool)
+        frame = pd.DataFrame(values)
+        span = (frame.rolling(records).max() - frame.rolling(records).min()).values
+        # the margin absorbs the rounding of values stored with the resolution
+        with np.errstate(invalid='ignore'):
+            return span <= tolerance * (1 + 1e-6)
+
+    @staticmethod
+    def detect_jumps(values: np.ndarray, max_jump: float, previous: np.ndarray = None) -> np.ndarray:
+        """ records (time x pv) differing by more than max_jump from the previous valid one, previous holding the
+            last valid value of each pv before values (NaN if none); the first valid record, which is used as
+            reference, is compared to the next one """
+        if previous is not None:
+            values = np.vstack((previous, values))
+        frame = pd.DataFrame(values)
+        preceding = frame.ffill().shift(1).values
+        preceding = np.where(np.isnan(preceding), frame.bfill().shift(-1).values, preceding)
+        with np.errstate(invalid='ignore'):
+            jumps = np.abs(values - preceding) > max_jump
+        return jumps if previous is None else jumps[1:]
+
+    def get_state(self, name: str, columns, fill_value) -> np.ndarray:
+        """ state kept per pv, aligned to the pvs of the current call """
+        state = getattr(self, name)
+        if state is None:
+            return None
+        return state.reindex(columns=columns, fill_value=fill_value).values if isinstance(state, pd.DataFrame) else \
+            state.reindex(columns, fill_value=fill_value).values
+
+    def apply(self, data: pd.DataFrame, lookahead: pd.DataFrame = None) -> tuple:
+        """ checks the records of data (time x pv), following those of the previous calls; returns the data with
+            the flagged records discarded, or interpolated in time when the gap is no longer than max_fill_records
+            (so that the mean of a sector does not jump when one of its pvs is missing for a while), the health
+            table (one row per pv), the mask of the flagged records (True where flagged) and the weight of each pv
+            at each record. Excluded pvs are emptied. lookahead holds the records following data, if available """
+        columns, n_pvs = data.columns, data.shape[1]
+        tail = self.get_state('tail_values', columns, np.nan)
+        tail = np.empty((0, n_pvs)) if tail is None else tail
+        ahead = np.empty((0, n_pvs)) if lookahead is None else lookahead.reindex(columns=columns).values
+        values = np.vstack((tail, data.values, ahead)).astype(float)
+        start, end = len(tail), len(tail) + len(data)
+
+        gaps = np.isnan(values)
+        with np.errstate(invalid='ignore'):
+            out_of_range = (values < self.valid_range[0]) | (values > self.valid_range[1])
+        flatlines = SensorQuality.detect_flatlines(values, self.flatline_records, self.flatline_tolerance) & ~gaps
+        jumps = np.zeros(values.shape, dtype=bool)
+        jumps[start:] = SensorQuality.detect_jumps(values[start:], self.max_jump, self.get_state('last_valid', columns, np.nan))
+        mask = gaps | out_of_range | flatlines | jumps
+        # the records of the previous calls keep their flags
+        mask[:start] = self.get_state('tail_mask', columns, True)
+
+        # fraction of flagged records up to each one
+        flagged = self.get_state('flagged', columns, 0)
+        flagged = np.cumsum(mask[start:end], axis=0) + (0 if flagged is None else flagged)
+        counted = np.maximum(self.records + np.arange(1, len(data) + 1), self.min_records)
+        bad_fraction = flagged / counted[:, None]
+        weights = np.where(bad_fraction > self.max_bad_fraction, 0, 1 - bad_fraction)
+
+        # gaps interpolated over the records around the block, as over a single one
+        missing = mask
+        short_gaps = missing & (SensorQuality.get_gap_lengths(missing) <= self.max_fill_records)
+        filled = pd.DataFrame(np.where(missing, np.nan, values)).interpolate(limit_direction='both').values
+        filled = np.where(~missing | short_gaps, filled, np.nan)[start:end]
+        filled[weights == 0] = np.nan
+
+        rows = slice(start, end)
+        fraction = lambda flags: flags[rows].mean(axis=0) if len(data) else np.zeros(n_pvs)
+        current_fraction = bad_fraction[-1] if len(data) else np.zeros(n_pvs)
+        current_weight = weights[-1] if len(data) else np.ones(n_pvs)
+        health = pd.DataFrame({'gap_fraction': fraction(gaps), 'out_of_range_fraction': fraction(out_of_range),
+                               'flatline_fraction': fraction(flatlines), 'jumps': jumps[rows].sum(axis=0),
+                               'bad_fraction': current_fraction, 'weight': current_weight,
+                               'status': np.where(current_weight == 0, STATUS_EXCLUDED,
+                                                  np.where(mask[rows].any(axis=0), STATUS_DEGRADED, STATUS_OK))},
+                              index=columns)
+
+        # state for the next call
+        context = self.get_context_records()
+        self.tail_values = pd.DataFrame(values[:end][-context:], columns=columns)
+        self.tail_mask = pd.DataFrame(mask[:end][-context:], columns=columns)
+        last_valid = pd.DataFrame(values[:end]).ffill().values[-1] if end else np.full(n_pvs, np.nan)
+        self.last_valid = pd.Series(last_valid, index=columns)
+        if len(data):
+            self.flagged = pd.Series(flagged[-1], index=columns)
+        self.records += len(data)
+
+        return (pd.DataFrame(filled, index=data.index, columns=columns), health,
+                pd.DataFrame(mask[rows], index=data.index, columns=columns), pd.DataFrame(weights, index=data.index, columns=columns))
+
+    @staticmethod
+    def get_gap_lengths(missing: np.ndarray) -> np.ndarray:
+        """ length of the run of missing records each record belongs to (time x pv, 0 where not missing) """
+        positions = np.arange(len(missing))[:, None]
+        previous = np.maximum.accumulate(np.where(missing, -1, positions), axis=0)
+        following = np.minimum.accumulate(np.where(missing, len(missing), positions)[::-1], axis=0)[::-1]
+        return np.where(missing, following - previous - 1, 0)
+
+    @staticmethod
+    def weighted_mean(data: pd.DataFrame, weights: pd.DataFrame) -> pd.Series:
+        """ mean over the columns weighted by the weight of each pv at each record (time x pv), ignoring missing
+            records (NaN where none is left) """
+        weights = weights.reindex(index=data.index, columns=data.columns).fillna(1).values
+        valid_weights = data.notna().values * weights
+        total = valid_weights.sum(axis=1)
+        weighted_sum = (np.nan_to_num(data.values) * valid_weights).sum(axis=1)
+        mean = np.divide(weighted_sum, total, out=np.full(len(data), np.nan), where=total > 0)
+        return pd.Series(mean, index=data.index)
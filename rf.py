@@ -10,10 +10,12 @@ class RF:
     data_source: str
     timespam: dict
 
-    def __init__(self, data_source, timespam: dict = None, filepath: str = None) -> None:
+    def __init__(self, data_source, timespam: dict = None, filepath: str = None, reference: pd.Series = None) -> None:
         self.data_source = data_source
         self.timespam = timespam
         self.filepath = filepath
+        # first record used as reference; passing the one from a previous timespam keeps consecutive loads consistent
+        self.reference = reference
         self.load_data()
     
     def get_local_data(self) -> pd.DataFrame:
@@ -33,7 +35,9 @@ class RF:
             self.data = self.get_local_data()
         elif (self.data_source == 'archiver'):
             self.data = self.get_data_from_archiver()
-        self.data = self.data - self.data.iloc[0,:]
+        if self.reference is None:
+            self.reference = self.data.iloc[0,:]
+        self.data = self.data - self.reference
 
     def get_data(self) -> pd.DataFrame:
         return self.data
\ No newline at end of file
@@ -0,0 +1,152 @@
+import os
+import json
+import pickle
+from typing import List
+import pandas as pd
+
+from instrumentation import PROFILER
+
+STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results_store')
+
+# bucket of each aggregate level and the time span of the files (chunks) it is split in
+LEVELS = {
+    'raw': {'bucket': None, 'chunk': '%Y-%m-%d'},
+    'minute': {'bucket': pd.Timedelta(minutes=1), 'chunk': '%Y-%m-%d'},
+    'hour': {'bucket': pd.Timedelta(hours=1), 'chunk': '%Y-%m'},
+    'day': {'bucket': pd.Timedelta(days=1), 'chunk': '%Y'},
+}
+STATISTICS = ['mean', 'min', 'max', 'count']
+
+
+class ResultsStore:
+    """ append-only store of time-indexed results (e.g. perimeter, model, well_contrib) split in chunk files,
+        with mean/min/max aggregates per minute, hour and day built on every append, so that any time range
+        can be read at a resolution matching the number of points needed """
+
+    def __init__(self, store_dir: str = STORE_DIR) -> None:
+        self.store_dir = store_dir
+        for level in LEVELS:
+            os.makedirs(os.path.join(self.store_dir, level), exist_ok=True)
+        self.metadata_path = os.path.join(self.store_dir, 'metadata.json')
+        self.metadata = {'last_timestamp': None, 'columns': None}
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path) as f:
+                self.metadata = json.load(f)
+
+    def get_last_timestamp(self) -> pd.Timestamp:
+        return pd.Timestamp(self.metadata['last_timestamp']) if self.metadata['last_timestamp'] else None
+
+    def get_chunk_path(self, level: str, key: str) -> str:
+        return os.path.join(self.store_dir, level, f'{key}.pkl')
+
+    def list_chunks(self, level: str) -> List:
+        return sorted(filename[:-4] for filename in os.listdir(os.path.join(self.store_dir, level)) if filename.endswith('.pkl'))
+
+    def read_chunk(self, level: str, key: str) -> pd.DataFrame:
+        with open(self.get_chunk_path(level, key), 'rb') as f:
+            return pickle.load(f)
+
+    def write_chunk(self, level: str, key: str, frame: pd.DataFrame) -> None:
+        # writing to a temporary file first, so a killed run never leaves a truncated chunk
+        path = self.get_chunk_path(level, key)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(frame, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def write_rows(self, level: str, frame: pd.DataFrame) -> None:
+        """ writes rows to their chunks, replacing the rows of the chunks from the first new timestamp on """
+        keys = frame.index.strftime(LEVELS[level]['chunk'])
+        for key, rows in frame.groupby(keys):
+            if os.path.exists(self.get_chunk_path(level, key)):
+                existing = self.read_chunk(level, key)
+                rows = pd.concat([existing[existing.index < rows.index[0]], rows])
+            self.write_chunk(level, key, rows)
+
+    def read(self, level: str, start: pd.Timestamp = None, end: pd.Timestamp = None) -> pd.DataFrame:
+        """ rows of a level within [start, end], reading only the chunks that overlap it """
+        chunk_format = LEVELS[level]['chunk']
+        keys = self.list_chunks(level)
+        if start is not None:
+            keys = [key for key in keys if key >= start.strftime(chunk_format)]
+        if end is not None:
+            keys = [key for key in keys if key <= end.strftime(chunk_format)]
+        if not keys:
+            return pd.DataFrame()
+        frame = pd.concat([self.read_chunk(level, key) for key in keys])
+        if start is not None:
+            frame = frame[frame.index >= start]
+        if end is not None:
+            frame = frame[frame.index <= end]
+        return frame
+
+    @staticmethod
+    def aggregate(frame: pd.DataFrame, bucket: pd.Timedelta) -> pd.DataFrame:
+        """ mean, min, max and count of every column per bucket; columns are (variable, statistic) """
+        return frame.groupby(frame.index.floor(bucket)).agg(STATISTICS)
+
+    @PROFILER.instrument('store.append', lambda result, args, kwargs: {'rows': len(args[1])})
+    def append(self, results: pd.DataFrame) -> None:
+        """ appends records newer than the last stored one and updates the aggregates they fall in """
+        if results.empty:
+            return
+        results = results.sort_index()
+        last_timestamp = self.get_last_timestamp()
+        if last_timestamp is not None and results.index[0] <= last_timestamp:
+            raise ValueError(f'the results store is append-only: {results.index[0]} is not after {last_timestamp}')
+        if self.metadata['columns'] is not None and list(results.columns) != self.metadata['columns']:
+            raise ValueError(f"columns {list(results.columns)} differ from the stored ones {self.metadata['columns']}")
+
+        self.write_rows('raw', results)
+        # only the buckets touched by the new records are recalculated, from the raw records
+        for level, definition in LEVELS.items():
+            if definition['bucket'] is None:
+                continue
+            bucket_start = results.index[0].floor(definition['bucket'])
+            records = results if bucket_start == results.index[0] else self.read('raw', bucket_start)
+            self.write_rows(level, ResultsStore.aggregate(records, definition['bucket']))
+
+        self.metadata = {'last_timestamp': results.index[-1].isoformat(), 'columns': list(results.columns)}
+        with open(self.metadata_path + '.tmp', 'w') as f:
+            json.dump(self.metadata, f)
+        os.replace(self.metadata_path + '.tmp', self.metadata_path)
+
+    @PROFILER.instrument('store.query', lambda result, args, kwargs: {'rows': len(result)})
+    def query(self, start=None, end=None, resolution: str = 'auto', max_points: int = 2000, columns: List = None) -> pd.DataFrame:
+        """ records within [start, end] at the given level ('raw', 'minute', 'hour' or 'day'); with 'auto', the
+            finest level giving at most max_points buckets. Aggregated levels have (variable, statistic) columns """
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else self.get_last_timestamp()
+        if resolution == 'auto':
+            resolution = self.choose_resolution(start, end, max_points)
+        frame = self.read(resolution, start, end)
+        if columns is not None and not frame.empty:
+            frame = frame[columns]
+        return frame
+
+    def choose_resolution(self, start: pd.Timestamp, end: pd.Timestamp, max_points: int) -> str:
+        if start is None:
+            keys = self.list_chunks('raw')
+            start = self.read_chunk('raw', keys[0]).index[0] if keys else end
+        span = (end - start) if end is not None else pd.Timedelta(0)
+        # raw records are acquired every minute
+        if span / pd.Timedelta(minutes=1) <= max_points:
+            return 'raw'
+        for level, definition in LEVELS.items():
+            if definition['bucket'] is not None and span / definition['bucket'] <= max_points:
+                return level
+        return 'day'
+
+
+if __name__ == "__main__":
+    # user definitions
+    start = '2021-09-01'
+    end = '2021-12-01'
+
+    store = ResultsStore()
+    data = store.query(start, end)
+    print(data)
+
+    from plot import plot_lines
+    variable = 'well_contrib'
+    series = data[variable] if not isinstance(data.columns, pd.MultiIndex) else data[variable]['mean']
+    plot_lines({variable: [series.index, series.values]})
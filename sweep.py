@@ -0,0 +1,134 @@
+import os
+import ctypes
+from typing import Dict, List
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+import pandas as pd
+
+from instrumentation import PROFILER
+from interpolation import RingInterpolator
+from perimeter import Perimeter
+from timeseries import TimeSeriesArray
+
+
+class LayoutSweep:
+    """ perimeter evolution predicted by many node layouts (number and angular position of the nodes) for the
+        same deformation: the radial thermal deformation, known at the temperature nodes, and the tidal
+        displacements, known at the tide stations, are interpolated along the ring onto the nodes of each layout.
+        The deformation arrays are placed once in shared memory and the layouts are evaluated by a pool of workers """
+
+    # arrays attached by each worker process
+    worker_arrays: Dict = {}
+
+    def __init__(self, temp_deformation: pd.DataFrame or TimeSeriesArray, temp_directions: Dict, tides_deformation: Dict or TimeSeriesArray = None,
+                 tides_directions: Dict = None, tides_sign: float = 1) -> None:
+        temp_deformation = TimeSeriesArray.from_any(temp_deformation)
+        self.index = temp_deformation.index
+        self.temp_directions = [temp_directions[node] for node in temp_deformation.stations]
+        self.tides_sign = tides_sign
+        self.arrays = {'radial': temp_deformation.values[:, :, 0].astype(float)}
+        self.tides_directions = None
+        if tides_deformation is not None:
+            tides_deformation = TimeSeriesArray.from_any(tides_deformation, ['East', 'North', 'Up'])
+            tides_deformation = tides_deformation.reindex_nearest(self.index).select(components=['East', 'North', 'Up'])
+            self.tides_directions = [tides_directions[station] for station in tides_deformation.stations]
+            self.arrays['tides'] = tides_deformation.values
+
+    @staticmethod
+    def generate_even_layout(n_nodes: int, offset: float = 0) -> List:
+        return list(offset + np.arange(n_nodes) * 360 / n_nodes)
+
+    @staticmethod
+    def generate_layout_from_distances(inter_distances: List, quadrants: int = 4) -> List:
+        """ same construction as main.generate_node_temp_directions: the distances between consecutive nodes
+            of one quadrant, along the circumference, repeated in every quadrant """
+        arc_length = Perimeter.REAL_PERIMETER/quadrants
+        distances_one_quad = np.concatenate(([0], np.cumsum(inter_distances[:-1])))
+        distances = np.concatenate([distances_one_quad + i*arc_length for i in range(quadrants)])
+        return list(distances / Perimeter.REAL_PERIMETER * 360)
+
+    @staticmethod
+    def attach_worker(descriptions: Dict) -> None:
+        """ pool initializer: maps the shared memory blocks as arrays, without copying them """
+        LayoutSweep.worker_arrays = {}
+        for name, (block, shape, dtype) in descriptions.items():
+            LayoutSweep.worker_arrays[name] = np.frombuffer(block, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+    @staticmethod
+    def evaluate_layout(task: Dict) -> np.ndarray:
+        """ delta perimeter, in microns, of one layout """
+        arrays = LayoutSweep.worker_arrays
+        directions = np.asarray(task['directions'], dtype=float)
+        perimeter = Perimeter(list(range(len(directions))), list(directions))
+
+        radial = RingInterpolator(task['temp_directions'], directions).apply(arrays['radial'])
+        station_data, tides_matrix = None, None
+        if 'tides' in arrays:
+            station_data = arrays['tides']
+            tides_matrix = RingInterpolator(task['tides_directions'], directions).matrix
+        return Perimeter.calc_delta_perimeter_series(perimeter.pair_vectors, perimeter.radial_vectors, radial, station_data, tides_matrix,
+                                                     task['tides_sign'], task['block_size']) * 1e6
+
+    @PROFILER.instrument('sweep.run', lambda result, args, kwargs: {'rows': len(result), 'layouts': result.shape[1]})
+    def run(self, layouts: Dict, processes: int = None, block_size: int = 100000) -> pd.DataFrame:
+        """ layouts maps a name to the node directions (degrees from East, in ring order);
+            returns the delta perimeter, in microns, of each layout (time x layout) """
+        processes = min(processes or os.cpu_count(), len(layouts))
+        tasks = [{'directions': directions, 'temp_directions': self.temp_directions, 'tides_directions': self.tides_directions,
+                  'tides_sign': self.tides_sign, 'block_size': block_size} for directions in layouts.values()]
+
+        # copying the deformation to shared memory once, for all the workers (sharedctypes rather than
+        # shared_memory, which needs python 3.8, as the geodesics extension is built for 3.7); the blocks are
+        # inherited by the workers when they start and freed with the last reference to them
+        descriptions = {}
+        for name, array in self.arrays.items():
+            block = RawArray(ctypes.c_byte, max(1, array.nbytes))
+            np.frombuffer(block, dtype=array.dtype, count=array.size).reshape(array.shape)[:] = array
+            descriptions[name] = (block, array.shape, array.dtype)
+
+        if processes > 1:
+            with Pool(processes, initializer=LayoutSweep.attach_worker, initargs=(descriptions,)) as pool:
+                results = pool.map(LayoutSweep.evaluate_layout, tasks)
+        else:
+            LayoutSweep.attach_worker(descriptions)
+            results = [LayoutSweep.evaluate_layout(task) for task in tasks]
+            LayoutSweep.worker_arrays = {}
+
+        return pd.DataFrame(np.column_stack(results), index=self.index, columns=list(layouts))
+
+
+if __name__ == "__main__":
+    from main import (POINT_NAMES_TIDES, TIDES_SIGN, create_temperature_deformation_data, create_tides_data,
+                      get_node_temp_directions, generate_node_tides_directions)
+    from temp import TemperatureDeformation
+
+    # user definitions
+    use_tides = True
+
+    temp_options = {
+        'data_source': 'archiver',
+        'which_temp': 'concrete',
+        'combination_params': ['A', 'N']
+    }
+
+    timespam = {
+        'init': {'day': 13,'month': 11, 'year': 2021,'hour': 0,'minute': 0,'second': 0},
+        'end': {'day': 14,'month': 11, 'year': 2021,'hour': 10,'minute': 0,'second': 0}
+    }
+
+    layouts = {'current': LayoutSweep.generate_layout_from_distances([14.8, 11.1, 14.8, 11.1, 11.1, 14.8, 14.8, 11.1, 14.8, 11.1]),
+               'tides stations': generate_node_tides_directions()}
+    for n_nodes in [8, 16, 40, 80, 160]:
+        layouts[f'even {n_nodes}'] = LayoutSweep.generate_even_layout(n_nodes)
+
+    node_directions = get_node_temp_directions()
+    temp_data = create_temperature_deformation_data(TemperatureDeformation(timespam=timespam, node_directions=node_directions, **temp_options))
+    tides_data = create_tides_data(POINT_NAMES_TIDES, timespam) if use_tides else None
+
+    sweep = LayoutSweep(temp_data, node_directions, tides_data, dict(zip(POINT_NAMES_TIDES, generate_node_tides_directions())), TIDES_SIGN)
+    results = sweep.run(layouts)
+    print(results.describe().T)
+
+    from plot import plot_lines
+    plot_lines({name: [results.index, results[name].values] for name in results.columns}, ylabel=u"\u03bcm")
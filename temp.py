@@ -1,13 +1,18 @@
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 import numpy as np
 import pandas as pd
 import asyncio
 from functools import partial
+from datetime import timedelta
 
 from archiver import Archiver
 from perimeter import Perimeter
-from plot import LegendPickablePlot
+from interpolation import RingNodeOperator
+from quality import SensorQuality
+from instrumentation import PROFILER, count_frame
+from timeseries import TimeSeriesArray
+
+# concrete's thermal coeficient
+THERMAL_COEFFICIENT = 12e-6
 
 MAPPING_CARDINAL_SECTOR = {
     "concrete":
@@ -48,24 +53,19 @@ MAPPING_CARDINAL_SECTOR = {
         20: "SE",
         18: "ESE"
     },
+    # each fancoil covers a range of sectors, some of them spanning two cardinals
     "fancoil":
     {
-        "16-18": "E",
-        "16-18": "ENE",
-        "14-16": "NE",
-        "12-14": "NNE",
-        "12-14": "N",
-        "10-12": "NNW",
-        "10-12": "NW",
-        "08-10": "WNW",
-        "06-08": "W",
-        "06-08": "WSW",
-        "04-06": "SW",
-        "02-04": "SSW",
-        "02-04": "S", 
-        "20-22": "SSE",
-        "20-22": "SE",
-        "18-20": "ESE"
+        "16-18": ["E", "ENE"],
+        "14-16": ["NE"],
+        "12-14": ["NNE", "N"],
+        "10-12": ["NNW", "NW"],
+        "08-10": ["WNW"],
+        "06-08": ["W", "WSW"],
+        "04-06": ["SW"],
+        "02-04": ["SSW", "S"],
+        "20-22": ["SSE", "SE"],
+        "18-20": ["ESE"]
     }
 }
 
@@ -538,13 +538,25 @@ PVS = {
 }
 
 class TemperatureDeformation:
-    def __init__(self, data_source: str, which_temp: str, timespam: dict = None, concrete_pvs_combination: str = None, filepath: str = None, combination_params: list = None ) -> None:
+    def __init__(self, data_source: str, which_temp: str, timespam: dict = None, concrete_pvs_combination: str = None, filepath: str = None, combination_params: list = None,
+                 node_directions: dict = None, quality: SensorQuality or bool = True) -> None:
         self.filepath = filepath
         self.which_temp = which_temp
         self.data_source = data_source
         self.timespam = timespam
         self.concrete_pvs_combination = concrete_pvs_combination
         self.combination_params = combination_params
+        # first record of the first loaded timespam, kept when the instance is reused for consecutive timespams
+        self.temp_reference = None
+        # angular position of each ring node: if given, nodes without data are interpolated from their neighbours instead of dropped
+        self.node_directions = node_directions
+        self.node_operator = RingNodeOperator(list(node_directions.values())) if node_directions else None
+        # checks of the raw pvs (default SensorQuality if True, none if False): flagged records are discarded and
+        # the pvs of a sector are averaged with their weights; the report of the last loaded timespam is kept
+        self.quality = SensorQuality() if quality is True else (quality or None)
+        self.quality_report = None
+        self.quality_mask = None
+        self.sensor_weights = None
 
     def get_local_data(self) -> pd.DataFrame:
         temp_data = pd.read_excel(self.filepath)
@@ -570,65 +582,134 @@ class TemperatureDeformation:
 
         return pvs_list
 
-    def get_data_from_archiver(self) -> pd.DataFrame:
+    def get_data_from_archiver(self) -> tuple:
+        """ pvs over the timespam and, for the quality checks, over the records following it (None without checks) """
         # pvs = PVS[self.which_temp] if self.concrete_pvs_combination is None else PVS[self.which_temp][self.concrete_pvs_combination]
         pvs = self.resolve_pvs()
-        temp_data = asyncio.run(Archiver.request_data(pvs, self.timespam, 1))
-        return temp_data
+        if self.quality is None:
+            return asyncio.run(Archiver.request_data(pvs, self.timespam, 1)), None
+        return tuple(asyncio.run(TemperatureDeformation.request_with_lookahead(pvs, self.timespam, self.quality.get_lookahead_records())))
+
+    @staticmethod
+    def get_lookahead_timespam(timespam: dict, records: int) -> dict:
+        """ the records (of 1 minute) following the timespam """
+        _, datetime_end = Archiver.timespam_to_datetimes(timespam)
+        return Archiver.datetimes_to_timespam(datetime_end, datetime_end + timedelta(minutes=records))
+
+    @staticmethod
+    async def request_with_lookahead(pvs: list, timespam: dict, records: int) -> list:
+        return await asyncio.gather(Archiver.request_data(pvs, timespam, 1),
+                                    Archiver.request_data(pvs, TemperatureDeformation.get_lookahead_timespam(timespam, records), 1))
     
     
-    def load_temp_data(self) -> None:
+    @PROFILER.instrument('temp.load_temp_data', lambda result, args, kwargs: count_frame(args[0].temp_data))
+    def load_temp_data(self, data: pd.DataFrame or TimeSeriesArray = None, lookahead: pd.DataFrame = None) -> None:
+        """ loads the pvs from the data source, or takes them from data (time x pv) if given, with lookahead
+            holding the records following them, if available (see SensorQuality.apply) """
         # creating custom combination if it is the case
         if (not self.combination_params is None):
             self.generate_custom_pvs_combination()
 
         # extracting data from specified source
-        if (self.data_source == 'local'):
+        if data is not None:
+            self.temp_data = data.to_wide() if isinstance(data, TimeSeriesArray) else data
+        elif (self.data_source == 'local'):
             self.temp_data = self.get_local_data()
         elif (self.data_source == 'archiver'):
-            self.temp_data = self.get_data_from_archiver()
-        # referencing the first value
-        self.temp_data = self.temp_data - self.temp_data.iloc[0,:]
-        
+            self.temp_data, lookahead = self.get_data_from_archiver()
+        self.temp_data = self.reference_data(self.temp_data, lookahead)
+
         # calling general data treatment procedures
         self.treat_data()
 
+    def reference_data(self, data: pd.DataFrame, lookahead: pd.DataFrame = None) -> pd.DataFrame:
+        """ raw pvs (time x pv) checked and referenced to the first record ever loaded, updating the state kept
+            between consecutive loads """
+        if self.quality is not None:
+            data = self.check_quality(data, lookahead)
+        # referencing the first value
+        if self.temp_reference is None:
+            self.temp_reference = TemperatureDeformation.get_first_valid_record(data)
+        return data - self.temp_reference
+
+    def check_quality(self, data: pd.DataFrame, lookahead: pd.DataFrame = None) -> pd.DataFrame:
+        """ runs the quality checks on raw pvs (time x pv), following the previous loads, keeping the health
+            table, the mask and the weights, and returns the data with the flagged records discarded, or filled
+            when the gaps are short """
+        with PROFILER.measure('temp.check_quality', rows=data.shape[0], pvs=data.shape[1]) as record:
+            filled, self.quality_report, self.quality_mask, self.sensor_weights = self.quality.apply(data, lookahead)
+            record['excluded'] = int((self.quality_report['weight'] == 0).sum())
+            return filled
+
+    def advance(self, data: pd.DataFrame, lookahead: pd.DataFrame = None) -> None:
+        """ state kept between consecutive loads (quality checks, reference) after raw pvs (time x pv) loaded
+            elsewhere, e.g. by a worker process given a copy of the instance """
+        self.reference_data(data, lookahead)
+
+    @staticmethod
+    def get_first_valid_record(data: pd.DataFrame) -> pd.Series:
+        """ first value of each pv, skipping the missing (or discarded) ones """
+        return data.bfill().iloc[0,:]
+
     def treat_data(self):
-        mapping = MAPPING_CARDINAL_SECTOR[self.which_temp]
-        # simple mapping between sector and cardinals is needed
-        if self.which_temp != 'concrete':
-            for i, col in enumerate(self.temp_data.columns):
+        with PROFILER.measure('temp.treat_data', rows=self.temp_data.shape[0], pvs=self.temp_data.shape[1]) as record:
+            mapping = MAPPING_CARDINAL_SECTOR[self.which_temp]
+            # simple mapping between sector and cardinals is needed
+            if self.which_temp != 'concrete':
+                if self.sensor_weights is not None:
+                    # droping the excluded pvs
+                    self.temp_data = self.temp_data.loc[:, (self.sensor_weights.reindex(columns=self.temp_data.columns) != 0).any().values]
                 if self.which_temp == 'fancoil':
-                    sector_ref = col[-5:]
+                    get_sector_ref = lambda col: col[-5:]
                 elif self.which_temp == 'hls':
-                    sector_ref = int(col[3:5])
-                self.temp_data.columns.values[i] = mapping[sector_ref]
-        # applies a mean between specific columns and map sector to cardinal
-        else:
-            treated_data = self.temp_data.copy()
-            treated_data.drop(columns=self.temp_data.columns.values, inplace=True)
+                    get_sector_ref = lambda col: int(col[3:5])
+                self.temp_data = TemperatureDeformation.map_columns_to_cardinals(self.temp_data, mapping, get_sector_ref)
+            # applies a mean between specific columns and map sector to cardinal
+            else:
+                treated_data = self.temp_data.copy()
+                treated_data.drop(columns=self.temp_data.columns.values, inplace=True)
 
-            sector_pvs_relations = PVS[self.which_temp][self.concrete_pvs_combination] if self.combination_params is None else self.custom_comb
-            for sector in sector_pvs_relations:
-                pvs = sector_pvs_relations[sector]
-                try:
-                    column_name = mapping[sector]
-                except KeyError:
-                    column_name = sector
-                treated_data[column_name] = self.temp_data.loc[:, pvs].mean(axis='columns')
-            # droping columns that refers to positions without loaded pvs
-            treated_data.dropna(axis='columns', how='all', inplace=True)
-            self.temp_data = treated_data
-        
+                sector_pvs_relations = PVS[self.which_temp][self.concrete_pvs_combination] if self.combination_params is None else self.custom_comb
+                for sector in sector_pvs_relations:
+                    pvs = sector_pvs_relations[sector]
+                    try:
+                        column_name = mapping[sector]
+                    except KeyError:
+                        column_name = sector
+                    if self.sensor_weights is None:
+                        treated_data[column_name] = self.temp_data.loc[:, pvs].mean(axis='columns')
+                    else:
+                        treated_data[column_name] = SensorQuality.weighted_mean(self.temp_data.loc[:, pvs], self.sensor_weights)
+                if self.node_operator is not None and set(treated_data.columns) <= set(self.node_directions):
+                    # filling every node, and every gap of a node, along the ring
+                    nodes = list(self.node_directions)
+                    filled = self.node_operator.apply(treated_data.reindex(columns=nodes).values)
+                    treated_data = pd.DataFrame(filled, index=treated_data.index, columns=nodes)
+                else:
+                    # droping columns that refers to positions without loaded pvs
+                    treated_data.dropna(axis='columns', how='all', inplace=True)
+                self.temp_data = treated_data
+            record['nodes'] = self.temp_data.shape[1]
+
+    @staticmethod
+    def map_columns_to_cardinals(data: pd.DataFrame, mapping: dict, get_sector_ref) -> pd.DataFrame:
+        """ one column per cardinal; a pv whose sector maps to several cardinals (as a fancoil) is repeated in each """
+        cardinal_data = {}
+        for col in data.columns:
+            cardinals = mapping[get_sector_ref(col)]
+            for cardinal in ([cardinals] if isinstance(cardinals, str) else cardinals):
+                cardinal_data[cardinal] = data[col]
+        return pd.DataFrame(cardinal_data, index=data.index)
+
+    @staticmethod
+    def get_node_sectors(combination: str = 'all_sensors') -> dict:
+        """ concrete sector of each node, from the name of its pvs (e.g. TU-17S, sector 17) """
+        return {node: int(pvs[0][3:5]) for node, pvs in PVS['concrete'][combination].items()}
 
     def map_sector_to_cardinal(self):
         mapping = MAPPING_CARDINAL_SECTOR[self.which_temp]
-        for i, col in enumerate(self.temp_data.columns):
-            if (self.which_temp == 'concrete'):
-                sector_ref = int(col[3:5])
-            else:
-                sector_ref = col[-5:]
-            self.temp_data.columns.values[i] = mapping[sector_ref]
+        get_sector_ref = (lambda col: int(col[3:5])) if self.which_temp == 'concrete' else (lambda col: col[-5:])
+        self.temp_data = TemperatureDeformation.map_columns_to_cardinals(self.temp_data, mapping, get_sector_ref)
         
     def generate_custom_pvs_combination(self):
         base_comb = PVS['concrete']['all_sensors']
@@ -640,30 +721,43 @@ class TemperatureDeformation:
         self.custom_comb = custom_comb
 
 
-    def calculate_deformation(self) -> pd.DataFrame:
-        alpha = 12e-6 # concrete's thermal coeficient
+    def calculate_deformation(self, alpha: float = THERMAL_COEFFICIENT, inertia = None) -> pd.DataFrame:
+        """ radial deformation of each node; with a ThermalInertia, the temperatures are first convolved with its
+            impulse responses instead of deforming the slab instantly """
         r = Perimeter.REAL_PERIMETER/(2 * np.pi) # considering a linear section of the slab in the radial direction
-        self.def_data = self.temp_data.copy() * alpha * r
+        temp_data = self.temp_data if inertia is None else inertia.apply_frame(self.temp_data)
+        self.def_data = temp_data * (alpha * r)
         return self.def_data
 
-    def plot_temp(self, mode=None) -> None:
+    def get_deformation_array(self, dtype = None) -> TimeSeriesArray:
+        """ last calculated deformation as a (time x node x 1) array """
+        return TimeSeriesArray.from_frame(self.def_data, 'radial', dtype)
+
+    @PROFILER.instrument('temp.plot_temp', lambda result, args, kwargs: count_frame(args[0].temp_data))
+    def plot_temp(self, mode=None, output_file: str = None, decimate: bool = True) -> None:
         """plots selected temp variables or the overall mean"""
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+        from plot import LegendPickablePlot, DecimatedPlot, show_or_save
+
         if mode == 'mean':
-            _, ax = plt.subplots()
+            fig, ax = plt.subplots()
             mean_temp = self.temp_data.mean(axis=1).values
             print(f'delta temp. média = {mean_temp[-1]}')
-            ax.plot(self.temp_data.index, mean_temp)
-            plt.show()
+            DecimatedPlot(ax, enabled=decimate).plot(self.temp_data.index, mean_temp)
+            show_or_save(fig, output_file)
             return
 
         plot = LegendPickablePlot()
         fig, ax = plot.get_plot_props()
+        # long series are drawn decimated to the figure width
+        decimated_plot = DecimatedPlot(ax, enabled=decimate)
 
         y = self.temp_data.iloc[:,:].values
         x = self.temp_data.index
 
         lines, legends = [], []
-        line = ax.plot(x, y)
+        line = [decimated_plot.plot(x, y[:,i]) for i in range(y.shape[1])]
         [legends.append(var) for var in self.temp_data.columns.values]
         [lines.append(l) for l in line] 
         
@@ -681,4 +775,4 @@ class TemperatureDeformation:
         ax.grid()
         fig.canvas.mpl_connect('pick_event', partial(LegendPickablePlot.on_pick, fig=fig, lined=plot.get_lined()))
         fig.tight_layout()
-        plt.show()
+        show_or_save(fig, output_file)
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+import main
+from temp import TemperatureDeformation
+
+DAYS = 4
+RECORDS_PER_DAY = 1440
+
+
+def create_temperature() -> TemperatureDeformation:
+    temperature = TemperatureDeformation('archiver', 'concrete', combination_params=['A', 'N'], node_directions=main.get_node_temp_directions())
+    temperature.generate_custom_pvs_combination()
+    return temperature
+
+
+def create_degraded_data(pvs: list) -> pd.DataFrame:
+    """ daily cycles of 1 minute records, one pv missing for most of a day, one stuck and one with a spike """
+    rng = np.random.default_rng(0)
+    index = pd.date_range('2021-09-01', periods=DAYS*RECORDS_PER_DAY, freq='min')
+    phase = 2*np.pi*np.arange(len(index))/RECORDS_PER_DAY
+    values = 22 + rng.uniform(0, 2, len(pvs)) + np.sin(phase[:, None] + rng.uniform(0, np.pi, len(pvs)))
+    data = pd.DataFrame(np.round(values + rng.normal(0, 0.02, values.shape), 2), index=index, columns=pvs)
+    data.iloc[RECORDS_PER_DAY + 200:RECORDS_PER_DAY + 1200, 0] = np.nan
+    data.iloc[RECORDS_PER_DAY//2:, 1] = data.iloc[RECORDS_PER_DAY//2, 1]
+    data.iloc[3*RECORDS_PER_DAY - 10, 2] += 15
+    # short gap across the end of the first day
+    data.iloc[RECORDS_PER_DAY - 20:RECORDS_PER_DAY + 20, 3] = np.nan
+    return data
+
+
+def test_chunked_matches_single_pass():
+    single = create_temperature()
+    pvs = single.resolve_pvs()
+    data = create_degraded_data(pvs)
+    single.load_temp_data(data.copy())
+
+    chunked = create_temperature()
+    lookahead_records = chunked.quality.get_lookahead_records()
+    blocks = []
+    for day in range(DAYS):
+        block = data.iloc[day*RECORDS_PER_DAY:(day + 1)*RECORDS_PER_DAY]
+        lookahead = data.iloc[(day + 1)*RECORDS_PER_DAY:(day + 1)*RECORDS_PER_DAY + lookahead_records]
+        chunked.load_temp_data(block.copy(), lookahead.copy())
+        blocks.append(chunked.temp_data)
+
+    pd.testing.assert_frame_equal(pd.concat(blocks), single.temp_data, check_freq=False)
+    assert single.quality_report['status'].iloc[:3].tolist() != ['ok']*3
+
+
+def test_flatline_detected_across_blocks():
+    temperature = create_temperature()
+    pvs = temperature.resolve_pvs()
+    data = create_degraded_data(pvs)
+    # blocks shorter than the flatline window, as the live polls
+    for start in range(0, 2*RECORDS_PER_DAY, 60):
+        temperature.load_temp_data(data.iloc[start:start + 60].copy())
+    assert temperature.quality_mask[pvs[1]].all()
+    assert not temperature.quality_mask[pvs[4]].any()
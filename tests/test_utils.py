@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+from utils import MathUtils
+
+WINDOW = 120
+
+
+def create_series(records: int = 1000) -> tuple:
+    rng = np.random.default_rng(0)
+    model = np.cumsum(rng.normal(0, 1, records))
+    targets = np.column_stack([slope*model + rng.normal(0, 2, records) for slope in [-1, 0.5, 3]])
+    targets[100:150, 1] = np.nan
+    model[400:420] = np.nan
+    return model, targets
+
+
+def reference_regression(model: np.ndarray, target: np.ndarray) -> dict:
+    """ the same statistics from pandas rolling windows """
+    frame = pd.DataFrame({'x': model, 'y': target})
+    frame[frame.isna().any(axis=1)] = np.nan
+    windows = frame.rolling(WINDOW, min_periods=WINDOW)
+    covariance = windows.cov(pairwise=True).unstack()
+    slope = covariance[('x', 'y')] / covariance[('x', 'x')]
+    return {'correlation': windows.corr(pairwise=True).unstack()[('x', 'y')].values, 'slope': slope.values,
+            'intercept': (windows.mean()['y'] - slope*windows.mean()['x']).values}
+
+
+def test_single_model_against_many_targets():
+    model, targets = create_series()
+    results = MathUtils.rolling_regression(model, targets, WINDOW)
+    assert results['slope'].shape == targets.shape
+    for column in range(targets.shape[1]):
+        single = MathUtils.rolling_regression(model, targets[:, column], WINDOW)
+        for name in results:
+            np.testing.assert_allclose(results[name][:, column], single[name], rtol=1e-9, atol=1e-9)
+
+
+def test_matches_pandas_rolling():
+    model, targets = create_series()
+    results = MathUtils.rolling_regression(model, targets[:, 1], WINDOW)
+    for name, expected in reference_regression(model, targets[:, 1]).items():
+        np.testing.assert_allclose(results[name], expected, rtol=1e-6, atol=1e-9)
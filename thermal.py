@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+
+class ThermalInertia:
+    """ thermal response of the slab as a causal impulse response per node (kernel, records x node) applied to
+        the temperature series by FFT convolution, all nodes at once and in overlap-add blocks of records """
+
+    def __init__(self, kernels: np.ndarray) -> None:
+        kernels = np.asarray(kernels, dtype=float)
+        self.kernels = kernels[:, None] if kernels.ndim == 1 else kernels
+
+    @staticmethod
+    def from_time_constants(time_constants, acq_period_in_seconds: float = 60, length_in_time_constants: float = 10) -> 'ThermalInertia':
+        """ first order lags, time constants in seconds (one per node or a single one for all), with unit static gain """
+        time_constants = np.atleast_1d(np.asarray(time_constants, dtype=float))
+        length = max(1, int(np.ceil(length_in_time_constants * time_constants.max() / acq_period_in_seconds)))
+        samples = np.arange(length)[:, None] * acq_period_in_seconds
+        kernels = np.exp(-samples / time_constants[None, :])
+        return ThermalInertia(kernels / kernels.sum(axis=0))
+
+    @staticmethod
+    def fit_kernel(temperature: np.ndarray, response: np.ndarray, length: int, regularization: float = 1e-6) -> np.ndarray:
+        """ least squares FIR kernel of the given length relating a temperature series to a response series
+            (e.g. a measured deformation), from their auto and cross correlations computed by FFT """
+        temperature, response = np.asarray(temperature, dtype=float), np.asarray(response, dtype=float)
+        n = len(temperature)
+        size = 1 << int(np.ceil(np.log2(2*n)))
+        spectrum = np.fft.rfft(temperature, size)
+        autocorrelation = np.fft.irfft(spectrum.conj() * spectrum, size)[:length]
+        crosscorrelation = np.fft.irfft(spectrum.conj() * np.fft.rfft(response, size), size)[:length]
+        # toeplitz normal equations
+        lags = np.abs(np.arange(length)[:, None] - np.arange(length)[None, :])
+        gram = autocorrelation[lags] + regularization * autocorrelation[0] * np.eye(length)
+        return np.linalg.solve(gram, crosscorrelation)
+
+    def apply(self, temperature: np.ndarray, block_size: int = 1 << 16) -> np.ndarray:
+        """ causal convolution of each node series (records x node) with its kernel; the series are assumed
+            to be zero before the first record (temperatures referenced to the first one) """
+        temperature = np.asarray(temperature, dtype=float)
+        length = len(self.kernels)
+        size = 1 << int(np.ceil(np.log2(block_size + length - 1)))
+        kernel_spectrum = np.fft.rfft(self.kernels, size, axis=0)
+
+        result = np.zeros((len(temperature) + length - 1, temperature.shape[1]))
+        for start in range(0, len(temperature), block_size):
+            block = temperature[start:start + block_size]
+            convolved = np.fft.irfft(np.fft.rfft(block, size, axis=0) * kernel_spectrum, size, axis=0)
+            result[start:start + len(block) + length - 1] += convolved[:len(block) + length - 1]
+        return result[:len(temperature)]
+
+    def apply_frame(self, temp_data: pd.DataFrame) -> pd.DataFrame:
+        """ same as apply for a DataFrame, gaps being interpolated before the convolution """
+        values = temp_data.interpolate(limit_direction='both').fillna(0).values
+        return pd.DataFrame(self.apply(values), index=temp_data.index, columns=temp_data.columns)
@@ -1,13 +1,13 @@
-import geodesics
-
 from typing import Dict, List
 from pandas.core.arrays import boolean
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 import pandas as pd
 from datetime import datetime, timedelta
 import numpy as np
 
+from instrumentation import PROFILER
+from perimeter import Perimeter
+from timeseries import TimeSeriesArray
+
 CARDINAL_GP = {
     'N': (-22.807226196465898, -47.0524966686184),\
     'NNE': (-22.807307677130677, -47.05222194447693),\
@@ -27,6 +27,12 @@ CARDINAL_GP = {
     'NNW': (-22.80723725576768, -47.052729913577195)
 }
 
+# reference point for the linearized tide model
+RING_CENTER_GP = (np.mean([gp[0] for gp in CARDINAL_GP.values()]), np.mean([gp[1] for gp in CARDINAL_GP.values()]))
+EARTH_RADIUS = 6371e3
+# distance, in meters, between the points used to estimate the horizontal gradient of the tides
+GRADIENT_STEP = 100
+
 MAPPING_CARDINAL_SECTOR = {
     'E': 'Q1P2',
     'ENE': 'Q1P4',
@@ -47,51 +53,158 @@ MAPPING_CARDINAL_SECTOR = {
 }
 
 class Tides:
-    data: Dict = {}
+    series: TimeSeriesArray
     coords: List
     coord_list: Dict
     num_of_days: int
     mapping_needed: boolean
+    reference: np.ndarray
 
-    def __init__(self, point_names: List, mapping_needed: boolean = False) -> None:
+    def __init__(self, point_names: List, mapping_needed: boolean = False, mode: str = 'stations', node_directions: List = None,
+                 dtype = np.float64) -> None:
+        """ mode 'stations' evaluates the tide model at each of the CARDINAL_GP stations; mode 'linearized'
+            evaluates it only at the ring center, plus its horizontal gradient, and extrapolates it to each
+            point, placed on the ring by node_directions (angles from East) or, if not given, at its station.
+            The series are kept in a TimeSeriesArray of the given dtype, owned by the instance """
         self.coords = point_names
         self.mapping_needed = mapping_needed
-        # initializing data structure with empty DataFrames
-        for coord in self.coords:
-            self.data[coord] = pd.DataFrame()
+        self.mode = mode
+        self.node_directions = node_directions
+        self.dtype = dtype
+        # first record (station x component) of the first generated timespam, kept when the instance is reused for consecutive timespams
+        self.reference = None
+        # initializing data structure
+        self.reset_data()
         # initializing coordinate list with predefined latitude and longitude values
         self.coord_list = CARDINAL_GP
+
+    def reset_data(self) -> None:
+        self.series = None
+
+    @property
+    def data(self) -> Dict:
+        """ one DataFrame per point, as views of the series array """
+        if self.series is None:
+            return {coord: pd.DataFrame() for coord in self.coords}
+        return self.series.to_dict()
+
+    @staticmethod
+    def gp_to_offset(lat: float, lon: float) -> tuple:
+        """ local (East, North) offset, in meters, of a geographic position from the ring center """
+        lat0, lon0 = RING_CENTER_GP
+        east = np.radians(lon - lon0) * EARTH_RADIUS * np.cos(np.radians(lat0))
+        north = np.radians(lat - lat0) * EARTH_RADIUS
+        return east, north
+
+    def get_node_offsets(self) -> np.ndarray:
+        """ (East, North) offsets of each point from the ring center, in meters """
+        if self.node_directions is not None:
+            radius = Perimeter.REAL_PERIMETER / (2*np.pi)
+            theta = np.radians(self.node_directions)
+            return np.column_stack((radius*np.cos(theta), radius*np.sin(theta)))
+        point_to_cardinal = {v: k for k, v in MAPPING_CARDINAL_SECTOR.items()} if self.mapping_needed else {c: c for c in self.coords}
+        return np.array([Tides.gp_to_offset(*self.coord_list[point_to_cardinal[coord]]) for coord in self.coords])
+
+    @staticmethod
+    def evaluate(date: datetime, lat: float, lon: float) -> np.ndarray:
+        """ solid earth tide of a whole day with 1 minute period, as (North, East, Up) columns """
+        import geodesics
+        _, tides = geodesics.solid(date.year, date.month, date.day, lat, lon, 1)
+        return np.asarray(tides)
+
+    def evaluate_stations(self, date: datetime) -> Dict:
+        day_data = {}
+        for cardinal in self.coord_list:
+            point_name = cardinal if not self.mapping_needed else MAPPING_CARDINAL_SECTOR[cardinal]
+            day_data[point_name] = Tides.evaluate(date, self.coord_list[cardinal][0], self.coord_list[cardinal][1])
+        return day_data
+
+    def evaluate_linearized(self, date: datetime, offsets: np.ndarray = None) -> np.ndarray:
+        """ tides at the given (East, North) offsets from the ring center, as (time x point x component),
+            from a first order expansion around the center: 5 evaluations regardless of the number of points """
+        lat0, lon0 = RING_CENTER_GP
+        offsets = self.get_node_offsets() if offsets is None else offsets
+        step_lat = np.degrees(GRADIENT_STEP / EARTH_RADIUS)
+        step_lon = step_lat / np.cos(np.radians(lat0))
+
+        center = Tides.evaluate(date, lat0, lon0)
+        # central differences, per meter
+        gradient_east = (Tides.evaluate(date, lat0, lon0 + step_lon) - Tides.evaluate(date, lat0, lon0 - step_lon)) / (2*GRADIENT_STEP)
+        gradient_north = (Tides.evaluate(date, lat0 + step_lat, lon0) - Tides.evaluate(date, lat0 - step_lat, lon0)) / (2*GRADIENT_STEP)
+
+        return center[:, None, :] + offsets[None, :, 0, None] * gradient_east[:, None, :] + offsets[None, :, 1, None] * gradient_north[:, None, :]
+
+    def linearization_error(self, timespam: dict) -> Dict:
+        """ compares the linearized model with the evaluation at each of the 16 stations over the days of the timespam;
+            returns, per component, the maximum absolute error and the maximum displacement, in meters """
+        datelist = pd.date_range(start=datetime(timespam['init']['year'], timespam['init']['month'], timespam['init']['day']),\
+                                 end=datetime(timespam['end']['year'], timespam['end']['month'], timespam['end']['day']), freq='D').tolist()
+        offsets = np.array([Tides.gp_to_offset(*gp) for gp in self.coord_list.values()])
+        max_error, max_displacement = np.zeros(3), np.zeros(3)
+        for date in datelist:
+            linearized = self.evaluate_linearized(date, offsets)
+            stations = np.stack([Tides.evaluate(date, *gp) for gp in self.coord_list.values()], axis=1)
+            # errors of the displacements relative to the first record, as used by the perimeter
+            linearized -= linearized[0]
+            stations -= stations[0]
+            max_error = np.maximum(max_error, np.abs(linearized - stations).max(axis=(0, 1)))
+            max_displacement = np.maximum(max_displacement, np.abs(stations).max(axis=(0, 1)))
+
+        error = {}
+        for i, component in enumerate(['North', 'East', 'Up']):
+            error[component] = {'max_abs_error_m': max_error[i], 'max_displacement_m': max_displacement[i]}
+            print(f'{component}: max. error {max_error[i]*1e9:.3f} nm (max. displacement {max_displacement[i]*1e3:.3f} mm)')
+        return error
     
+    def evaluate_days(self, datelist: List) -> tuple:
+        """ point names and tides of whole days (time x point x component) """
+        if self.mode == 'linearized':
+            points = list(self.coords)
+            values = np.concatenate([self.evaluate_linearized(date) for date in datelist])
+        else:
+            days = [self.evaluate_stations(date) for date in datelist]
+            # requested points first, as they used to be ordered
+            points = [coord for coord in self.coords if coord in days[0]] + [point for point in days[0] if point not in self.coords]
+            values = np.concatenate([np.stack([day[point] for point in points], axis=1) for day in days])
+        return points, values.astype(self.dtype, copy=False)
+
+    def set_reference(self, timespam: dict) -> None:
+        """ takes the reference generate_tides would take for this timespam, evaluating its first day only, so that
+            instances generating later parts of the timespam (e.g. in other processes) share it """
+        first_day = datetime(timespam['init']['year'], timespam['init']['month'], timespam['init']['day'])
+        self.reference = self.evaluate_days([first_day])[1][0].copy()
+
+    @PROFILER.instrument('tides.generate_tides', lambda result, args, kwargs: {'stations': len(args[0].coords), 'days': args[0].num_of_days, 'rows': args[0].get_num_of_records()})
     def generate_tides(self, timespam: dict) -> None:
+        # discarding series from a previous call
+        self.reset_data()
         # setting datelist according to method parameters
         datelist = pd.date_range(start=datetime(timespam['init']['year'], timespam['init']['month'], timespam['init']['day']),\
                                  end=datetime(timespam['end']['year'], timespam['end']['month'], timespam['end']['day']), freq='D').tolist()
         # setting number of days for future use
         # self.num_of_days =  (datelist[-1] - datelist[0]).days
         self.num_of_days =  len(datelist)
-        # generating earth tides according to the timespam and position reference
-        for date in datelist:
-            for cardinal in self.coord_list:
-                _, tides = geodesics.solid(date.year, date.month, date.day, self.coord_list[cardinal][0], self.coord_list[cardinal][1], 1)
-                dummy = pd.DataFrame(tides, columns=['North', 'East', 'Up'])
-                point_name = cardinal if not self.mapping_needed else MAPPING_CARDINAL_SECTOR[cardinal]
-                self.data[point_name] = self.data[point_name].append(dummy, ignore_index=True)
+        # generating earth tides according to the timespam and position reference, time x point x component
+        points, values = self.evaluate_days(datelist)
 
-        # correcting datetime index
+        # datetime index
         index = pd.date_range(start=datetime(timespam['init']['year'], timespam['init']['month'], timespam['init']['day']),\
                               end=datetime(timespam['end']['year'], timespam['end']['month'], timespam['end']['day']) + timedelta(days=1),\
                               freq='T', closed='left')
 
-        for d in self.data:
-            self.data[d].index = index
-            # setting first record as 0 in tides series
-            self.data[d] = self.data[d] - self.data[d].iloc[0,:]
-            # filtering data to contemplate exactly the timespam
-            datetime_init = datetime(timespam['init']['year'], timespam['init']["month"], timespam['init']["day"], timespam['init']["hour"], timespam['init']["minute"], timespam['init']["second"])
-            datetime_end = datetime(timespam['end']['year'], timespam['end']["month"], timespam['end']["day"], timespam['end']["hour"], timespam['end']["minute"], timespam['end']["second"])
-            self.data[d] = self.data[d][(self.data[d].index >= datetime_init) & (self.data[d].index <= datetime_end)]
+        # setting first record as 0 in tides series
+        if self.reference is None:
+            self.reference = values[0].copy()
+        values -= self.reference
+
+        # filtering data to contemplate exactly the timespam
+        datetime_init = datetime(timespam['init']['year'], timespam['init']["month"], timespam['init']["day"], timespam['init']["hour"], timespam['init']["minute"], timespam['init']["second"])
+        datetime_end = datetime(timespam['end']['year'], timespam['end']["month"], timespam['end']["day"], timespam['end']["hour"], timespam['end']["minute"], timespam['end']["second"])
+        self.series = TimeSeriesArray(values, index, points, ['North', 'East', 'Up']).slice_time(datetime_init, datetime_end)
 
     def plot_tide(self, position:str = None) -> None:
+        import matplotlib.pyplot as plt
+
         if not position:
             for coord in self.coords:
                 self.data[coord].plot()
@@ -105,11 +218,14 @@ class Tides:
     def get_timeseries(self) -> dict:
         return self.data
 
+    def get_array(self) -> TimeSeriesArray:
+        return self.series
+
     def get_num_of_days(self) -> int:
         return self.num_of_days
 
     def get_num_of_records(self) -> int:
-        return len(self.data[self.coords[0]])
+        return len(self.series) if self.series is not None else 0
 
     def get_datetime_index(self) -> pd.Index:
-        return self.data[self.coords[0]].index
\ No newline at end of file
+        return self.series.index
\ No newline at end of file
@@ -0,0 +1,114 @@
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+
+class TimeSeriesArray:
+    """ compact container of the series of several stations (nodes) sharing one datetime index: a single
+        contiguous (time x station x component) array, optionally float32. Station, component and time
+        range selections are views of that array, and to_frame/to_dict wrap them without copying """
+
+    def __init__(self, values: np.ndarray, index, stations: List, components: List, dtype=None) -> None:
+        values = np.asarray(values)
+        if values.ndim == 2:
+            values = values[:, :, None]
+        self.values = np.ascontiguousarray(values, dtype=dtype if dtype is not None else values.dtype)
+        self.index = pd.DatetimeIndex(index)
+        self.stations = list(stations)
+        self.components = list(components)
+        self.station_positions = {station: i for i, station in enumerate(self.stations)}
+        if self.values.shape != (len(self.index), len(self.stations), len(self.components)):
+            raise ValueError(f'values of shape {self.values.shape} do not match the index, stations and components')
+
+    @staticmethod
+    def from_frames(frames: Dict, components: List = None, dtype=None) -> 'TimeSeriesArray':
+        """ from a dict of DataFrames with the same index, one per station (as Tides.get_timeseries) """
+        stations = list(frames)
+        first = frames[stations[0]]
+        components = list(first.columns) if components is None else components
+        values = np.empty((len(first), len(stations), len(components)), dtype=dtype or np.float64)
+        for i, station in enumerate(stations):
+            values[:, i, :] = frames[station][components].values
+        return TimeSeriesArray(values, first.index, stations, components)
+
+    @staticmethod
+    def from_frame(frame: pd.DataFrame, component: str = 'value', dtype=None) -> 'TimeSeriesArray':
+        """ from a DataFrame with one column per station (as TemperatureDeformation.def_data) """
+        return TimeSeriesArray(frame.values, frame.index, frame.columns, [component], dtype)
+
+    @staticmethod
+    def from_any(data, components: List = None, dtype=None) -> 'TimeSeriesArray':
+        if isinstance(data, TimeSeriesArray):
+            return data
+        if isinstance(data, pd.DataFrame):
+            return TimeSeriesArray.from_frame(data, dtype=dtype)
+        return TimeSeriesArray.from_frames(data, components, dtype)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.stations)
+
+    def __contains__(self, station: str) -> bool:
+        return station in self.station_positions
+
+    def __getitem__(self, station: str) -> pd.DataFrame:
+        return self.to_frame(station)
+
+    @property
+    def shape(self) -> tuple:
+        return self.values.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes
+
+    def keys(self) -> List:
+        return self.stations
+
+    def station(self, station: str) -> np.ndarray:
+        """ (time x component) view of one station """
+        return self.values[:, self.station_positions[station], :]
+
+    def component(self, component: str) -> np.ndarray:
+        """ (time x station) view of one component """
+        return self.values[:, :, self.components.index(component)]
+
+    def to_frame(self, station: str) -> pd.DataFrame:
+        return pd.DataFrame(self.station(station), index=self.index, columns=self.components, copy=False)
+
+    def to_wide(self, component: str = None) -> pd.DataFrame:
+        """ (time x station) DataFrame of one component, the first one by default """
+        component = self.components[0] if component is None else component
+        return pd.DataFrame(self.component(component), index=self.index, columns=self.stations, copy=False)
+
+    def to_dict(self) -> Dict:
+        return {station: self.to_frame(station) for station in self.stations}
+
+    def slice_time(self, start=None, end=None) -> 'TimeSeriesArray':
+        """ records within [start, end], sharing the array """
+        first = self.index.searchsorted(pd.Timestamp(start), side='left') if start is not None else 0
+        last = self.index.searchsorted(pd.Timestamp(end), side='right') if end is not None else len(self.index)
+        return TimeSeriesArray(self.values[first:last], self.index[first:last], self.stations, self.components)
+
+    def select(self, stations: List = None, components: List = None) -> 'TimeSeriesArray':
+        """ subset of stations and components, in the given order (a copy, unless nothing changes) """
+        stations = self.stations if stations is None else list(stations)
+        components = self.components if components is None else list(components)
+        if stations == self.stations and components == self.components:
+            return self
+        station_positions = [self.station_positions[station] for station in stations]
+        component_positions = [self.components.index(component) for component in components]
+        return TimeSeriesArray(self.values[:, station_positions][:, :, component_positions], self.index, stations, components)
+
+    def reindex_nearest(self, index) -> 'TimeSeriesArray':
+        """ records at the nearest timestamps of another index """
+        index = pd.DatetimeIndex(index)
+        if self.index.equals(index):
+            return self
+        positions = self.index.get_indexer(index, method='nearest')
+        return TimeSeriesArray(self.values[positions], index, self.stations, self.components)
+
+    def astype(self, dtype) -> 'TimeSeriesArray':
+        return TimeSeriesArray(self.values, self.index, self.stations, self.components, dtype)
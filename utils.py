@@ -1,14 +1,14 @@
-from scipy.signal import butter, filtfilt
-from scipy.stats import pearsonr
-from scipy.fft import rfftfreq, rfft
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
 
+# scipy and matplotlib are imported by the methods that use them, keeping this module light to import
+
 class MathUtils:
 
     @staticmethod
     def filter_timeserie(timeserie, min_period) -> np.array:
+        from scipy.signal import butter, filtfilt
+
         T = 60 # in seconds
         filter_type = 'lowpass'
         filter_limit = 1/(3600*min_period)
@@ -18,9 +18,28 @@ class MathUtils:
 
         return filtered_data
 
+    @staticmethod
+    def filter_timeserie_causal(timeserie, min_period, zi: np.ndarray = None) -> tuple:
+        """ forward-only version of filter_timeserie that can be applied block by block:
+            the returned state must be passed as 'zi' along with the next block """
+        from scipy.signal import butter, sosfilt, sosfilt_zi
+
+        T = 60 # in seconds
+        filter_type = 'lowpass'
+        filter_limit = 1/(3600*min_period)
+
+        sos = butter(4, filter_limit, filter_type, fs=1/T, output='sos')
+        if zi is None:
+            # starting in steady state with the first sample
+            zi = sosfilt_zi(sos) * timeserie[0]
+        filtered_data, zf = sosfilt(sos, timeserie, zi=zi)
+
+        return filtered_data, zf
+
     @staticmethod
     def calculate_correlation(serie1: list, serie2: list, corr_type: str = 'pearson'):
         if (corr_type == 'pearson'):
+            from scipy.stats import pearsonr
             corr, _ = pearsonr(serie1, serie2)
         elif (corr_type == 'cross'):
             # calculating time-based normalized cross-correlation
@@ -31,8 +50,62 @@ class MathUtils:
         
         print(f'{corr_type} correlation: {corr:.4f}')
     
+    @staticmethod
+    def rolling_regression(model, target, window: int, min_periods: int = None) -> dict:
+        """ correlation, slope, intercept and residual rms of target (e.g. RF) regressed on model over the trailing
+            window of each record, for one model series (time) or many variants at once (time x variant), a
+            single model being regressed against every column of a (time x variant) target.
+            The window sums come from cumulative sums, so the cost does not depend on the window length;
+            records where model or target is NaN are left out, and windows with fewer than min_periods valid
+            records (window by default) are NaN """
+        model = np.asarray(model, dtype=float)
+        target = np.asarray(target, dtype=float)
+        if model.ndim == 1 and target.ndim == 2:
+            model = np.broadcast_to(model[:, None], target.shape)
+        single = model.ndim == 1
+        # variant x time internally, the cumulative sums running along contiguous memory
+        x = np.ascontiguousarray(model[None, :] if single else model.T)
+        y = target[None, :] if target.ndim == 1 else np.ascontiguousarray(target.T)
+        min_periods = window if min_periods is None else min_periods
+
+        # a single target without gaps in the models shares its sums (and the counts) with every variant
+        if len(y) == 1 and not np.isnan(x).any():
+            valid = ~np.isnan(y)
+        else:
+            valid = ~(np.isnan(x) | np.isnan(y))
+            y = np.broadcast_to(y, x.shape)
+        # centering on the global means to limit the cancellation in the differences of large sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x_mean = np.where(valid, x, 0).sum(axis=1, keepdims=True) / valid.sum(axis=1, keepdims=True)
+            y_mean = np.where(valid, y, 0).sum(axis=1, keepdims=True) / valid.sum(axis=1, keepdims=True)
+        x = np.where(valid, x - x_mean, 0)
+        y = np.where(valid, y - y_mean, 0)
+
+        def window_sums(values: np.ndarray) -> np.ndarray:
+            sums = np.cumsum(values, axis=1)
+            sums[:, window:] -= sums[:, :-window].copy()
+            return sums
+
+        n = window_sums(valid.astype(float))
+        sx, sy = window_sums(x), window_sums(y)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sxx = window_sums(x*x) - sx*sx/n
+            syy = window_sums(y*y) - sy*sy/n
+            sxy = window_sums(x*y) - sx*sy/n
+            slope = sxy / sxx
+            results = {'correlation': sxy / np.sqrt(sxx * syy), 'slope': slope,
+                       # intercept of the original (not centered) series
+                       'intercept': (sy - slope*sx)/n + y_mean - slope*x_mean,
+                       'residual_rms': np.sqrt(np.maximum(syy - slope*sxy, 0) / n)}
+        for name in results:
+            results[name] = np.where(n < max(min_periods, 2), np.nan, results[name])
+            results[name] = results[name][0] if single else results[name].T
+        return results
+
     @staticmethod
     def calculate_fft(timeserie: list, acq_period_in_seconds: float):
+        from scipy.fft import rfftfreq, rfft
+
         series_length = len(timeserie)
         # creating frequency x axis data
         freq_raw = rfftfreq(series_length, acq_period_in_seconds)
@@ -54,6 +127,7 @@ class DataUtils:
                      press enter to compute then and move to next outliers to exclude; once finished the 
                      selecting, just close the plot window and the filtered dataset will be saved in a
                      .xlsx format and shown in a new plot windows (if plot_output is True) """
+        import matplotlib.pyplot as plt
         from plot import PickPointsPlot
 
         # x = rf.get_data().index.values